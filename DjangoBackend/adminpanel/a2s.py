@@ -0,0 +1,520 @@
+"""
+Game server status over the Steam A2S query protocol, for the entity that
+declares "a2s" in entities.json
+
+  "GameServer": {
+    "fields": {"name": ..., "host": ..., "query_port": "IntegerField(default=27015)", "is_active": ...},
+    "a2s": {"host": "host", "port": "query_port", "active": "is_active", "interval": 15, "timeout": 2}
+  }
+
+A poller thread, started by the first /api/servers/ request of a web
+process, runs an asyncio loop that queries every registered server, and
+those listed in A2S_SERVERS, with A2S_INFO and (unless "players" is false)
+A2S_PLAYER, answering challenges and reassembling split responses. All
+queries share one UDP socket; replies are matched to servers by address.
+Each server is queried every interval seconds, +/- jitter, from a random
+start, so 1000 servers every 15 seconds make about 130 queries per second;
+at most A2S_CONCURRENCY are in flight. A server that does not answer within
+timeout seconds is offline until it answers again.
+
+Results live in memory: /api/servers/ returns the last status of each
+server and never waits for a query. The server list is reloaded from the
+database every A2S_RELOAD_SECONDS.
+
+StandIn answers queries like a game server, for tests and for
+query_servers --stand-in.
+"""
+
+import asyncio
+import ipaddress
+import json
+import os
+import random
+import socket
+import struct
+import threading
+import time
+from functools import lru_cache
+
+from django.apps import apps
+from django.conf import settings
+from django.db import connection
+from rest_framework import viewsets
+from rest_framework.exceptions import NotFound
+from rest_framework.response import Response
+
+# Queries in flight at once
+A2S_CONCURRENCY = int(os.getenv('A2S_CONCURRENCY', 256))
+
+# Seconds between reloads of the server list
+A2S_RELOAD_SECONDS = float(os.getenv('A2S_RELOAD_SECONDS', 60))
+
+# Servers queried in addition to the registered ones: "host:port,host:port"
+A2S_SERVERS = os.getenv('A2S_SERVERS', '')
+
+# Seconds before an unanswered request is sent again, within the server's timeout
+A2S_RETRANSMIT = float(os.getenv('A2S_RETRANSMIT', 0.5))
+
+# Receive buffer of the query socket, for replies arriving in bursts
+A2S_RCVBUF = int(os.getenv('A2S_RCVBUF', 1024 * 1024))
+
+HEADER = b'\xff\xff\xff\xff'
+SPLIT_HEADER = b'\xfe\xff\xff\xff'
+INFO_REQUEST = HEADER + b'TSource Engine Query\x00'
+PLAYER_REQUEST = HEADER + b'U'
+NO_CHALLENGE = b'\xff\xff\xff\xff'
+CHALLENGE_REPLY = 0x41
+INFO_REPLY = 0x49
+PLAYER_REPLY = 0x44
+
+DEFAULTS = {"interval": 15, "jitter": 0.2, "timeout": 2.0, "players": True}
+
+
+class A2SError(Exception):
+    """A reply that is not a valid A2S response"""
+
+
+def a2s_entity(model_name, model_config):
+    """Normalized "a2s" of an entity, None if it declares none"""
+    a2s = model_config.get("a2s")
+    if not a2s:
+        return None
+    fields = model_config.get("fields", {})
+    for option in ("host", "port", "active"):
+        if option in a2s and a2s[option] not in fields:
+            raise ValueError(f"{model_name}: a2s '{option}' names unknown field '{a2s[option]}'")
+    if "host" not in a2s or "port" not in a2s:
+        raise ValueError(f"{model_name}: a2s needs 'host' and 'port' fields")
+    spec = {**DEFAULTS, **{key: a2s[key] for key in DEFAULTS if key in a2s}}
+    if not 1 <= spec["interval"] <= 3600 or not 0 <= spec["jitter"] < 1 or not 0 < spec["timeout"] < spec["interval"]:
+        raise ValueError(f"{model_name}: a2s needs 1 <= interval <= 3600, 0 <= jitter < 1 and 0 < timeout < interval")
+    return {"model": model_name, "host": a2s["host"], "port": a2s["port"], "active": a2s.get("active"),
+            "name": "name" if "name" in fields else None, **spec}
+
+
+@lru_cache(maxsize=1)
+def a2s_spec():
+    """The a2s spec of the entity declaring it, or the defaults when only A2S_SERVERS lists servers"""
+    config = json.loads(settings.DYNAMIC_MODELS_CONFIG['CONFIG_PATH'].read_text())
+    specs = [spec for spec in (a2s_entity(name, model_config) for name, model_config in config.items()) if spec]
+    if len(specs) > 1:
+        raise ValueError(f"a2s is declared by {' and '.join(spec['model'] for spec in specs)}, at most one entity")
+    if specs:
+        return specs[0]
+    return {"model": None, **DEFAULTS} if A2S_SERVERS else None
+
+
+def parse_address(value, default_port=27015):
+    host, _, port = value.strip().rpartition(':')
+    if not host:
+        return value.strip(), default_port
+    return host.strip('[]'), int(port)
+
+
+def load_servers(spec):
+    """{'host:port': {'name', 'host', 'port'}} of the servers to query"""
+    servers = {}
+    for entry in A2S_SERVERS.split(','):
+        if entry.strip():
+            host, port = parse_address(entry)
+            servers[f"{host}:{port}"] = {"name": None, "host": host, "port": port}
+    if spec["model"] is None:
+        return servers
+    model = apps.get_model('adminpanel', spec["model"])
+    rows = model.objects.all()
+    if spec["active"]:
+        rows = rows.filter(**{spec["active"]: True})
+    columns = [spec["host"], spec["port"]] + ([spec["name"]] if spec["name"] else [])
+    try:
+        for row in rows.values_list(*columns):
+            host, port = row[0], int(row[1])
+            servers[f"{host}:{port}"] = {"name": row[2] if spec["name"] else None, "host": host, "port": port}
+    finally:
+        connection.close()
+    return servers
+
+
+class Reader:
+    """Little-endian fields of an A2S payload"""
+
+    def __init__(self, data):
+        self.data = data
+        self.offset = 0
+
+    def unpack(self, fmt):
+        try:
+            values = struct.unpack_from(fmt, self.data, self.offset)
+        except struct.error:
+            raise A2SError("Truncated reply")
+        self.offset += struct.calcsize(fmt)
+        return values[0]
+
+    def string(self):
+        end = self.data.find(b'\x00', self.offset)
+        if end < 0:
+            raise A2SError("Unterminated string")
+        value = self.data[self.offset:end].decode('utf-8', 'replace')
+        self.offset = end + 1
+        return value
+
+    def more(self):
+        return self.offset < len(self.data)
+
+
+def parse_info(payload):
+    """A2S_INFO reply (without the FF FF FF FF header) as a dict"""
+    reader = Reader(payload)
+    if reader.unpack('<B') != INFO_REPLY:
+        raise A2SError("Not an A2S_INFO reply")
+    info = {'protocol': reader.unpack('<B'), 'name': reader.string(), 'map': reader.string(),
+            'folder': reader.string(), 'game': reader.string(), 'app_id': reader.unpack('<H'),
+            'players': reader.unpack('<B'), 'max_players': reader.unpack('<B'), 'bots': reader.unpack('<B'),
+            'server_type': chr(reader.unpack('<B')), 'environment': chr(reader.unpack('<B')),
+            'password': bool(reader.unpack('<B')), 'vac': bool(reader.unpack('<B')), 'version': reader.string()}
+    if reader.more():
+        flags = reader.unpack('<B')
+        if flags & 0x80:
+            info['port'] = reader.unpack('<H')
+        if flags & 0x10:
+            info['steam_id'] = reader.unpack('<Q')
+        if flags & 0x40:
+            info['tv_port'] = reader.unpack('<H')
+            info['tv_name'] = reader.string()
+        if flags & 0x20:
+            info['keywords'] = reader.string()
+        if flags & 0x01:
+            info['game_id'] = reader.unpack('<Q')
+    return info
+
+
+def parse_players(payload):
+    """A2S_PLAYER reply (without the FF FF FF FF header) as a list of dicts"""
+    reader = Reader(payload)
+    if reader.unpack('<B') != PLAYER_REPLY:
+        raise A2SError("Not an A2S_PLAYER reply")
+    players = []
+    for _ in range(reader.unpack('<B')):
+        reader.unpack('<B')
+        players.append({'name': reader.string(), 'score': reader.unpack('<l'),
+                        'duration': round(reader.unpack('<f'), 1)})
+    return players
+
+
+class QueryProtocol(asyncio.DatagramProtocol):
+    """One UDP socket for all queries; replies go to the query waiting on their address"""
+
+    def __init__(self):
+        self.transport = None
+        self.waiting = {}
+        self.parts = {}
+        self.unexpected = 0
+
+    def connection_made(self, transport):
+        self.transport = transport
+        sock = transport.get_extra_info('socket')
+        try:
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, A2S_RCVBUF)
+        except OSError:
+            pass
+
+    def datagram_received(self, data, addr):
+        addr = addr[:2]
+        future = self.waiting.get(addr)
+        if future is None or future.done():
+            self.unexpected += 1
+            return
+        if data[:4] == SPLIT_HEADER:
+            data = self.reassemble(addr, data)
+            if data is None:
+                return
+        if data[:4] != HEADER or len(data) < 5:
+            future.set_exception(A2SError("Reply without A2S header"))
+            return
+        future.set_result(data[4:])
+
+    def reassemble(self, addr, data):
+        """The whole reply once every part of a split reply arrived (Source format)"""
+        reader = Reader(data)
+        reader.offset = 4
+        try:
+            packet_id, total, number = reader.unpack('<l'), reader.unpack('<B'), reader.unpack('<B')
+            reader.unpack('<H')
+        except A2SError:
+            return None
+        if packet_id & 0x80000000 or total == 0 or number >= total:
+            self.waiting[addr].set_exception(A2SError("Compressed or invalid split reply"))
+            return None
+        parts = self.parts.setdefault((addr, packet_id), {})
+        parts[number] = data[reader.offset:]
+        if len(parts) < total:
+            return None
+        del self.parts[(addr, packet_id)]
+        return b''.join(parts[index] for index in range(total))
+
+    def error_received(self, exc):
+        # ICMP port unreachable: the server is down, the next query times out
+        pass
+
+    async def request(self, addr, payload):
+        future = asyncio.get_running_loop().create_future()
+        self.waiting[addr] = future
+        try:
+            # UDP loses datagrams: resend until a reply or the caller's timeout
+            while True:
+                self.transport.sendto(payload, addr)
+                done, _ = await asyncio.wait([future], timeout=A2S_RETRANSMIT)
+                if done:
+                    return future.result()
+        finally:
+            if self.waiting.get(addr) is future:
+                del self.waiting[addr]
+            for key in [key for key in self.parts if key[0] == addr]:
+                del self.parts[key]
+
+    async def exchange(self, addr, request, challenge_suffix=b''):
+        """Send a request, answering up to two challenges; returns the reply payload"""
+        reply = await self.request(addr, request + challenge_suffix)
+        for _ in range(2):
+            if reply[:1] != bytes([CHALLENGE_REPLY]) or len(reply) < 5:
+                return reply
+            reply = await self.request(addr, request + reply[1:5])
+        raise A2SError("Server keeps sending challenges")
+
+    async def query(self, addr, players=True):
+        """(info, players or None, ping in ms) of one server"""
+        started = time.monotonic()
+        info = parse_info(await self.exchange(addr, INFO_REQUEST))
+        ping = round((time.monotonic() - started) * 1000, 1)
+        roster = parse_players(await self.exchange(addr, PLAYER_REQUEST, NO_CHALLENGE)) if players else None
+        return info, roster, ping
+
+
+class Poller:
+    """Queries the servers from an asyncio loop and keeps their last status in memory"""
+
+    def __init__(self, spec):
+        self.spec = spec
+        self.status = {}
+        # Guards status: the loop thread writes it, request threads take snapshots
+        self.lock = threading.Lock()
+        self.servers = {}
+        self.tasks = {}
+        self.addresses = {}
+        self.protocol = None
+        self.semaphore = None
+        self.thread = None
+        self.counters = {'queries': 0, 'answered': 0, 'timeouts': 0, 'errors': 0}
+
+    def start(self):
+        """Poll from a daemon thread with its own event loop"""
+        self.thread = threading.Thread(target=asyncio.run, args=(self.run(),), name='a2s-poller', daemon=True)
+        self.thread.start()
+
+    async def open(self):
+        loop = asyncio.get_running_loop()
+        _, self.protocol = await loop.create_datagram_endpoint(QueryProtocol, local_addr=('0.0.0.0', 0))
+        self.semaphore = asyncio.Semaphore(A2S_CONCURRENCY)
+
+    async def run(self):
+        await self.open()
+        loop = asyncio.get_running_loop()
+        while True:
+            try:
+                # The ORM must not run on the event loop's thread
+                self.sync(await loop.run_in_executor(None, load_servers, self.spec))
+            except Exception as e:
+                print(f"A2S server list reload failed, keeping the previous one: {e}")
+            await asyncio.sleep(A2S_RELOAD_SECONDS)
+
+    def sync(self, servers):
+        """Start watching new servers and stop watching removed ones"""
+        for key in set(self.tasks) - set(servers):
+            self.tasks.pop(key).cancel()
+            with self.lock:
+                self.status.pop(key, None)
+            self.addresses.pop(key, None)
+        for key, server in servers.items():
+            self.servers[key] = server
+            if key not in self.tasks:
+                with self.lock:
+                    self.status[key] = self.entry(server, 'pending')
+                self.tasks[key] = asyncio.create_task(self.watch(key))
+
+    async def watch(self, key):
+        interval, jitter = self.spec["interval"], self.spec["jitter"]
+        await asyncio.sleep(random.uniform(0, interval))
+        while True:
+            await self.poll(key)
+            await asyncio.sleep(interval * random.uniform(1 - jitter, 1 + jitter))
+
+    async def resolve(self, key):
+        """IP address of a server, looked up again with every server list reload"""
+        server = self.servers[key]
+        cached = self.addresses.get(key)
+        if cached and cached[1] > time.monotonic():
+            return cached[0]
+        try:
+            ipaddress.ip_address(server["host"])
+            ip = server["host"]
+        except ValueError:
+            found = await asyncio.get_running_loop().getaddrinfo(server["host"], server["port"],
+                                                                 family=socket.AF_INET, type=socket.SOCK_DGRAM)
+            ip = found[0][4][0]
+        self.addresses[key] = (ip, time.monotonic() + A2S_RELOAD_SECONDS)
+        return ip
+
+    async def poll(self, key):
+        server = self.servers[key]
+        previous = self.status.get(key) or self.entry(server, 'pending')
+        self.counters['queries'] += 1
+        async with self.semaphore:
+            try:
+                addr = (await self.resolve(key), server["port"])
+                info, players, ping = await asyncio.wait_for(
+                    self.protocol.query(addr, self.spec["players"]), self.spec["timeout"],
+                )
+            except asyncio.TimeoutError:
+                self.counters['timeouts'] += 1
+                error = f"No reply within {self.spec['timeout']}s"
+            except (A2SError, OSError) as e:
+                self.counters['errors'] += 1
+                error = str(e)
+            else:
+                self.counters['answered'] += 1
+                with self.lock:
+                    self.status[key] = {**self.entry(server, 'online'), 'ping_ms': ping, 'info': info,
+                                        'players': players, 'last_seen': time.time(), 'failures': 0}
+                return
+        # Offline keeps the last known info, so dashboards can show what went away
+        with self.lock:
+            self.status[key] = {**previous, 'state': 'offline', 'error': error, 'checked_at': time.time(),
+                                'failures': previous.get('failures', 0) + 1}
+
+    @staticmethod
+    def entry(server, state):
+        return {'address': f"{server['host']}:{server['port']}", 'name': server['name'], 'state': state,
+                'ping_ms': None, 'info': None, 'players': None, 'error': None, 'last_seen': None,
+                'checked_at': time.time() if state != 'pending' else None, 'failures': 0}
+
+    async def poll_once(self, servers):
+        """Query every server once, concurrently; used by query_servers"""
+        if self.protocol is None:
+            await self.open()
+        self.sync(servers)
+        for task in self.tasks.values():
+            task.cancel()
+        await asyncio.gather(*(self.poll(key) for key in servers))
+        return self.status
+
+    def snapshot(self):
+        """Statuses sorted by name, safe to call from any thread"""
+        with self.lock:
+            statuses = list(self.status.values())
+        return sorted(statuses, key=lambda status: (status['name'] or '', status['address']))
+
+
+poller = None
+poller_lock = threading.Lock()
+
+
+def get_poller():
+    """The process's poller, started on first use; None when no servers are configured"""
+    global poller
+    with poller_lock:
+        if poller is None:
+            spec = a2s_spec()
+            if spec is None:
+                return None
+            poller = Poller(spec)
+            poller.start()
+        return poller
+
+
+class ServerViewSet(viewsets.ViewSet):
+    """Last A2S status of the game servers: /api/servers/, /api/servers/<host:port or name>/"""
+
+    lookup_value_regex = '[^/]+'
+
+    def list(self, request):
+        current = get_poller()
+        servers = current.snapshot() if current else []
+        if request.query_params.get('state'):
+            servers = [server for server in servers if server['state'] == request.query_params['state']]
+        online = [server for server in servers if server['state'] == 'online']
+        return Response({
+            'count': len(servers),
+            'online': len(online),
+            'players': sum(server['info']['players'] for server in online),
+            'counters': current.counters if current else {},
+            'results': servers,
+        })
+
+    def retrieve(self, request, pk=None):
+        current = get_poller()
+        for server in current.snapshot() if current else []:
+            if pk in (server['address'], server['name']):
+                return Response(server)
+        raise NotFound(f"No game server '{pk}'")
+
+
+def info_reply(name, map_name, players, max_players, port, game='Stand-in', folder='standin', version='1.0'):
+    return (HEADER + bytes([INFO_REPLY, 17]) + b'\x00'.join(
+        value.encode() for value in (name, map_name, folder, game)) + b'\x00'
+        + struct.pack('<HBBBBBBB', 0, players, max_players, 0, ord('d'), ord('l'), 0, 0)
+        + version.encode() + b'\x00' + struct.pack('<BH', 0x80, port))
+
+
+def player_reply(players):
+    return HEADER + bytes([PLAYER_REPLY, len(players)]) + b''.join(
+        struct.pack('<B', index) + name.encode() + b'\x00' + struct.pack('<lf', score, duration)
+        for index, (name, score, duration) in enumerate(players)
+    )
+
+
+class StandIn(asyncio.DatagramProtocol):
+    """
+    Answers A2S_INFO and A2S_PLAYER like a game server, challenge included;
+    player lists longer than split bytes are sent as split replies, and a
+    drop fraction of the requests goes unanswered
+    """
+
+    def __init__(self, name='Stand-in', map_name='Lobby', players=(), max_players=16, split=1200, drop=0.0):
+        self.name = name
+        self.map_name = map_name
+        self.players = list(players)
+        self.max_players = max_players
+        self.split = split
+        self.drop = drop
+        self.token = struct.pack('<l', random.randint(1, 2 ** 31 - 1))
+        self.transport = None
+        self.split_id = 0
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def datagram_received(self, data, addr):
+        if random.random() < self.drop:
+            return
+        if data.startswith(INFO_REQUEST):
+            if data[len(INFO_REQUEST):] != self.token:
+                self.transport.sendto(HEADER + bytes([CHALLENGE_REPLY]) + self.token, addr)
+                return
+            port = self.transport.get_extra_info('sockname')[1]
+            self.transport.sendto(info_reply(self.name, self.map_name, len(self.players), self.max_players, port),
+                                  addr)
+        elif data.startswith(PLAYER_REQUEST):
+            if data[len(PLAYER_REQUEST):] != self.token:
+                self.transport.sendto(HEADER + bytes([CHALLENGE_REPLY]) + self.token, addr)
+                return
+            self.send(player_reply(self.players), addr)
+
+    def send(self, reply, addr):
+        if len(reply) <= self.split:
+            self.transport.sendto(reply, addr)
+            return
+        self.split_id = (self.split_id + 1) % 2 ** 31
+        chunks = [reply[offset:offset + self.split] for offset in range(0, len(reply), self.split)]
+        for number, chunk in reversed(list(enumerate(chunks))):
+            self.transport.sendto(
+                SPLIT_HEADER + struct.pack('<lBBH', self.split_id, len(chunks), number, self.split) + chunk, addr,
+            )
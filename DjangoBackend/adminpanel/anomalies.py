@@ -0,0 +1,303 @@
+"""
+Statistical outlier detection, declared per entity in entities.json
+
+  "Match": {
+    "anomalies": {
+      "win_rate": {"by": "winner", "against": "loser", "time": "end_time", "window": 86400}
+    }
+  },
+  "Item": {
+    "anomalies": {
+      "value_spike": {"field": "value", "group_by": "rarity"}
+    }
+  }
+
+- field detectors flag rows whose numeric field has a robust z-score
+  (0.6745 * (x - median) / MAD, per group_by group) of at least "threshold"
+  (default 3.5) in either direction
+- rate detectors count the rows per owner ("by") over sliding windows of
+  "window" seconds moving by "step" (default 3600). With "against" they flag
+  owners whose share of by-rows among their by- and against-rows is above the
+  overall share by "threshold" (default 4) binomial standard deviations, in
+  windows of at least "min_rows" (default 10) rows; without it, windows whose
+  count has a robust z-score of at least "threshold"
+
+detect_anomalies loads the columns it needs with a binary COPY straight into
+NumPy arrays and computes every count and score vectorized. Flags go to
+the Anomaly review table: each run replaces the open flags of a detector,
+and objects with a reviewed flag are not flagged again by it.
+"""
+
+import io
+import json
+import os
+from datetime import datetime, timedelta, timezone as dt_timezone
+from functools import lru_cache
+
+import numpy as np
+from django.apps import apps
+from django.conf import settings
+from django.contrib import admin
+from django.db import connection, transaction
+from django.db.models import Case, F, FloatField, Value, When
+from django.db.models.functions import Cast, Extract
+from django.urls import NoReverseMatch, reverse
+from django.utils import timezone
+from django.utils.html import format_html
+
+# Most flags kept per detector and run, highest scores first
+ANOMALY_MAX_FLAGS = int(os.getenv('ANOMALY_MAX_FLAGS', 1000))
+
+# Most distinct values of a non-numeric group_by field
+ANOMALY_MAX_GROUPS = int(os.getenv('ANOMALY_MAX_GROUPS', 1000))
+
+# Consistency constant of the MAD for normally distributed data
+MAD_SCALE = 0.6745
+
+NUMERIC_TYPES = ('IntegerField', 'BigIntegerField', 'SmallIntegerField', 'PositiveIntegerField',
+                 'PositiveSmallIntegerField', 'FloatField', 'DecimalField', 'AutoField', 'BigAutoField')
+
+
+def source_detectors(model_name, model_config):
+    """Normalized detectors of one entity, defaults filled in"""
+    fields = model_config.get("fields", {})
+    detectors = {}
+    for name, detector in model_config.get("anomalies", {}).items():
+        if "field" in detector:
+            if detector["field"] not in fields:
+                raise ValueError(f"{model_name}: anomaly detector '{name}' checks unknown field '{detector['field']}'")
+            if detector.get("group_by") and detector["group_by"] not in fields:
+                raise ValueError(f"{model_name}: anomaly detector '{name}' groups by unknown field '{detector['group_by']}'")
+            detectors[name] = {"kind": "field", "field": detector["field"], "group_by": detector.get("group_by"),
+                               "threshold": float(detector.get("threshold", 3.5))}
+        elif "by" in detector:
+            for role in ("by", "against"):
+                if detector.get(role) and 'ForeignKey' not in str(fields.get(detector[role])):
+                    raise ValueError(f"{model_name}: anomaly detector '{name}' needs '{role}' naming a ForeignKey")
+            if 'DateTimeField' not in str(fields.get(detector.get("time"))):
+                raise ValueError(f"{model_name}: anomaly detector '{name}' needs 'time' naming a DateTimeField")
+            step = int(detector.get("step", 3600))
+            window = int(detector.get("window", 86400))
+            if window % step:
+                raise ValueError(f"{model_name}: anomaly detector '{name}' needs a window that is a multiple of step")
+            detectors[name] = {"kind": "rate", "by": detector["by"], "against": detector.get("against"),
+                               "time": detector["time"], "window": window, "step": step,
+                               "min_rows": int(detector.get("min_rows", 10)),
+                               "threshold": float(detector.get("threshold", 4 if detector.get("against") else 3.5))}
+        else:
+            raise ValueError(f"{model_name}: anomaly detector '{name}' needs 'field' or 'by'")
+    return detectors
+
+
+@lru_cache(maxsize=1)
+def detector_specs():
+    """{name: {'source': model_name, ...}} of all entities"""
+    config = json.loads(settings.DYNAMIC_MODELS_CONFIG['CONFIG_PATH'].read_text())
+    specs = {}
+    for model_name, model_config in config.items():
+        for name, detector in source_detectors(model_name, model_config).items():
+            if name in specs:
+                raise ValueError(f"Anomaly detector '{name}' is declared by {specs[name]['source']} and {model_name}")
+            specs[name] = {"source": model_name, **detector}
+    return specs
+
+
+def fetch_columns(queryset, columns):
+    """
+    Columns of a queryset as float64 arrays, read with COPY ... (FORMAT binary):
+    every row has the same size, so the buffer maps onto a structured dtype.
+    The columns must not be NULL, the queryset filters those rows out
+    """
+    queryset = queryset.annotate(**{
+        f"copy_{name}": Cast(expression, FloatField()) for name, expression in columns.items()
+    }).values_list(*(f"copy_{name}" for name in columns))
+    sql, params = queryset.query.sql_with_params()
+    with connection.cursor() as cursor:
+        buffer = io.BytesIO()
+        cursor.copy_expert(f"COPY ({cursor.mogrify(sql, params).decode()}) TO STDOUT (FORMAT binary)", buffer)
+    data = buffer.getbuffer()
+    # 11 byte signature, flags, header extension length; each row: field count, then length and value per field
+    offset = 19 + int.from_bytes(data[15:19], 'big')
+    row = np.dtype([('count', '>i2')] + [item for name in columns for item in ((f"{name}_length", '>i4'), (name, '>f8'))])
+    rows = np.frombuffer(data, dtype=row, count=(len(data) - offset - 2) // row.itemsize, offset=offset)
+    # A NULL has length -1 and no value, so it shortens its row and shifts every later one
+    aligned = offset + len(rows) * row.itemsize + 2 == len(data)
+    if not aligned or any((rows[f"{name}_length"] != 8).any() for name in columns):
+        raise ValueError(f"COPY returned NULL values for {', '.join(columns)}")
+    return {name: rows[name].astype(np.float64) for name in columns}
+
+
+def group_medians(values, groups):
+    """Median of values per group code, for groups 0..groups.max()"""
+    order = np.lexsort((values, groups))
+    values = values[order]
+    counts = np.bincount(groups)
+    starts = np.concatenate([[0], np.cumsum(counts)[:-1]])
+    present = counts > 0
+    medians = np.zeros(len(counts))
+    medians[present] = (values[starts[present] + (counts[present] - 1) // 2] +
+                        values[starts[present] + counts[present] // 2]) / 2
+    return medians
+
+
+def robust_z(values, groups=None):
+    """Modified z-scores of values within their groups (all in one group by default)"""
+    if not len(values):
+        return np.empty(0), np.empty(0)
+    groups = np.zeros(len(values), dtype=np.int64) if groups is None else groups
+    medians = group_medians(values, groups)
+    deviations = np.abs(values - medians[groups])
+    mad = group_medians(deviations, groups)
+    # Groups with MAD 0 (most values equal) fall back on the mean absolute deviation
+    mean_ad = np.bincount(groups, deviations) / np.maximum(np.bincount(groups), 1)
+    scale = np.where(mad > 0, mad, mean_ad * 1.2533 * MAD_SCALE)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        scores = np.where(scale[groups] > 0, MAD_SCALE * (values - medians[groups]) / scale[groups], 0.0)
+    return scores, medians[groups]
+
+
+def detect_field(spec):
+    """(object ids, scores, observed, expected) of rows with outlying field values"""
+    model = apps.get_model('adminpanel', spec["source"])
+    queryset = model.objects.filter(**{f"{spec['field']}__isnull": False}).order_by()
+    columns = {"id": F('pk'), "value": F(spec["field"])}
+    if spec["group_by"]:
+        group_field = model._meta.get_field(spec["group_by"])
+        if group_field.is_relation or group_field.get_internal_type() in NUMERIC_TYPES:
+            queryset = queryset.filter(**{f"{group_field.attname}__isnull": False})
+            columns["group"] = F(group_field.attname)
+        else:
+            values = list(queryset.values_list(spec["group_by"], flat=True).distinct()[:ANOMALY_MAX_GROUPS + 1])
+            if len(values) > ANOMALY_MAX_GROUPS:
+                raise ValueError(f"{spec['source']}.{spec['group_by']} has more than {ANOMALY_MAX_GROUPS} values")
+            columns["group"] = Case(*[When(**{spec["group_by"]: value}, then=Value(code))
+                                      for code, value in enumerate(values)], default=Value(-1))
+    data = fetch_columns(queryset, columns)
+    groups = None
+    if "group" in data:
+        # Codes of numeric groups are arbitrary, so compact them first
+        _, groups = np.unique(data["group"], return_inverse=True)
+    scores, expected = robust_z(data["value"], groups)
+    flagged = np.abs(scores) >= spec["threshold"]
+    return data["id"][flagged], scores[flagged], data["value"][flagged], expected[flagged]
+
+
+def owner_buckets(spec, role, since):
+    """Owner and step bucket of each row naming the owner as role"""
+    model = apps.get_model('adminpanel', spec["source"])
+    column = model._meta.get_field(spec[role]).attname
+    queryset = model.objects.filter(**{f"{spec[role]}__isnull": False, f"{spec['time']}__gte": since}).order_by()
+    # Grouping would not shrink the data much (few rows per owner and bucket), so NumPy counts them
+    data = fetch_columns(queryset, {"owner": F(column), "bucket": Extract(spec["time"], 'epoch') / spec["step"]})
+    return data["owner"].astype(np.int64), data["bucket"].astype(np.int64)
+
+
+def detect_rate(spec, since):
+    """(owner ids, scores, observed, expected, window ends) of owners with outlying windows"""
+    owners, buckets = owner_buckets(spec, "by", since)
+    hits = np.ones(len(owners))
+    if spec["against"]:
+        other_owners, other_buckets = owner_buckets(spec, "against", since)
+        owners = np.concatenate([owners, other_owners])
+        buckets = np.concatenate([buckets, other_buckets])
+        hits = np.concatenate([hits, np.zeros(len(other_owners))])
+    if not len(owners):
+        return (np.empty(0),) * 5
+    # One sorted key per owner and bucket; the stride keeps windows from spanning owners
+    first = buckets.min()
+    span = int(spec["window"] // spec["step"])
+    stride = buckets.max() - first + 1 + span
+    keys, inverse = np.unique(owners * stride + (buckets - first), return_inverse=True)
+    trials = np.bincount(inverse).astype(np.float64)
+    hits = np.bincount(inverse, hits)
+
+    # Sliding window sums ending at each active bucket: differences of cumulative sums
+    start = np.searchsorted(keys, keys - span + 1)
+    cumulative_hits = np.concatenate([[0], np.cumsum(hits)])
+    cumulative_trials = np.concatenate([[0], np.cumsum(trials)])
+    window_hits = cumulative_hits[1:] - cumulative_hits[start]
+    window_trials = cumulative_trials[1:] - cumulative_trials[start]
+
+    if spec["against"]:
+        share = hits.sum() / trials.sum()
+        expected = window_trials * share
+        with np.errstate(divide='ignore', invalid='ignore'):
+            scores = (window_hits - expected) / np.sqrt(window_trials * share * (1 - share))
+        scores[(window_trials < spec["min_rows"]) | ~np.isfinite(scores)] = 0
+    else:
+        scores, expected = robust_z(window_hits)
+        scores[window_hits < spec["min_rows"]] = 0
+    flagged = np.flatnonzero(scores >= spec["threshold"])
+
+    # The highest scoring window of each owner
+    flagged = flagged[np.argsort(-scores[flagged], kind='stable')]
+    owner_of = keys[flagged] // stride
+    _, first_of_owner = np.unique(owner_of, return_index=True)
+    flagged = flagged[first_of_owner]
+    window_ends = (keys[flagged] % stride + first + 1) * spec["step"]
+    return keys[flagged] // stride, scores[flagged], window_hits[flagged], expected[flagged], window_ends
+
+
+def detect(name, days):
+    """Run one detector and replace its open flags; returns (flags, objects checked description)"""
+    spec = detector_specs()[name]
+    Anomaly = apps.get_model('adminpanel', 'Anomaly')
+    model = apps.get_model('adminpanel', spec["source"])
+    if spec["kind"] == "field":
+        ids, scores, observed, expected = detect_field(spec)
+        entity, window_ends = spec["source"], None
+    else:
+        since = timezone.now() - timedelta(days=days)
+        ids, scores, observed, expected, window_ends = detect_rate(spec, since)
+        entity = model._meta.get_field(spec["by"]).related_model.__name__
+
+    order = np.argsort(-np.abs(scores), kind='stable')
+    reviewed = set(Anomaly.objects.filter(detector=name).exclude(status='open').values_list('object_id', flat=True))
+    flags = []
+    for i in order:
+        if len(flags) >= ANOMALY_MAX_FLAGS:
+            break
+        if int(ids[i]) in reviewed:
+            continue
+        window_end = None if window_ends is None else datetime.fromtimestamp(int(window_ends[i]), dt_timezone.utc)
+        flags.append(Anomaly(
+            detector=name, entity=entity, object_id=int(ids[i]), score=float(scores[i]),
+            observed=float(observed[i]), expected=float(expected[i]), window_end=window_end,
+            window_start=window_end and window_end - timedelta(seconds=spec["window"]),
+        ))
+    with transaction.atomic():
+        Anomaly.objects.filter(detector=name, status='open').delete()
+        Anomaly.objects.bulk_create(flags, batch_size=1000)
+    return flags
+
+
+class AnomalyAdmin(admin.ModelAdmin):
+    """Review queue of detect_anomalies"""
+
+    list_display = ['detector', 'object_link', 'score', 'observed', 'expected', 'window_start', 'window_end',
+                    'status', 'detected_at']
+    list_filter = ['status', 'detector', 'entity']
+    list_editable = ['status']
+    ordering = ['status', '-score']
+    readonly_fields = ['detector', 'entity', 'object_id', 'score', 'observed', 'expected',
+                       'window_start', 'window_end', 'detected_at']
+    actions = ['confirm', 'dismiss']
+
+    def object_link(self, obj):
+        try:
+            url = reverse(f'admin:adminpanel_{obj.entity.lower()}_change', args=[obj.object_id])
+        except NoReverseMatch:
+            return f"{obj.entity} {obj.object_id}"
+        return format_html('<a href="{}">{} {}</a>', url, obj.entity, obj.object_id)
+    object_link.short_description = 'Object'
+
+    def confirm(self, request, queryset):
+        queryset.update(status='confirmed')
+    confirm.short_description = 'Mark selected anomalies as confirmed'
+
+    def dismiss(self, request, queryset):
+        queryset.update(status='dismissed')
+    dismiss.short_description = 'Mark selected anomalies as dismissed'
+
+    def has_add_permission(self, request):
+        return False
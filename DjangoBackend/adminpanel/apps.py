@@ -1,5 +1,22 @@
 from django.apps import AppConfig
+from django.conf import settings
+from django.contrib.auth.signals import user_logged_out
+from django.db.models.signals import post_delete, post_save
 
 class AdminpanelConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
-    name = 'adminpanel'
\ No newline at end of file
+    name = 'adminpanel'
+
+    def ready(self):
+        from .stats import advance_generation
+        post_save.connect(advance_generation, dispatch_uid='stats_generation_save')
+        post_delete.connect(advance_generation, dispatch_uid='stats_generation_delete')
+
+        from .multiget import drop_cached
+        post_save.connect(drop_cached, dispatch_uid='object_cache_save')
+        post_delete.connect(drop_cached, dispatch_uid='object_cache_delete')
+
+        from .spool import forget_logged_out, forget_user
+        user_logged_out.connect(forget_logged_out, dispatch_uid='spool_logged_out')
+        post_save.connect(forget_user, sender=settings.AUTH_USER_MODEL, dispatch_uid='spool_user_save')
+        post_delete.connect(forget_user, sender=settings.AUTH_USER_MODEL, dispatch_uid='spool_user_delete')
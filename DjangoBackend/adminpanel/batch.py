@@ -0,0 +1,194 @@
+"""
+/api/batch/: many API requests in one round trip
+
+  POST /api/batch/
+  {
+    "atomic": true,
+    "requests": [
+      {"id": "match", "method": "POST", "path": "/api/matchs/", "body": {"match_id": "m-77", ...}},
+      {"method": "POST", "path": "/api/guilds/{{guild}}/member_count/increment/", "body": {"by": 2}},
+      {"method": "GET", "path": "/api/matchs/{{match.id}}/"},
+      {"method": "POST", "path": "/api/matchs/m-77/finish/", "headers": {"Idempotency-Key": "finish-m-77"}, ...},
+      {"method": "GET", "path": "/api/leaderboards/wins/?owner={{match.winner}}"}
+    ],
+    "refs": {"guild": 7}
+  }
+
+Sub-requests run in order, in-process through the resolved API views: no
+middleware, and the batch's authenticated user is reused instead of
+authenticating each item. {{step.field...}} in a path or body reads the
+response body of an earlier step (its "id" or index), or a "refs" value; a
+string that is only a reference keeps the value's type.
+
+Steps do not inherit the batch's conditional and idempotency headers
+(STEP_HEADERS); a step sends its own in "headers".
+
+With "atomic" all steps share one transaction, and the first failing step
+(status >= 400) stops the batch and rolls everything back. Otherwise every
+step runs; steps referring to a failed one answer 424.
+"""
+
+import io
+import json
+import logging
+import os
+import re
+from contextlib import nullcontext
+from urllib.parse import urlsplit
+
+from django.db import connection, transaction
+from django.http import HttpRequest, QueryDict
+from django.urls import Resolver404, resolve
+from rest_framework import status
+from rest_framework.exceptions import ValidationError
+from rest_framework.response import Response
+from rest_framework.views import APIView
+
+logger = logging.getLogger('django.request')
+
+# Most sub-requests per batch
+BATCH_MAX_REQUESTS = int(os.getenv('BATCH_MAX_REQUESTS', 50))
+
+METHODS = ('GET', 'POST', 'PUT', 'PATCH', 'DELETE')
+
+REFERENCE = re.compile(r'\{\{\s*([\w-]+)((?:\.[\w-]+)*)\s*\}\}')
+
+# Headers that belong to one request: taken from the step, never from the batch
+STEP_HEADERS = ('Idempotency-Key', 'If-Match', 'If-None-Match', 'If-Modified-Since', 'If-Unmodified-Since')
+
+
+def meta_key(header):
+    return 'HTTP_' + header.upper().replace('-', '_')
+
+
+class StepFailed(Exception):
+    """A reference names a step that failed or a value that does not exist"""
+
+
+def lookup(results, refs, name, path):
+    if name in results:
+        status_code, value = results[name]
+        if status_code >= 400:
+            raise StepFailed(f"Step '{name}' failed with status {status_code}")
+    elif name in refs:
+        value = refs[name]
+    else:
+        raise StepFailed(f"No earlier step or ref named '{name}'")
+    for part in filter(None, path.split('.')):
+        try:
+            value = value[int(part)] if isinstance(value, list) else value[part]
+        except (KeyError, IndexError, ValueError, TypeError):
+            raise StepFailed(f"{{{{{name}{path}}}}} does not exist")
+    return value
+
+
+def substitute(value, results, refs):
+    """value with the references in its strings replaced"""
+    if isinstance(value, dict):
+        return {key: substitute(item, results, refs) for key, item in value.items()}
+    if isinstance(value, list):
+        return [substitute(item, results, refs) for item in value]
+    if not isinstance(value, str):
+        return value
+    whole = REFERENCE.fullmatch(value)
+    if whole:
+        return lookup(results, refs, whole.group(1), whole.group(2))
+    return REFERENCE.sub(lambda match: str(lookup(results, refs, match.group(1), match.group(2))), value)
+
+
+def sub_request(request, method, url, body, headers):
+    """A Django request for one step, authenticated as the batch request"""
+    parts = urlsplit(url)
+    content = json.dumps(body).encode() if body is not None else b''
+    sub = HttpRequest()
+    sub.method = method
+    sub.path = sub.path_info = parts.path
+    step_keys = {meta_key(header) for header in STEP_HEADERS}
+    sub.META = {
+        **{key: value for key, value in request._request.META.items() if key not in step_keys},
+        **{meta_key(header): value for header, value in headers.items()},
+        'REQUEST_METHOD': method,
+        'PATH_INFO': parts.path,
+        'QUERY_STRING': parts.query,
+        'CONTENT_TYPE': 'application/json',
+        'CONTENT_LENGTH': str(len(content)),
+    }
+    sub.GET = QueryDict(parts.query)
+    sub._stream = io.BytesIO(content)
+    sub._read_started = False
+    sub.user = request.user
+    # Picked up by rest_framework.request.Request in place of the authenticators
+    sub._force_auth_user = request.user
+    sub._force_auth_token = request.auth
+    return sub
+
+
+def run_step(request, step):
+    """(status, body) of one sub-request"""
+    method = str(step.get('method', 'GET')).upper()
+    url = step.get('path', '')
+    if method not in METHODS:
+        return status.HTTP_405_METHOD_NOT_ALLOWED, {'detail': f"Method {method} is not supported"}
+    if not isinstance(url, str) or not url.startswith('/api/') or urlsplit(url).path.rstrip('/') == '/api/batch':
+        return status.HTTP_400_BAD_REQUEST, {'detail': "Path must be an API route other than /api/batch/"}
+    try:
+        match = resolve(urlsplit(url).path)
+    except Resolver404:
+        return status.HTTP_404_NOT_FOUND, {'detail': "Not found."}
+    if not hasattr(match.func, 'cls'):
+        return status.HTTP_400_BAD_REQUEST, {'detail': "Only REST API views can be batched"}
+    headers = step.get('headers') or {}
+    if not isinstance(headers, dict) or not all(isinstance(value, str) for value in headers.values()):
+        return status.HTTP_400_BAD_REQUEST, {'detail': "headers must be an object of strings"}
+
+    sub = sub_request(request, method, url, step.get('body'), headers)
+    sub.resolver_match = match
+    try:
+        response = match.func(sub, *match.args, **match.kwargs)
+    except Exception:
+        logger.exception("Batch step %s %s failed", method, url)
+        return status.HTTP_500_INTERNAL_SERVER_ERROR, {'detail': "Server error"}
+    return response.status_code, getattr(response, 'data', None)
+
+
+class BatchView(APIView):
+    """Runs a list of API requests in order and returns all responses"""
+
+    def post(self, request):
+        if not isinstance(request.data, dict):
+            raise ValidationError({'detail': 'Expected an object with "requests"'})
+        steps = request.data.get('requests')
+        refs = request.data.get('refs') or {}
+        if not isinstance(steps, list) or not steps or not all(isinstance(step, dict) for step in steps):
+            raise ValidationError({'requests': 'Expected a list of {"method", "path", "body"} objects'})
+        if len(steps) > BATCH_MAX_REQUESTS:
+            raise ValidationError({'requests': f"At most {BATCH_MAX_REQUESTS} requests"})
+        if not isinstance(refs, dict):
+            raise ValidationError({'refs': 'Expected an object'})
+        atomic = bool(request.data.get('atomic'))
+
+        results = {}
+        responses = []
+        with transaction.atomic() if atomic else nullcontext():
+            if atomic:
+                # Foreign keys are deferred to COMMIT by default; checked per statement, the step
+                # that breaks one answers with its own error instead of the commit failing
+                with connection.cursor() as cursor:
+                    cursor.execute("SET CONSTRAINTS ALL IMMEDIATE")
+            for index, step in enumerate(steps):
+                try:
+                    url = substitute(step.get('path', ''), results, refs)
+                    step = {**step, 'path': url, 'body': substitute(step.get('body'), results, refs)}
+                    status_code, body = run_step(request, step)
+                except StepFailed as e:
+                    status_code, body = status.HTTP_424_FAILED_DEPENDENCY, {'detail': str(e)}
+                results[str(index)] = (status_code, body)
+                if step.get('id') is not None:
+                    results[str(step['id'])] = (status_code, body)
+                responses.append({'id': step.get('id', index), 'status': status_code, 'body': body})
+                if atomic and status_code >= 400:
+                    transaction.set_rollback(True)
+                    break
+
+        committed = not (atomic and responses[-1]['status'] >= 400)
+        return Response({'committed': committed, 'responses': responses})
@@ -0,0 +1,97 @@
+"""
+Bulk create for the generated ViewSets: POST a list to /api/<entity>s/
+
+Unique fields are checked for the whole payload with one
+SELECT ... WHERE field IN (...) per field instead of one query per item,
+and repeated values within the payload are reported as well. Errors stay
+per item, as with any many=True serializer:
+
+  [{}, {"username": ["player with this username already exists."]}, ...]
+
+Valid payloads are written with a single bulk INSERT.
+"""
+
+import os
+
+from rest_framework import serializers
+from rest_framework.validators import UniqueValidator
+
+from . import stats
+
+# Most items per bulk create
+BULK_MAX_ITEMS = int(os.getenv('BULK_MAX_ITEMS', 1000))
+
+
+class BulkListSerializer(serializers.ListSerializer):
+    """many=True serializer with batched uniqueness checks and a bulk INSERT"""
+
+    def __init__(self, *args, **kwargs):
+        kwargs.setdefault('max_length', BULK_MAX_ITEMS)
+        super().__init__(*args, **kwargs)
+        self.unique = {}
+        self.taken = {}
+        self.seen = {}
+
+    def batch_unique_validators(self):
+        """Move the child's UniqueValidators here: {field name: validator}"""
+        for name, field in self.child.fields.items():
+            unique = [validator for validator in field.validators if isinstance(validator, UniqueValidator)]
+            if unique and not field.read_only:
+                field.validators = [validator for validator in field.validators if validator not in unique]
+                self.unique[name] = unique[0]
+
+    def to_internal_value(self, data):
+        if self.instance is None and isinstance(data, list) and len(data) <= (self.max_length or len(data)):
+            self.batch_unique_validators()
+            self.seen = {name: set() for name in self.unique}
+            for name, validator in self.unique.items():
+                field = self.child.fields[name]
+                values = set()
+                for item in data:
+                    if isinstance(item, dict) and item.get(name) is not None:
+                        try:
+                            values.add(field.run_validation(item[name]))
+                        except serializers.ValidationError:
+                            pass
+                self.taken[name] = set(
+                    validator.queryset.filter(**{f"{field.source}__in": values}).values_list(field.source, flat=True)
+                ) if values else set()
+        return super().to_internal_value(data)
+
+    def run_child_validation(self, data):
+        if not self.unique:
+            return super().run_child_validation(data)
+        try:
+            validated = super().run_child_validation(data)
+            errors = {}
+        except serializers.ValidationError as exc:
+            if not isinstance(exc.detail, dict):
+                raise
+            validated, errors = None, dict(exc.detail)
+        for name, validator in self.unique.items():
+            if name in errors or not isinstance(data, dict) or data.get(name) is None:
+                continue
+            value = validated[self.child.fields[name].source] if validated is not None else None
+            if value is None:
+                try:
+                    value = self.child.fields[name].run_validation(data[name])
+                except serializers.ValidationError:
+                    continue
+            if value in self.taken[name]:
+                errors[name] = [serializers.ErrorDetail(str(validator.message), code='unique')]
+            elif value in self.seen[name]:
+                errors[name] = [serializers.ErrorDetail(f"Repeats an earlier item's {name}.", code='unique')]
+            self.seen[name].add(value)
+        if errors:
+            raise serializers.ValidationError(errors)
+        return validated
+
+    def create(self, validated_data):
+        model = self.child.Meta.model
+        many_to_many = [field.name for field in model._meta.many_to_many]
+        if any(name in attrs for attrs in validated_data for name in many_to_many):
+            return super().create(validated_data)
+        instances = model.objects.bulk_create([model(**attrs) for attrs in validated_data])
+        # Receivers of a regular save, once per request instead of once per row
+        stats.advance_generation(model)
+        return instances
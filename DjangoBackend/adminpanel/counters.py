@@ -0,0 +1,178 @@
+"""
+Counter fields declared with "type": "counter" in entities.json
+Every write is an atomic increment, never a read-modify-write
+
+  "member_count": {"type": "counter", "mode": "sharded", "shards": 16}
+
+Modes:
+  direct    UPDATE ... SET f = f + n on the row itself (default)
+  sharded   adds go to one of N shard rows, fold_counters moves them into the row
+  buffered  adds collect in process memory and are flushed every few seconds;
+            up to one flush interval of increments is lost if the process dies
+"""
+
+import atexit
+import os
+import random
+import threading
+from collections import defaultdict
+
+from django.db import connection, connections, transaction
+
+from .fields import field_type
+
+# Seconds between flushes of buffered counters
+COUNTER_FLUSH_INTERVAL = float(os.getenv('COUNTER_FLUSH_INTERVAL', 2))
+
+# Flush early once this many rows have pending deltas
+COUNTER_BUFFER_MAX_ROWS = int(os.getenv('COUNTER_BUFFER_MAX_ROWS', 10000))
+
+# Seconds between fold_counters runs of run_maintenance
+COUNTER_FOLD_SECONDS = int(os.getenv('COUNTER_FOLD_SECONDS', 10))
+
+
+COUNTER_MODES = ('direct', 'sharded', 'buffered')
+
+
+def counter_fields(model_config):
+    """
+    Counter fields of a model: {name: {'mode': str, 'shards': int, 'big': bool}}.
+    Declared as "counter" or {"type": "counter", "mode": ..., "shards": ..., "big": ...}.
+    """
+    counters = {}
+    for name, field_def in model_config.get("fields", {}).items():
+        if field_type(field_def) != "counter":
+            continue
+        options = field_def if isinstance(field_def, dict) else {}
+        mode = options.get("mode", "direct")
+        if mode not in COUNTER_MODES:
+            raise ValueError(f"Counter '{name}' mode must be one of {', '.join(COUNTER_MODES)}")
+        counters[name] = {"mode": mode, "shards": int(options.get("shards", 16)), "big": bool(options.get("big"))}
+    return counters
+
+
+def counter_shard_model(model_name, field_name):
+    """Name of the generated model that holds the shard rows of a sharded counter"""
+    return f"{model_name}{''.join(part.title() for part in field_name.split('_'))}Shard"
+
+
+def add(model, pk, field, amount):
+    """Add amount to a counter on its row; returns the new value, None if the row is missing"""
+    quote = connection.ops.quote_name
+    meta = model._meta
+    column = quote(meta.get_field(field).column)
+    with connection.cursor() as cursor:
+        cursor.execute(
+            f"UPDATE {quote(meta.db_table)} SET {column} = {column} + %s "
+            f"WHERE {quote(meta.pk.column)} = %s RETURNING {column}",
+            [amount, pk],
+        )
+        row = cursor.fetchone()
+    return row[0] if row else None
+
+
+def add_sharded(shard_model, pk, amount, shards):
+    """Add amount to a random shard row of the counter, so writers rarely wait on each other"""
+    quote = connection.ops.quote_name
+    table = quote(shard_model._meta.db_table)
+    owner = quote(shard_model._meta.get_field('owner').column)
+    with connection.cursor() as cursor:
+        cursor.execute(
+            f"INSERT INTO {table} ({owner}, shard, delta) VALUES (%s, %s, %s) "
+            f"ON CONFLICT ({owner}, shard) DO UPDATE SET delta = {table}.delta + EXCLUDED.delta",
+            [pk, random.randrange(shards), amount],
+        )
+
+
+def pending_shards(shard_model, pk):
+    """Sum of the shard rows not yet folded into the counter"""
+    return sum(shard_model.objects.filter(owner_id=pk).values_list('delta', flat=True))
+
+
+def fold(model, field, shard_model):
+    """Move all shard deltas into the counter column; returns the number of rows changed"""
+    quote = connection.ops.quote_name
+    meta = model._meta
+    table = quote(meta.db_table)
+    column = quote(meta.get_field(field).column)
+    owner = quote(shard_model._meta.get_field('owner').column)
+    with transaction.atomic(), connection.cursor() as cursor:
+        cursor.execute(
+            f"WITH moved AS (DELETE FROM {quote(shard_model._meta.db_table)} RETURNING {owner} AS owner, delta) "
+            f"UPDATE {table} SET {column} = {column} + totals.delta "
+            f"FROM (SELECT owner, sum(delta) AS delta FROM moved GROUP BY owner) totals "
+            f"WHERE {table}.{quote(meta.pk.column)} = totals.owner"
+        )
+        return cursor.rowcount
+
+
+class DeltaBuffer:
+    """Per-process counter deltas, written as one UPDATE per counter column"""
+
+    def __init__(self, interval=COUNTER_FLUSH_INTERVAL, max_rows=COUNTER_BUFFER_MAX_ROWS):
+        self.interval = interval
+        self.max_rows = max_rows
+        self.lock = threading.Lock()
+        self.deltas = defaultdict(int)
+        self.flusher = None
+        self.wakeup = threading.Event()
+
+    def add(self, model, pk, field, amount):
+        with self.lock:
+            self.deltas[(model, field, pk)] += amount
+            full = len(self.deltas) >= self.max_rows
+            if self.flusher is None:
+                self.flusher = threading.Thread(target=self.run, name='counter-flusher', daemon=True)
+                self.flusher.start()
+                atexit.register(self.flush)
+        if full:
+            self.wakeup.set()
+
+    def run(self):
+        while True:
+            self.wakeup.wait(self.interval)
+            self.wakeup.clear()
+            try:
+                self.flush()
+            except Exception as e:
+                print(f"Counter flush failed, retrying: {e}")
+            finally:
+                # Each thread has its own connection; do not keep it open between flushes
+                connections.close_all()
+
+    def flush(self):
+        """Write all pending deltas; they are put back if the write fails"""
+        with self.lock:
+            deltas, self.deltas = self.deltas, defaultdict(int)
+        groups = defaultdict(list)
+        for (model, field, pk), amount in deltas.items():
+            if amount:
+                groups[(model, field)].append((pk, amount))
+        try:
+            for (model, field), rows in list(groups.items()):
+                self.write(model, field, rows)
+                del groups[(model, field)]
+        except Exception:
+            with self.lock:
+                for (model, field), rows in groups.items():
+                    for pk, amount in rows:
+                        self.deltas[(model, field, pk)] += amount
+            raise
+
+    def write(self, model, field, rows):
+        quote = connection.ops.quote_name
+        meta = model._meta
+        table = quote(meta.db_table)
+        column = quote(meta.get_field(field).column)
+        # Rows in pk order, so concurrent flushes lock them in the same order
+        rows = sorted(rows)
+        values = ", ".join(["(%s, %s)"] * len(rows))
+        with connection.cursor() as cursor:
+            cursor.execute(
+                f"UPDATE {table} SET {column} = {table}.{column} + v.delta "
+                f"FROM (VALUES {values}) AS v(pk, delta) WHERE {table}.{quote(meta.pk.column)} = v.pk",
+                [value for row in rows for value in row],
+            )
+
+
+buffer = DeltaBuffer()
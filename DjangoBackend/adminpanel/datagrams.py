@@ -0,0 +1,461 @@
+"""
+UDP telemetry for append-only entities declared with "udp" in entities.json
+
+  "TelemetryEvent": {
+    "udp": {
+      "context": ["server", "match_id"],
+      "type_field": "kind",
+      "types": {
+        "position": {"id": 1, "fields": {"time": "d", "player": "q", "x": "f", "y": "f", "z": "f"}},
+        "kill": {"id": 2, "fields": {"time": "d", "player": "q", "value": "f"}}
+      }
+    }
+  }
+
+A datagram carries events of one type, little-endian:
+
+  "UT", version 1 (B), type id (B), sequence (I), event count (H)
+  per context column: length (B) and UTF-8 text
+  the events, each packed with the struct codes of its type ("<dqfff" for position)
+
+Times are epoch seconds. Each server numbers its datagrams from 0 and starts
+over at 0 when it restarts.
+
+listen_telemetry receives datagrams with asyncio and unpacks the events with
+struct into preallocated NumPy arrays. Every flush_ms, or as soon as
+flush_events are waiting, a writer thread copies them to the table with one
+binary COPY per type while a second set of arrays keeps filling. Events that
+do not fit are dropped; per server (the first context column) the listener
+counts packets, events, sequence gaps (datagrams missing between two that
+arrived, including those that arrive later, out of order), datagrams out of
+order, restarts, malformed datagrams, and events dropped for want of room or
+rejected as invalid.
+"""
+
+import asyncio
+import io
+import json
+import os
+import socket
+import struct
+import time
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+from django.conf import settings
+from django.db import DataError, IntegrityError, connection, transaction
+
+# Port of an entity that does not set one
+TELEMETRY_UDP_PORT = int(os.getenv('TELEMETRY_UDP_PORT', 27500))
+
+MAGIC = b'UT'
+VERSION = 1
+HEADER = struct.Struct('<2sBBIH')
+
+# Socket receive buffer; bursts beyond it are dropped by the kernel and show up as sequence gaps
+TELEMETRY_RCVBUF = int(os.getenv('TELEMETRY_RCVBUF', 4 * 1024 * 1024))
+
+# Largest UDP payload
+MAX_DATAGRAM = 65507
+
+# Struct codes each field type takes, and the type of its binary COPY value
+FIELD_CODES = {
+    'SmallIntegerField': ('bBh', '>i2'),
+    'IntegerField': ('bBhHi', '>i4'),
+    'PositiveIntegerField': ('BH', '>i4'),
+    'BigIntegerField': ('bBhHiIq', '>i8'),
+    'FloatField': ('bBhHiIqfd', '>f8'),
+    'BooleanField': ('?', '?'),
+    'DateTimeField': ('iIqd', '>i8'),
+}
+TEXT_FIELDS = ('CharField', 'TextField', 'SlugField')
+
+# Binary COPY timestamps count microseconds from 2000-01-01
+PG_EPOCH = 946684800
+# Epoch seconds accepted as times: years 1 to 9999
+TIME_RANGE = (-62135596800, 253402300800)
+
+COPY_HEADER = b'PGCOPY\n\xff\r\n\x00' + struct.pack('>ii', 0, 0)
+COPY_TRAILER = struct.pack('>h', -1)
+
+SERVER_COUNTERS = ['packets', 'events', 'sequence_gaps', 'out_of_order', 'restarts', 'malformed', 'dropped',
+                   'invalid']
+
+
+def udp_specs():
+    """{model_name: normalized "udp" spec} of all entities"""
+    config = json.loads(settings.DYNAMIC_MODELS_CONFIG['CONFIG_PATH'].read_text())
+    specs = {}
+    for model_name, model_config in config.items():
+        udp = model_config.get('udp')
+        if not udp:
+            continue
+        spec = {
+            'port': int(udp.get('port', TELEMETRY_UDP_PORT)),
+            'context': list(udp.get('context', [])),
+            'type_field': udp.get('type_field'),
+            'flush_ms': int(udp.get('flush_ms', 200)),
+            'flush_events': int(udp.get('flush_events', 20000)),
+            'capacity': int(udp.get('capacity', 100000)),
+            'types': {},
+        }
+        if not 0 < spec['flush_events'] <= spec['capacity'] or spec['flush_ms'] <= 0:
+            raise ValueError(f"{model_name}: udp needs flush_ms > 0 and 0 < flush_events <= capacity")
+        ids = set()
+        for name, declared in udp.get('types', {}).items():
+            type_id = declared.get('id')
+            if not isinstance(type_id, int) or not 0 < type_id < 256 or type_id in ids:
+                raise ValueError(f"{model_name}: udp type '{name}' needs a unique id from 1 to 255")
+            ids.add(type_id)
+            spec['types'][name] = {'id': type_id, 'fields': dict(declared.get('fields', {}))}
+        if not spec['types']:
+            raise ValueError(f"{model_name}: udp declares no types")
+        if spec['port'] in [other['port'] for other in specs.values()]:
+            raise ValueError(f"{model_name}: udp port {spec['port']} is taken by another entity")
+        specs[model_name] = spec
+    return specs
+
+
+class EventType:
+    """Record layout of one event type: its struct, its array dtype and its COPY columns"""
+
+    def __init__(self, model, spec, name, declared):
+        self.name = name
+        self.id = declared['id']
+        self.fields = []
+        for field_name, code in declared['fields'].items():
+            field = model._meta.get_field(field_name)
+            codes, copy_type = FIELD_CODES.get(field.get_internal_type(), ('', None))
+            if len(code) != 1 or code not in codes:
+                raise ValueError(f"{model.__name__}: udp type '{name}' cannot pack '{field_name}' "
+                                 f"({field.get_internal_type()}) as '{code}'")
+            self.fields.append((field, code, copy_type))
+        self.record = struct.Struct('<' + ''.join(code for _, code, _ in self.fields))
+        self.dtype = np.dtype([(field.attname, '<' + code) for field, code, _ in self.fields])
+        self.name_bytes = name.encode()
+
+        taken = set(spec['context']) | {spec['type_field']}
+        if taken & {field.name for field, _, _ in self.fields}:
+            raise ValueError(f"{model.__name__}: udp type '{name}' packs a context or type field")
+        given = set(spec['context']) | {spec['type_field']} | {field.name for field, _, _ in self.fields}
+        for field in model._meta.concrete_fields:
+            if field.name not in given and not field.primary_key and not field.null:
+                raise ValueError(f"{model.__name__}: udp type '{name}' leaves '{field.name}', which is not "
+                                 f"nullable, empty")
+
+    def copy_rows(self, records, constants):
+        """Binary COPY tuples of records sharing the constant (text) column values"""
+        layout = [('columns', '>i2')]
+        for index, value in enumerate(constants):
+            layout.append((f'l{index}', '>i4'))
+            if value:
+                layout.append((f'c{index}', f'S{len(value)}'))
+        for field, _, copy_type in self.fields:
+            layout += [(f'l_{field.attname}', '>i4'), (f'v_{field.attname}', copy_type)]
+        rows = np.empty(len(records), np.dtype(layout))
+        rows['columns'] = len(constants) + len(self.fields)
+        for index, value in enumerate(constants):
+            rows[f'l{index}'] = len(value)
+            if value:
+                rows[f'c{index}'] = value
+        for field, _, copy_type in self.fields:
+            values = records[field.attname]
+            rows[f'l_{field.attname}'] = np.dtype(copy_type).itemsize
+            if field.get_internal_type() == 'DateTimeField':
+                values = np.rint((values.astype(np.float64) - PG_EPOCH) * 1e6)
+            rows[f'v_{field.attname}'] = values
+        return rows.tobytes()
+
+
+class Bank:
+    """Preallocated arrays for the events of each type, filled until they are written"""
+
+    def __init__(self, types, capacity):
+        self.records = {event_type.id: np.zeros(capacity, event_type.dtype) for event_type in types}
+        self.groups = {event_type.id: np.zeros(capacity, np.uint32) for event_type in types}
+        self.counts = dict.fromkeys(self.records, 0)
+        self.total = 0
+        # Context values of the events' datagrams: group number -> tuple of encoded texts
+        self.contexts = []
+        self.context_groups = {}
+
+    def group(self, context):
+        if context not in self.context_groups:
+            self.context_groups[context] = len(self.contexts)
+            self.contexts.append(context)
+        return self.context_groups[context]
+
+    def clear(self):
+        self.counts = dict.fromkeys(self.records, 0)
+        self.total = 0
+        self.contexts = []
+        self.context_groups = {}
+
+
+class Listener(asyncio.DatagramProtocol):
+    """Decodes the datagrams of one entity into a Bank and writes full or due banks with COPY"""
+
+    def __init__(self, model, spec):
+        self.model = model
+        self.spec = spec
+        self.types = {}
+        for name, declared in spec['types'].items():
+            event_type = EventType(model, spec, name, declared)
+            self.types[event_type.id] = event_type
+        self.context_fields = [model._meta.get_field(name) for name in spec['context']]
+        for field in self.context_fields + ([model._meta.get_field(spec['type_field'])] if spec['type_field'] else []):
+            if field.get_internal_type() not in TEXT_FIELDS:
+                raise ValueError(f"{model.__name__}: udp context and type_field must be text fields, "
+                                 f"not '{field.name}'")
+        self.capacity = spec['capacity']
+        self.interval = spec['flush_ms'] / 1000
+        self.filling = Bank(self.types.values(), self.capacity)
+        self.writing = Bank(self.types.values(), self.capacity)
+        # Validated context texts: raw bytes -> encoded tuple, None when invalid
+        self.known_contexts = {}
+        self.sequences = {}
+        self.servers = defaultdict(lambda: dict.fromkeys(SERVER_COUNTERS, 0))
+        self.counters = {'malformed': 0, 'flushed': 0, 'flushes': 0, 'flush_failures': 0}
+        self.wakeup = asyncio.Event()
+        self.pending = None
+        # One thread, so the writes share one database connection
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='telemetry-writer')
+
+    def datagram_received(self, data, addr):
+        try:
+            magic, version, type_id, sequence, count = HEADER.unpack_from(data)
+        except struct.error:
+            self.counters['malformed'] += 1
+            return
+        event_type = self.types.get(type_id)
+        if magic != MAGIC or version != VERSION or event_type is None:
+            self.counters['malformed'] += 1
+            return
+        offset = HEADER.size
+        raw = []
+        for _ in self.context_fields:
+            if offset >= len(data) or offset + 1 + data[offset] > len(data):
+                self.counters['malformed'] += 1
+                return
+            raw.append(data[offset + 1:offset + 1 + data[offset]])
+            offset += 1 + data[offset]
+        context = self.context(tuple(raw))
+        if context is None:
+            self.counters['malformed'] += 1
+            return
+        counters = self.servers[context[0].decode() if context else addr[0]]
+        if len(data) - offset != count * event_type.record.size:
+            counters['malformed'] += 1
+            return
+        counters['packets'] += 1
+        self.track_sequence(counters, context[0] if context else addr[0], sequence)
+
+        bank = self.filling
+        start = bank.counts[type_id]
+        if start + count > self.capacity:
+            counters['dropped'] += count
+            return
+        bank.records[type_id][start:start + count] = list(event_type.record.iter_unpack(data[offset:]))
+        bank.groups[type_id][start:start + count] = bank.group(context)
+        bank.counts[type_id] += count
+        bank.total += count
+        counters['events'] += count
+        if bank.total >= self.spec['flush_events']:
+            self.wakeup.set()
+
+    def context(self, raw):
+        """Encoded context texts of a datagram, None when one is not valid for its column"""
+        if raw not in self.known_contexts:
+            if len(self.known_contexts) >= 10000:
+                self.known_contexts.clear()
+            valid = raw
+            for field, value in zip(self.context_fields, raw):
+                try:
+                    text = value.decode()
+                except UnicodeDecodeError:
+                    valid = None
+                    break
+                if '\x00' in text or (field.max_length is not None and len(text) > field.max_length):
+                    valid = None
+                    break
+            self.known_contexts[raw] = valid
+        return self.known_contexts[raw]
+
+    def track_sequence(self, counters, server, sequence):
+        expected = self.sequences.get(server)
+        if sequence == 0 and expected is not None:
+            counters['restarts'] += 1
+        elif expected is not None:
+            ahead = (sequence - expected) % 2 ** 32
+            if ahead >= 2 ** 31:
+                # Older than one already received, so it was counted in a gap as well
+                counters['out_of_order'] += 1
+                return
+            counters['sequence_gaps'] += ahead
+        self.sequences[server] = (sequence + 1) % 2 ** 32
+
+    async def flush_forever(self):
+        failures = 0
+        while True:
+            try:
+                # Back off up to 30 seconds while the database is unreachable
+                await asyncio.wait_for(self.wakeup.wait(), min(self.interval * 2 ** failures, 30))
+            except asyncio.TimeoutError:
+                pass
+            self.wakeup.clear()
+            if not self.writing.total:
+                # Events arriving from now on go to the other bank
+                self.filling, self.writing = self.writing, self.filling
+            if not self.writing.total:
+                continue
+            self.pending = self.executor.submit(self.write, self.writing)
+            try:
+                invalid = await asyncio.wrap_future(self.pending)
+                failures = 0
+            except Exception as e:
+                failures = min(failures + 1, 16)
+                self.counters['flush_failures'] += 1
+                print(f"Telemetry flush of {self.model.__name__} failed, retrying: {e}")
+                continue
+            finally:
+                self.pending = None
+            self.count_written(self.writing, invalid)
+            self.writing.clear()
+            if self.filling.total >= self.spec['flush_events']:
+                self.wakeup.set()
+
+    def write(self, bank):
+        """
+        COPY the events of a bank in one transaction; returns {server: events
+        dropped}, counting invalid times, or every event of a batch the
+        database rejects
+        """
+        connection.close_if_unusable_or_obsolete()
+        quote = connection.ops.quote_name
+        table = quote(self.model._meta.db_table)
+        invalid = defaultdict(int)
+        try:
+            with transaction.atomic(), connection.cursor() as cursor, connection.wrap_database_errors:
+                for type_id, event_type in self.types.items():
+                    count = bank.counts[type_id]
+                    if not count:
+                        continue
+                    records = bank.records[type_id][:count]
+                    groups = bank.groups[type_id][:count]
+                    valid = np.ones(count, bool)
+                    for field, _, _ in event_type.fields:
+                        if field.get_internal_type() == 'DateTimeField':
+                            times = records[field.attname].astype(np.float64)
+                            valid &= np.isfinite(times) & (times >= TIME_RANGE[0]) & (times < TIME_RANGE[1])
+                        elif field.get_internal_type() == 'FloatField' and not field.null:
+                            valid &= np.isfinite(records[field.attname].astype(np.float64))
+                    for group, events in zip(*np.unique(groups[~valid], return_counts=True)):
+                        invalid[self.server_of(bank, group)] += int(events)
+
+                    columns = [field.column for field in self.context_fields]
+                    if self.spec['type_field']:
+                        columns.append(self.model._meta.get_field(self.spec['type_field']).column)
+                    columns += [field.column for field, _, _ in event_type.fields]
+                    parts = [COPY_HEADER]
+                    for group in np.unique(groups[valid]):
+                        constants = list(bank.contexts[group])
+                        if self.spec['type_field']:
+                            constants.append(event_type.name_bytes)
+                        parts.append(event_type.copy_rows(records[valid & (groups == group)], constants))
+                    parts.append(COPY_TRAILER)
+                    cursor.copy_expert(
+                        f"COPY {table} ({', '.join(quote(column) for column in columns)}) FROM STDIN WITH (FORMAT binary)",
+                        io.BytesIO(b''.join(parts)),
+                    )
+        except (DataError, IntegrityError) as e:
+            # Retrying cannot succeed: drop the batch instead of blocking the listener
+            print(f"Telemetry batch of {bank.total} {self.model._meta.verbose_name} events rejected by the "
+                  f"database, dropped: {e}")
+            invalid = defaultdict(int)
+            for type_id in self.types:
+                groups = bank.groups[type_id][:bank.counts[type_id]]
+                for group, events in zip(*np.unique(groups, return_counts=True)):
+                    invalid[self.server_of(bank, group)] += int(events)
+        except Exception:
+            connection.close()
+            raise
+        return dict(invalid)
+
+    def server_of(self, bank, group):
+        context = bank.contexts[group]
+        return context[0].decode() if context else ''
+
+    def count_written(self, bank, invalid):
+        for server, events in invalid.items():
+            self.servers[server]['invalid'] += events
+        self.counters['flushed'] += bank.total - sum(invalid.values())
+        self.counters['flushes'] += 1
+
+    def flush_now(self):
+        """Write both banks, waiting for a write in progress first; for shutdown"""
+        if self.pending is not None:
+            try:
+                self.count_written(self.writing, self.pending.result())
+                self.writing.clear()
+            except Exception:
+                pass
+            self.pending = None
+        for bank in (self.writing, self.filling):
+            if bank.total:
+                self.count_written(bank, self.executor.submit(self.write, bank).result())
+                bank.clear()
+
+    def report(self):
+        """Counter lines: one per server, then the totals"""
+        lines = []
+        for server, counters in sorted(self.servers.items()):
+            lines.append(f"  {server or '(no server)'}: " + ", ".join(
+                f"{counters[name]} {name.replace('_', ' ')}" for name in SERVER_COUNTERS))
+        lines.append(f"  {self.model.__name__}: {self.counters['flushed']} events written in "
+                     f"{self.counters['flushes']} flushes, {self.counters['flush_failures']} failed flushes, "
+                     f"{self.counters['malformed']} unattributed malformed datagrams, "
+                     f"{self.filling.total + self.writing.total} waiting")
+        return lines
+
+
+def pack_datagram(spec, type_name, sequence, context, events):
+    """
+    One datagram in the listener's format, for senders written in Python and
+    for driving the listener locally:
+      pack_datagram(spec, 'kill', 7, ['eu-1', 'm-77'], [(time.time(), 5, 1.0)])
+    """
+    declared = spec['types'][type_name]
+    record = struct.Struct('<' + ''.join(declared['fields'].values()))
+    texts = b''.join(struct.pack('<B', len(value.encode())) + value.encode() for value in context)
+    data = (HEADER.pack(MAGIC, VERSION, declared['id'], sequence % 2 ** 32, len(events)) + texts
+            + b''.join(record.pack(*event) for event in events))
+    if len(data) > MAX_DATAGRAM:
+        raise ValueError(f"{len(data)} bytes do not fit into one datagram")
+    return data
+
+
+async def serve(listeners, host, report_seconds):
+    """Receive datagrams for {port: Listener} until cancelled; prints the counters every report_seconds"""
+    loop = asyncio.get_running_loop()
+    transports = []
+    tasks = []
+    try:
+        for port, listener in listeners.items():
+            sock = socket.socket(socket.AF_INET6 if ':' in host else socket.AF_INET, socket.SOCK_DGRAM)
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, TELEMETRY_RCVBUF)
+            sock.bind((host, port))
+            transport, _ = await loop.create_datagram_endpoint(lambda listener=listener: listener, sock=sock)
+            transports.append(transport)
+            tasks.append(asyncio.create_task(listener.flush_forever()))
+        started = time.monotonic()
+        while True:
+            await asyncio.sleep(report_seconds)
+            print(f"Telemetry after {time.monotonic() - started:.0f}s:")
+            for listener in listeners.values():
+                print("\n".join(listener.report()), flush=True)
+    finally:
+        for task in tasks:
+            task.cancel()
+        for transport in transports:
+            transport.close()
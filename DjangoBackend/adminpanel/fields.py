@@ -0,0 +1,114 @@
+"""
+Computed fields declared with "type": "computed" in entities.json
+Stored as PostgreSQL GENERATED ALWAYS AS (...) STORED columns, so they can be
+filtered, sorted and indexed like any other column
+
+  "duration": {"type": "computed", "expression": "end_time - start_time",
+               "output": "DurationField()", "index": true}
+
+The expression is SQL over column names (a foreign key "winner" is
+"winner_id") and may only use immutable functions.
+
+field_type reads the field class of any entities.json field definition,
+for the spec parsers of the generators and the feature modules.
+"""
+
+import re
+
+from django.db import models
+from django.db.models.expressions import Expression
+
+# Field types that get gt/gte/lt/lte filters
+RANGE_FIELDS = [
+    'AutoField', 'BigAutoField', 'IntegerField', 'BigIntegerField', 'SmallIntegerField', 'PositiveIntegerField',
+    'PositiveSmallIntegerField', 'FloatField', 'DecimalField', 'DateTimeField', 'DateField', 'TimeField',
+    'DurationField',
+]
+
+
+def field_type(field_def):
+    """Return the Django field class name of an entities.json field definition"""
+    if isinstance(field_def, dict):
+        field_def = field_def.get("type", "CharField")
+    match = re.match(r"\s*(?:models\.)?(\w+)", str(field_def))
+    return match.group(1) if match else ""
+
+
+def computed_fields(model_config):
+    """
+    Computed fields of a model: {name: {'expression': str, 'output': str, 'index': bool}}.
+    Declared as {"type": "computed", "expression": "end_time - start_time", "output": "DurationField()"}.
+    """
+    computed = {}
+    for name, field_def in model_config.get("fields", {}).items():
+        if field_type(field_def) != "computed":
+            continue
+        if not isinstance(field_def, dict) or not field_def.get("expression") or not field_def.get("output"):
+            raise ValueError(f"Computed field '{name}' needs an 'expression' and an 'output' field type")
+        computed[name] = {
+            "expression": field_def["expression"],
+            "output": re.sub(r"^\s*models\.", "", field_def["output"]),
+            "index": bool(field_def.get("index")),
+        }
+    return computed
+
+
+class DatabaseComputed(Expression):
+    """Writes DEFAULT, the only value PostgreSQL accepts for a generated column"""
+
+    def as_sql(self, compiler, connection):
+        return "DEFAULT", []
+
+
+class ComputedField(models.Field):
+    """Read-only column computed by the database from other columns of the row"""
+
+    db_returning = True
+
+    def __init__(self, *args, expression, output_field, **kwargs):
+        self.expression = expression
+        self.output_field = output_field
+        kwargs['editable'] = False
+        kwargs['null'] = True
+        kwargs['blank'] = True
+        super().__init__(*args, **kwargs)
+
+    def deconstruct(self):
+        name, path, args, kwargs = super().deconstruct()
+        for option in ('editable', 'null', 'blank'):
+            kwargs.pop(option, None)
+        kwargs['expression'] = self.expression
+        kwargs['output_field'] = self.output_field
+        return name, path, args, kwargs
+
+    def db_type(self, connection):
+        return f"{self.output_field.db_type(connection)} GENERATED ALWAYS AS ({self.expression}) STORED"
+
+    def get_internal_type(self):
+        return self.output_field.get_internal_type()
+
+    def contribute_to_class(self, cls, name, **kwargs):
+        super().contribute_to_class(cls, name, **kwargs)
+        # Lets the output field read the value, e.g. for value_to_string()
+        self.output_field.set_attributes_from_name(name)
+        self.output_field.model = cls
+
+    def value_to_string(self, obj):
+        return self.output_field.value_to_string(obj)
+
+    def pre_save(self, model_instance, add):
+        return DatabaseComputed(output_field=self.output_field)
+
+    def from_db_value(self, value, expression, connection):
+        if hasattr(self.output_field, 'from_db_value'):
+            return self.output_field.from_db_value(value, expression, connection)
+        return value
+
+    def to_python(self, value):
+        return self.output_field.to_python(value)
+
+    def get_prep_value(self, value):
+        return self.output_field.get_prep_value(value)
+
+    def get_db_prep_value(self, value, connection, prepared=False):
+        return self.output_field.get_db_prep_value(value, connection, prepared)
@@ -0,0 +1,112 @@
+"""
+Query parameter filtering for the generated ViewSets
+
+  /api/items/?rarity=epic&value__gte=100&item_type__in=sword,bow
+
+Each ViewSet whitelists its filters in filter_lookups ({field: [lookups]}),
+generated from entities.json: only fields that lead an index, or are listed
+in "filtering": {"allow": [...]}, so no filter forces a full table scan.
+Parameters that name other model fields are rejected with 400.
+"""
+
+from datetime import datetime
+
+from django.core.exceptions import FieldDoesNotExist, ValidationError as DjangoValidationError
+from django.utils import timezone
+from rest_framework.exceptions import ValidationError
+from rest_framework.filters import BaseFilterBackend
+
+SCHEMA_TYPES = {
+    'AutoField': {'type': 'integer'},
+    'BigAutoField': {'type': 'integer'},
+    'IntegerField': {'type': 'integer'},
+    'BigIntegerField': {'type': 'integer'},
+    'SmallIntegerField': {'type': 'integer'},
+    'PositiveIntegerField': {'type': 'integer'},
+    'PositiveSmallIntegerField': {'type': 'integer'},
+    'FloatField': {'type': 'number'},
+    'DecimalField': {'type': 'number'},
+    'BooleanField': {'type': 'boolean'},
+    'DateTimeField': {'type': 'string', 'format': 'date-time'},
+    'DateField': {'type': 'string', 'format': 'date'},
+    'DurationField': {'type': 'string', 'example': '01:30:00'},
+}
+
+LOOKUP_DESCRIPTIONS = {
+    'exact': "equal to",
+    'in': "one of, comma separated",
+    'gt': "greater than",
+    'gte': "at least",
+    'lt': "less than",
+    'lte': "at most",
+    'isnull': "is empty (true) or set (false)",
+    'icontains': "contains, case-insensitive",
+}
+
+
+def parameter_name(field_name, lookup):
+    return field_name if lookup == 'exact' else f"{field_name}__{lookup}"
+
+
+def value_field(model, field_name):
+    """The field whose to_python() parses filter values (the target field for relations)"""
+    field = model._meta.get_field(field_name)
+    return field.target_field if field.is_relation else field
+
+
+def parse_value(field, lookup, raw):
+    if lookup == 'isnull':
+        if raw.lower() not in ('true', 'false', '1', '0'):
+            raise DjangoValidationError("Expected true or false")
+        return raw.lower() in ('true', '1')
+    if lookup == 'in':
+        return [parse_value(field, 'exact', item) for item in raw.split(',') if item]
+    value = field.to_python(raw)
+    if isinstance(value, datetime) and timezone.is_naive(value):
+        value = timezone.make_aware(value)
+    return value
+
+
+class IndexedFilterBackend(BaseFilterBackend):
+    """Applies the whitelisted ?field__lookup=value parameters of a view"""
+
+    def filter_queryset(self, request, queryset, view):
+        allowed = getattr(view, 'filter_lookups', {})
+        model = queryset.model
+        filters = {}
+        for param, raw in request.query_params.items():
+            field_name, _, lookup = param.partition('__')
+            lookup = lookup or 'exact'
+            if lookup not in allowed.get(field_name, []):
+                try:
+                    model._meta.get_field(field_name)
+                except FieldDoesNotExist:
+                    continue  # page, since, format, ...
+                raise ValidationError({param: f"Filtering on {param} is not supported; allowed: "
+                                              f"{', '.join(self.parameters(allowed)) or 'none'}"})
+            try:
+                filters[f"{field_name}__{lookup}"] = parse_value(value_field(model, field_name), lookup, raw)
+            except DjangoValidationError as e:
+                raise ValidationError({param: e.messages})
+        return queryset.filter(**filters) if filters else queryset
+
+    def parameters(self, allowed):
+        return [parameter_name(field_name, lookup) for field_name, lookups in allowed.items() for lookup in lookups]
+
+    def get_schema_operation_parameters(self, view):
+        allowed = getattr(view, 'filter_lookups', {})
+        model = view.queryset.model
+        parameters = []
+        for field_name, lookups in allowed.items():
+            field = value_field(model, field_name)
+            schema = SCHEMA_TYPES.get(field.get_internal_type(), {'type': 'string'})
+            for lookup in lookups:
+                parameters.append({
+                    'name': parameter_name(field_name, lookup),
+                    'required': False,
+                    'in': 'query',
+                    'description': f"{field_name} {LOOKUP_DESCRIPTIONS[lookup]}",
+                    'schema': {'type': 'boolean'} if lookup == 'isnull' else
+                              {'type': 'string'} if lookup == 'in' else schema,
+                })
+        return parameters
@@ -0,0 +1,307 @@
+"""
+Finish actions declared with "finish" in entities.json
+
+  POST /api/matchs/m-77/finish/
+  Idempotency-Key: 2f6c0b1e-...
+  {"winner": 5, "loser": 6}                # end_time defaults to now
+
+One transaction, and in the common case three statements:
+
+  UPDATE match SET end_time, winner, loser WHERE match_id AND end_time IS NULL RETURNING *
+  UPDATE player SET matches_played = matches_played + v.delta FROM (VALUES ...)
+  INSERT INTO idempotency key (the response)
+
+Leaderboard triggers run inside the first. With an Idempotency-Key a retry
+of a finished request returns the stored response instead of 409; a retry
+racing the original waits on the row lock and then does the same. A key
+reused with another request answers 422. Keys expire after
+IDEMPOTENCY_KEY_HOURS, purge_idempotency_keys deletes them.
+
+With "spool": true a request made while the database is unreachable is
+journaled and answered with 202, then replayed by adminpanel/spool.py.
+"""
+
+import hashlib
+import json
+import os
+import re
+from collections import defaultdict
+from datetime import timedelta
+
+from django.apps import apps
+from django.core.exceptions import ValidationError as DjangoValidationError
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db import DatabaseError, IntegrityError, connection, transaction
+from django.db.models.signals import post_save
+from django.utils import timezone
+from rest_framework import status
+from rest_framework.exceptions import NotFound, ValidationError
+from rest_framework.response import Response
+
+from . import spool
+from .counters import counter_fields
+from .fields import field_type
+from .multiget import natural_keys
+
+# Lifetime of stored responses
+IDEMPOTENCY_KEY_HOURS = float(os.getenv('IDEMPOTENCY_KEY_HOURS', 24))
+
+
+def finish_spec(model_name, model_config, config):
+    """
+    The finish action of a model, None if it declares none:
+      "finish": {"lookup": "match_id", "time": "end_time", "fields": ["winner", "loser"],
+                 "counters": {"winner": ["matches_played"], "loser": ["matches_played"]},
+                 "spool": true}
+    Counters name counter fields on the model a ForeignKey points to, each
+    added 1 per finished row: {fk: {'model': str, 'fields': {counter: mode}}}.
+    "spool" journals requests locally while the database is unreachable.
+    """
+    finish = model_config.get("finish")
+    if not finish:
+        return None
+    fields = model_config.get("fields", {})
+    lookup = finish.get("lookup", "id")
+    if lookup != "id" and lookup not in natural_keys(model_name, model_config).values():
+        raise ValueError(f"{model_name}: finish lookup '{lookup}' must be 'id' or a unique field")
+    time = finish.get("time")
+    if field_type(fields.get(time)) != "DateTimeField" or "null=True" not in str(fields[time]):
+        raise ValueError(f"{model_name}: finish needs 'time' naming a nullable DateTimeField")
+    for name in finish.get("fields", []):
+        if name not in fields or name in (lookup, time) or field_type(fields[name]) in ("counter", "computed"):
+            raise ValueError(f"{model_name}: finish cannot set field '{name}'")
+
+    counters = {}
+    for fk, names in finish.get("counters", {}).items():
+        target = re.search(r"ForeignKey\s*\(\s*['\"]([^'\"]+)['\"]", str(fields.get(fk)))
+        if not target or target.group(1) not in config:
+            raise ValueError(f"{model_name}: finish counters need '{fk}' to be a ForeignKey to an entity")
+        modes = counter_fields(config[target.group(1)])
+        for name in names:
+            if name not in modes:
+                raise ValueError(f"{model_name}: '{name}' is not a counter field of {target.group(1)}")
+        counters[fk] = {"model": target.group(1), "fields": {name: modes[name]["mode"] for name in names}}
+    return {"lookup": lookup, "time": time, "fields": list(finish.get("fields", [])), "counters": counters,
+            "spool": bool(finish.get("spool", False))}
+
+
+class NotFinished(Exception):
+    """The row was not updated: it does not exist, is already finished, or the key was used"""
+
+
+def finish_values(model, data, spec):
+    """{field: value} to set, from the request body; time defaults to now"""
+    values = {}
+    for name in [spec["time"]] + spec["fields"]:
+        if name not in data:
+            continue
+        field = model._meta.get_field(name)
+        try:
+            value = field.target_field.to_python(data[name]) if field.is_relation else field.to_python(data[name])
+            if data[name] is not None:
+                field.run_validators(value)
+        except DjangoValidationError as e:
+            raise ValidationError({name: e.messages})
+        if value is not None and name == spec["time"] and timezone.is_naive(value):
+            value = timezone.make_aware(value)
+        values[field] = value
+    if spec["time"] not in data or values[model._meta.get_field(spec["time"])] is None:
+        values[model._meta.get_field(spec["time"])] = timezone.now()
+    return values
+
+
+def update_row(model, spec, lookup_value, values):
+    """The finished row, None when no unfinished row has that key"""
+    quote = connection.ops.quote_name
+    meta = model._meta
+    lookup = meta.pk if spec["lookup"] == "id" else meta.get_field(spec["lookup"])
+    time_column = quote(meta.get_field(spec["time"]).column)
+    columns = [field.attname for field in meta.concrete_fields]
+    with connection.cursor() as cursor:
+        cursor.execute(
+            f"UPDATE {quote(meta.db_table)} SET {', '.join(f'{quote(field.column)} = %s' for field in values)} "
+            f"WHERE {quote(lookup.column)} = %s AND {time_column} IS NULL "
+            f"RETURNING {', '.join(quote(field.column) for field in meta.concrete_fields)}",
+            [field.get_db_prep_save(value, connection) for field, value in values.items()]
+            + [lookup.get_db_prep_value(lookup.to_python(lookup_value), connection)],
+        )
+        row = cursor.fetchone()
+    return model.from_db(connection.alias, columns, row) if row else None
+
+
+def add_counters(model, spec, row):
+    """
+    Add 1 to the counters of the related rows; one UPDATE per table for direct
+    counters, which returns those rows so the response needs no extra reads
+    """
+    deltas = defaultdict(lambda: defaultdict(lambda: defaultdict(int)))
+    for fk, counter in spec["counters"].items():
+        pk = getattr(row, model._meta.get_field(fk).attname)
+        if pk is None:
+            continue
+        target = apps.get_model('adminpanel', counter["model"])
+        for name, mode in counter["fields"].items():
+            if mode == "direct":
+                deltas[target][pk][name] += 1
+            elif mode == "sharded":
+                getattr(target, f"add_{name}")(pk, 1)
+            else:
+                # Buffered deltas are not transactional: only count finishes that commit
+                transaction.on_commit(lambda target=target, name=name, pk=pk: getattr(target, f"add_{name}")(pk, 1))
+
+    quote = connection.ops.quote_name
+    updated = {}
+    for target, rows in deltas.items():
+        meta = target._meta
+        table = quote(meta.db_table)
+        names = sorted({name for fields in rows.values() for name in fields})
+        # Rows in pk order, so concurrent finishes lock them in the same order
+        rows = sorted(rows.items())
+        values = ", ".join([f"({', '.join(['%s'] * (len(names) + 1))})"] * len(rows))
+        assignments = ", ".join(
+            f"{quote(meta.get_field(name).column)} = {table}.{quote(meta.get_field(name).column)} + v.d{i}"
+            for i, name in enumerate(names)
+        )
+        with connection.cursor() as cursor:
+            cursor.execute(
+                f"UPDATE {table} SET {assignments} "
+                f"FROM (VALUES {values}) AS v(pk, {', '.join(f'd{i}' for i in range(len(names)))}) "
+                f"WHERE {table}.{quote(meta.pk.column)} = v.pk "
+                f"RETURNING {', '.join(f'{table}.{quote(field.column)}' for field in meta.concrete_fields)}",
+                [value for pk, fields in rows for value in [pk] + [fields[name] for name in names]],
+            )
+            columns = [field.attname for field in meta.concrete_fields]
+            for record in cursor.fetchall():
+                instance = target.from_db(connection.alias, columns, record)
+                updated[(target, instance.pk)] = instance
+
+    for fk in spec["counters"]:
+        field = model._meta.get_field(fk)
+        instance = updated.get((field.related_model, getattr(row, field.attname)))
+        if instance is not None:
+            field.set_cached_value(row, instance)
+
+
+def store_response(endpoint, key, fingerprint, status_code, data):
+    """Record the response under the key; False if the key is taken and not yet expired"""
+    quote = connection.ops.quote_name
+    table = quote(apps.get_model('adminpanel', 'IdempotencyKey')._meta.db_table)
+    now = timezone.now()
+    with connection.cursor() as cursor:
+        cursor.execute(
+            f"INSERT INTO {table} (endpoint, key, fingerprint, status, response, created_at) "
+            f"VALUES (%s, %s, %s, %s, %s, %s) "
+            f"ON CONFLICT (endpoint, key) DO UPDATE SET fingerprint = EXCLUDED.fingerprint, "
+            f"status = EXCLUDED.status, response = EXCLUDED.response, created_at = EXCLUDED.created_at "
+            f"WHERE {table}.created_at < %s RETURNING id",
+            [endpoint, key, fingerprint, status_code, json.dumps(data, cls=DjangoJSONEncoder), now,
+             now - timedelta(hours=IDEMPOTENCY_KEY_HOURS)],
+        )
+        return cursor.fetchone() is not None
+
+
+def stored_response(endpoint, key, fingerprint):
+    """The response recorded under an unexpired key, None if there is none"""
+    stored = apps.get_model('adminpanel', 'IdempotencyKey').objects.filter(
+        endpoint=endpoint, key=key, created_at__gte=timezone.now() - timedelta(hours=IDEMPOTENCY_KEY_HOURS),
+    ).first()
+    if stored is None:
+        return None
+    if stored.fingerprint != fingerprint:
+        return Response({'detail': "Idempotency-Key was already used with a different request"},
+                        status=status.HTTP_422_UNPROCESSABLE_ENTITY)
+    return Response(stored.response, status=stored.status, headers={'Idempotent-Replayed': 'true'})
+
+
+def finish(view, model, spec, lookup_value, values, endpoint, key, fingerprint):
+    """Finish the row in one transaction; returns the response data, raises NotFinished"""
+    with transaction.atomic():
+        row = update_row(model, spec, lookup_value, values)
+        if row is None:
+            raise NotFinished()
+        add_counters(model, spec, row)
+        # Receivers of a regular save (stats generation, object cache) run once the row is
+        # committed, so an invalidation cannot be undone by a reader still seeing the old row
+        transaction.on_commit(lambda: post_save.send(sender=model, instance=row, created=False,
+                                                     update_fields=None, raw=False, using=connection.alias))
+        data = view.get_serializer(row).data
+        if key is not None and not store_response(endpoint, key, fingerprint, status.HTTP_200_OK, data):
+            raise NotFinished()
+    return data
+
+
+def not_finished(model, spec, lookup_value, endpoint, key, fingerprint):
+    """Response for a row that was not finished: the stored one, 404 or 409"""
+    replay = stored_response(endpoint, key, fingerprint) if key is not None else None
+    if replay is not None:
+        return replay
+    lookup = 'pk' if spec["lookup"] == "id" else spec["lookup"]
+    try:
+        exists = model.objects.filter(**{lookup: lookup_value}).exists()
+    except (DjangoValidationError, ValueError):
+        exists = False
+    if not exists:
+        raise NotFound()
+    return Response({'detail': f"{model._meta.verbose_name.title()} is already finished"},
+                    status=status.HTTP_409_CONFLICT)
+
+
+def request_fingerprint(lookup_value, data):
+    encoded = json.dumps([str(lookup_value), data], sort_keys=True, cls=DjangoJSONEncoder)
+    return hashlib.md5(encoded.encode()).hexdigest()
+
+
+def respond(view, request, lookup_value, spec):
+    """Response of a finish action"""
+    model = view.get_queryset().model
+    key = request.headers.get('Idempotency-Key')
+    if key is not None and not 0 < len(key) <= 255:
+        raise ValidationError({'Idempotency-Key': 'Expected 1 to 255 characters'})
+    if not isinstance(request.data, dict):
+        raise ValidationError({'detail': 'Expected an object'})
+    values = finish_values(model, request.data, spec)
+    endpoint = f"{model._meta.label_lower}.finish"
+    fingerprint = request_fingerprint(lookup_value, request.data)
+    if spec.get("spool"):
+        spool.resume()
+
+    try:
+        data = finish(view, model, spec, lookup_value, values, endpoint, key, fingerprint)
+    except NotFinished:
+        return not_finished(model, spec, lookup_value, endpoint, key, fingerprint)
+    except (DjangoValidationError, ValueError):
+        raise NotFound()
+    except IntegrityError as e:
+        raise ValidationError({'detail': str(e).strip()})
+    except spool.UNAVAILABLE:
+        if not spec.get("spool"):
+            raise
+        # Replayed later with the time this request was made
+        time_field = model._meta.get_field(spec["time"])
+        data = {**dict(request.data.items()), spec["time"]: values[time_field].isoformat()}
+        return spool.respond(view, lookup_value, data, spec, endpoint, key, fingerprint)
+    return Response(data)
+
+
+def replay(view, lookup_value, data, spec, endpoint, key, fingerprint):
+    """
+    Finish a spooled request: 'replayed', or 'already_applied' when its
+    stored response exists; raises spool.Refused for any other outcome
+    """
+    model = view.get_queryset().model
+    try:
+        finish(view, model, spec, lookup_value, finish_values(model, data, spec), endpoint, key, fingerprint)
+        return 'replayed'
+    except NotFinished:
+        pass
+    except (DjangoValidationError, ValueError, ValidationError, DatabaseError) as e:
+        if isinstance(e, spool.UNAVAILABLE):
+            raise
+        raise spool.Refused(str(e).strip())
+    try:
+        response = not_finished(model, spec, lookup_value, endpoint, key, fingerprint)
+    except NotFound:
+        raise spool.Refused(f"No {model._meta.verbose_name} {lookup_value}")
+    if response.status_code == status.HTTP_200_OK:
+        return 'already_applied'
+    raise spool.Refused(response.data['detail'])
@@ -0,0 +1,496 @@
+"""
+Buffered ingest for append-only entities declared with "ingest" in entities.json
+
+  "TelemetryEvent": {"ingest": {"flush_ms": 200, "flush_events": 5000, "capacity": 100000}}
+
+  POST /api/telemetryevents/ingest/          (Content-Encoding: gzip accepted)
+  {"defaults": {"server": "eu-1", "match_id": "m-77"},
+   "columns": ["kind", "time", "player", "x", "y"],
+   "events": [["kill", 1760000000.25, 5, 10.5, -3.0], ...]}
+
+Events are validated and encoded as COPY text lines in the request, then
+put in a fixed-size in-process ring buffer and answered with 202. A flusher
+thread writes the buffer with one COPY every flush_ms, or as soon as
+flush_events are waiting. When the buffer cannot take a whole request the
+request is refused with 503 and Retry-After, and nothing of it is kept.
+
+For a partitioned entity, events whose partition field lies outside every
+attached partition are left out of the buffer and reported in the 202, while
+the rest of the request is queued.
+
+Events stay in the buffer until their COPY succeeds, so an unreachable
+database only fills the buffer. When the database rejects a batch as
+invalid it is written in halves, so only the rows it rejects are dropped
+and counted. Buffered events are lost if the process is killed.
+GET on the same route returns this process's counters.
+"""
+
+import atexit
+import datetime
+import io
+import json
+import math
+import os
+import threading
+import time
+import zlib
+
+from django.db import DatabaseError, DataError, IntegrityError, connection
+from django.utils.dateparse import parse_datetime
+from rest_framework import status
+from rest_framework.exceptions import ValidationError
+from rest_framework.response import Response
+
+from .fields import field_type
+from .partitions import existing_partitions, is_partitioned
+
+# Largest decompressed request body; read from the request stream, so it is
+# not capped by DATA_UPLOAD_MAX_MEMORY_SIZE
+INGEST_MAX_BYTES = int(os.getenv('INGEST_MAX_BYTES', 16 * 1024 * 1024))
+
+# Bytes read from the request stream at a time
+INGEST_READ_CHUNK = 64 * 1024
+
+# Seconds the attached partitions of a partitioned ingest entity are cached
+INGEST_PARTITION_SECONDS = int(os.getenv('INGEST_PARTITION_SECONDS', 60))
+
+# Invalid events reported per refused request
+INGEST_MAX_ERRORS = 20
+
+INT_RANGES = {
+    'SmallIntegerField': (-2 ** 15, 2 ** 15 - 1),
+    'IntegerField': (-2 ** 31, 2 ** 31 - 1),
+    'PositiveIntegerField': (0, 2 ** 31 - 1),
+    'BigIntegerField': (-2 ** 63, 2 ** 63 - 1),
+}
+
+COPY_ESCAPES = str.maketrans({'\\': '\\\\', '\t': '\\t', '\n': '\\n', '\r': '\\r'})
+
+
+INGEST_FIELDS = [
+    'CharField', 'TextField', 'SlugField', 'IntegerField', 'BigIntegerField', 'SmallIntegerField',
+    'PositiveIntegerField', 'FloatField', 'BooleanField', 'DateTimeField', 'JSONField',
+]
+
+
+def ingest_spec(model_name, model_config):
+    """
+    The buffered ingest action of an append-only model, None if it declares none:
+      "ingest": {"flush_ms": 200, "flush_events": 5000, "capacity": 100000}
+    Only plain value fields can be ingested; rows are written with COPY, so
+    there are no foreign keys, counters or computed fields. Events of a
+    partitioned entity are checked against its attached partitions.
+    """
+    ingest = model_config.get("ingest")
+    if not ingest:
+        return None
+    columns = []
+    for name, field_def in model_config.get("fields", {}).items():
+        if field_type(field_def) not in INGEST_FIELDS:
+            raise ValueError(f"{model_name}: ingested field '{name}' must be one of {', '.join(INGEST_FIELDS)}")
+        columns.append(name)
+    spec = {
+        "columns": columns,
+        "flush_ms": int(ingest.get("flush_ms", 200)),
+        "flush_events": int(ingest.get("flush_events", 5000)),
+        "capacity": int(ingest.get("capacity", 100000)),
+        "partition_field": (model_config.get("partition_by") or {}).get("field"),
+    }
+    if not 0 < spec["flush_events"] <= spec["capacity"] or spec["flush_ms"] <= 0:
+        raise ValueError(f"{model_name}: ingest needs flush_ms > 0 and 0 < flush_events <= capacity")
+    return spec
+
+
+def text_encoder(field):
+    def encode(value):
+        if not isinstance(value, str):
+            raise ValueError('expected a string')
+        if field.max_length is not None and len(value) > field.max_length:
+            raise ValueError(f"longer than {field.max_length} characters")
+        if '\x00' in value:
+            raise ValueError('contains a NUL character')
+        return value.translate(COPY_ESCAPES)
+    return encode
+
+
+def integer_encoder(field):
+    low, high = INT_RANGES.get(field.get_internal_type(), INT_RANGES['BigIntegerField'])
+
+    def encode(value):
+        if isinstance(value, bool) or not isinstance(value, int) or not low <= value <= high:
+            raise ValueError('expected an integer in range')
+        return str(value)
+    return encode
+
+
+def float_encoder(field):
+    def encode(value):
+        if isinstance(value, bool) or not isinstance(value, (int, float)) or not math.isfinite(value):
+            raise ValueError('expected a finite number')
+        return repr(float(value))
+    return encode
+
+
+def boolean_encoder(field):
+    def encode(value):
+        if not isinstance(value, bool):
+            raise ValueError('expected true or false')
+        return 't' if value else 'f'
+    return encode
+
+
+def datetime_encoder(field):
+    def encode(value):
+        """Epoch seconds or an ISO 8601 string with a timezone"""
+        if isinstance(value, (int, float)) and not isinstance(value, bool):
+            try:
+                return datetime.datetime.fromtimestamp(value, datetime.timezone.utc).isoformat()
+            except (OverflowError, OSError, ValueError):
+                raise ValueError('epoch seconds out of range')
+        moment = parse_datetime(value) if isinstance(value, str) else None
+        if moment is None or moment.tzinfo is None:
+            raise ValueError('expected epoch seconds or an ISO 8601 datetime with timezone')
+        return moment.isoformat()
+    return encode
+
+
+def json_encoder(field):
+    def encode(value):
+        try:
+            text = json.dumps(value, separators=(',', ':'), allow_nan=False)
+        except (TypeError, ValueError):
+            raise ValueError('not valid JSON')
+        if '\\u0000' in text:
+            raise ValueError('contains a NUL character')
+        return text.translate(COPY_ESCAPES)
+    return encode
+
+
+ENCODERS = {
+    'CharField': text_encoder, 'TextField': text_encoder, 'SlugField': text_encoder,
+    'SmallIntegerField': integer_encoder, 'IntegerField': integer_encoder,
+    'PositiveIntegerField': integer_encoder, 'BigIntegerField': integer_encoder,
+    'FloatField': float_encoder, 'BooleanField': boolean_encoder,
+    'DateTimeField': datetime_encoder, 'JSONField': json_encoder,
+}
+
+
+class OutOfRange(ValueError):
+    """An event no attached partition can take"""
+
+
+def covers(spans, moment):
+    return any((lower is None or lower <= moment) and (upper is None or moment < upper) for lower, upper in spans)
+
+
+class Columns:
+    """How each ingested column is encoded, and what an event that omits it gets"""
+
+    def __init__(self, model, spec):
+        self.names = spec["columns"]
+        partition_field = spec.get("partition_field")
+        self.partition = self.names.index(partition_field) if partition_field in self.names else None
+        self.fields = [model._meta.get_field(name) for name in self.names]
+        self.encoders = [ENCODERS[field.get_internal_type()](field) for field in self.fields]
+        self.missing = []
+        for field, encode in zip(self.fields, self.encoders):
+            if field.has_default():
+                self.missing.append(encode(field.get_default()))
+            elif field.null:
+                self.missing.append('\\N')
+            else:
+                self.missing.append(None)
+
+    def encode(self, event, spans=None):
+        """
+        One COPY text line of an event given as {column: value}; raises
+        OutOfRange when spans are given and its partition value is outside them
+        """
+        values = []
+        for name, encode, missing in zip(self.names, self.encoders, self.missing):
+            value = event.get(name)
+            if value is None:
+                if missing is None:
+                    raise ValueError(f"{name}: required")
+                values.append(missing)
+                continue
+            try:
+                values.append(encode(value))
+            except ValueError as e:
+                raise ValueError(f"{name}: {e}")
+        if spans is not None and values[self.partition] != '\\N':
+            moment = datetime.datetime.fromisoformat(values[self.partition])
+            if not covers(spans, moment):
+                raise OutOfRange(f"{self.names[self.partition]}: {moment.isoformat()} is outside the partitions")
+        return '\t'.join(values) + '\n'
+
+
+class RingBuffer:
+    """Encoded events waiting for COPY, with room for a fixed number of them"""
+
+    def __init__(self, model, spec):
+        self.model = model
+        self.columns = Columns(model, spec)
+        self.capacity = spec["capacity"]
+        self.flush_events = spec["flush_events"]
+        self.interval = spec["flush_ms"] / 1000
+        self.slots = [None] * self.capacity
+        self.start = 0
+        self.depth = 0
+        self.lock = threading.Lock()
+        # Held for a whole COPY, so the exit flush never writes a batch the flusher is writing
+        self.flush_lock = threading.Lock()
+        self.wakeup = threading.Event()
+        self.flusher = None
+        self.counters = {
+            'accepted': 0, 'rejected': 0, 'invalid_requests': 0, 'flushed': 0, 'dropped': 0,
+            'out_of_range': 0, 'flushes': 0, 'flush_failures': 0,
+        }
+        self.last_flush = {'events': 0, 'seconds': 0.0}
+        self.started = time.time()
+        self.spans = None
+        self.spans_checked = None
+
+    def partition_spans(self):
+        """
+        [(lower, upper)] ranges of the partition field the attached partitions
+        take, None for an unpartitioned table or while they cannot be read
+        """
+        if self.columns.partition is None:
+            return None
+        now = time.monotonic()
+        if self.spans_checked is not None and now - self.spans_checked < INGEST_PARTITION_SECONDS:
+            return self.spans
+        table = self.model._meta.db_table
+        try:
+            with connection.cursor() as cursor:
+                partitions = existing_partitions(cursor, table) if is_partitioned(cursor, table) else None
+        except DatabaseError:
+            return self.spans
+        spans = None
+        if partitions is not None:
+            spans = []
+            for _, lower, upper in partitions:
+                if spans and lower is not None and spans[-1][1] == lower:
+                    spans[-1] = (spans[-1][0], upper)
+                else:
+                    spans.append((lower, upper))
+        self.spans, self.spans_checked = spans, now
+        return spans
+
+    def push(self, lines):
+        """Queue all lines, or none of them when they do not fit; returns whether they were queued"""
+        with self.lock:
+            if self.depth + len(lines) > self.capacity:
+                self.counters['rejected'] += len(lines)
+                return False
+            end = (self.start + self.depth) % self.capacity
+            first = min(len(lines), self.capacity - end)
+            self.slots[end:end + first] = lines[:first]
+            self.slots[:len(lines) - first] = lines[first:]
+            self.depth += len(lines)
+            self.counters['accepted'] += len(lines)
+            full = self.depth >= self.flush_events
+            if self.flusher is None:
+                self.flusher = threading.Thread(target=self.run, name='ingest-flusher', daemon=True)
+                self.flusher.start()
+                atexit.register(self.drain)
+        if full:
+            self.wakeup.set()
+        return True
+
+    def run(self):
+        failures = 0
+        while True:
+            # Back off up to 30 seconds while the database is unreachable
+            self.wakeup.wait(min(self.interval * 2 ** failures, 30))
+            self.wakeup.clear()
+            try:
+                self.drain()
+                failures = 0
+            except Exception as e:
+                failures = min(failures + 1, 16)
+                self.counters['flush_failures'] += 1
+                print(f"Ingest flush of {self.model.__name__} failed, retrying: {e}")
+                connection.close()
+
+    def drain(self):
+        """Flush until fewer than flush_events are waiting"""
+        while self.flush():
+            pass
+
+    def flush(self):
+        """COPY up to flush_events of the oldest events; returns whether a full batch was written"""
+        with self.flush_lock:
+            return self.write_oldest()
+
+    def write_oldest(self):
+        with self.lock:
+            count = min(self.depth, self.flush_events)
+            end = self.start + count
+            lines = self.slots[self.start:end] + self.slots[:max(0, end - self.capacity)]
+        if not lines:
+            return False
+        connection.close_if_unusable_or_obsolete()
+        began = time.monotonic()
+        dropped, error = self.copy_valid(lines)
+        self.counters['flushed'] += count - dropped
+        if dropped:
+            # Retrying cannot succeed: drop the rejected rows instead of blocking the buffer
+            self.counters['dropped'] += dropped
+            print(f"Ingest of {dropped} of {count} {self.model._meta.verbose_name} events rejected by the database, "
+                  f"dropped: {error}")
+        with self.lock:
+            for index in range(self.start, self.start + count):
+                self.slots[index % self.capacity] = None
+            self.start = (self.start + count) % self.capacity
+            self.depth -= count
+        self.counters['flushes'] += 1
+        self.last_flush = {'events': count, 'seconds': round(time.monotonic() - began, 4)}
+        return count == self.flush_events
+
+    def copy(self, lines):
+        quote = connection.ops.quote_name
+        with connection.cursor() as cursor, connection.wrap_database_errors:
+            cursor.copy_expert(
+                f"COPY {quote(self.model._meta.db_table)} "
+                f"({', '.join(quote(f.column) for f in self.columns.fields)}) FROM STDIN",
+                io.StringIO(''.join(lines)),
+            )
+
+    def copy_valid(self, lines):
+        """
+        COPY lines; when the database rejects them, COPY each half in turn so
+        only the rejected rows are lost. Returns (rows dropped, first error).
+        """
+        try:
+            self.copy(lines)
+            return 0, None
+        except (DataError, IntegrityError) as e:
+            if len(lines) == 1:
+                return 1, e
+            middle = len(lines) // 2
+            first, first_error = self.copy_valid(lines[:middle])
+            second, second_error = self.copy_valid(lines[middle:])
+            return first + second, first_error or second_error
+
+    def stats(self):
+        with self.lock:
+            depth = self.depth
+        uptime = time.time() - self.started
+        return {
+            **self.counters,
+            'depth': depth,
+            'capacity': self.capacity,
+            'flushed_per_second': round(self.counters['flushed'] / uptime, 1) if uptime else 0.0,
+            'last_flush': self.last_flush,
+        }
+
+
+buffers = {}
+buffers_lock = threading.Lock()
+
+
+def buffer_for(model, spec):
+    with buffers_lock:
+        if model not in buffers:
+            buffers[model] = RingBuffer(model, spec)
+        return buffers[model]
+
+
+def request_body(request):
+    """
+    JSON body of an ingest request, gunzipped when sent with Content-Encoding: gzip;
+    None when it is larger than INGEST_MAX_BYTES as sent or decompressed
+    """
+    inflater = None
+    if request.headers.get('Content-Encoding', '').lower() == 'gzip':
+        inflater = zlib.decompressobj(16 + zlib.MAX_WBITS)
+    chunks = []
+    sent = size = 0
+    while True:
+        chunk = request.read(INGEST_READ_CHUNK)
+        if not chunk:
+            break
+        sent += len(chunk)
+        if inflater is not None:
+            try:
+                chunk = inflater.decompress(chunk, INGEST_MAX_BYTES - size + 1)
+            except zlib.error:
+                raise ValidationError({'detail': 'Body is not valid gzip'})
+        size += len(chunk)
+        if sent > INGEST_MAX_BYTES or size > INGEST_MAX_BYTES:
+            return None
+        chunks.append(chunk)
+    body = b''.join(chunks)
+    try:
+        return json.loads(body)
+    except ValueError:
+        raise ValidationError({'detail': 'Body is not valid JSON'})
+
+
+def encode_events(columns, payload, spans=None):
+    """
+    COPY lines of a request payload and {index: reason} of the events outside
+    spans; raises ValidationError naming the first invalid events
+    """
+    if not isinstance(payload, dict) or not isinstance(payload.get('events'), list):
+        raise ValidationError({'events': 'Expected {"events": [...]}, optionally with "columns" and "defaults"'})
+    defaults = payload.get('defaults') or {}
+    names = payload.get('columns')
+    unknown = [name for name in [*(names or []), *defaults] if name not in columns.names]
+    if not isinstance(defaults, dict) or (names is not None and not isinstance(names, list)) or unknown:
+        raise ValidationError({'columns': f"Unknown columns {unknown}; ingested columns are {columns.names}"})
+
+    lines = []
+    errors = {}
+    out_of_range = {}
+    for index, event in enumerate(payload['events']):
+        try:
+            if names is not None:
+                if not isinstance(event, list) or len(event) != len(names):
+                    raise ValueError(f"expected a list of {len(names)} values")
+                event = dict(zip(names, event))
+            elif not isinstance(event, dict):
+                raise ValueError('expected an object')
+            lines.append(columns.encode({**defaults, **event} if defaults else event, spans))
+        except OutOfRange as e:
+            out_of_range[index] = str(e)
+        except ValueError as e:
+            errors[index] = str(e)
+            if len(errors) >= INGEST_MAX_ERRORS:
+                break
+    if errors:
+        raise ValidationError({'events': errors})
+    return lines, out_of_range
+
+
+def respond(view, request, spec):
+    """Response of an ingest action: POST queues events, GET reports the counters"""
+    buffer = buffer_for(view.get_queryset().model, spec)
+    if request.method == 'GET':
+        return Response(buffer.stats())
+
+    payload = request_body(request)
+    if payload is None:
+        return Response({'detail': f"Body exceeds {INGEST_MAX_BYTES} bytes"},
+                        status=status.HTTP_413_REQUEST_ENTITY_TOO_LARGE)
+    try:
+        lines, out_of_range = encode_events(buffer.columns, payload, buffer.partition_spans())
+    except ValidationError:
+        with buffer.lock:
+            buffer.counters['invalid_requests'] += 1
+        raise
+    if len(lines) > buffer.capacity:
+        return Response({'detail': f"At most {buffer.capacity} events per request"},
+                        status=status.HTTP_413_REQUEST_ENTITY_TOO_LARGE)
+    if not buffer.push(lines):
+        return Response({'detail': 'Ingest buffer is full, retry later'}, status=status.HTTP_503_SERVICE_UNAVAILABLE,
+                        headers={'Retry-After': str(max(1, math.ceil(buffer.interval)))})
+    accepted = {'accepted': len(lines)}
+    if out_of_range:
+        with buffer.lock:
+            buffer.counters['out_of_range'] += len(out_of_range)
+        accepted['out_of_range'] = len(out_of_range)
+        accepted['events'] = dict(list(out_of_range.items())[:INGEST_MAX_ERRORS])
+    return Response(accepted, status=status.HTTP_202_ACCEPTED)
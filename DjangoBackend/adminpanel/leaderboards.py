@@ -0,0 +1,229 @@
+"""
+Leaderboards declared on their source entity in entities.json
+
+  "Match": {
+    "leaderboards": {
+      "wins": {"by": "winner"},                      # rows per winner
+      "loot": {"by": "winner", "sum": "gold"}        # sum of an integer field
+    }
+  }
+
+Scores live in LeaderboardEntry, one row per board and owner, kept up to
+date by a trigger on the source table (see SyncLeaderboards), so every
+insert, update and delete adjusts them in the same transaction. Top N is an
+index scan on (board, score DESC, owner_id); a rank counts the entries
+above it on the same index.
+
+Scores are lifetime totals: rows purged by apply_retention stay counted
+(the trigger skips deletes marked with PURGE_SETTING), while other deletes
+take their rows off the board. Rebuilding a board counts the live rows only.
+"""
+
+import json
+import os
+import re
+from functools import lru_cache
+
+from django.apps import apps
+from django.conf import settings
+from django.db import connection, transaction
+from rest_framework import viewsets
+from rest_framework.exceptions import NotFound, ValidationError
+from rest_framework.response import Response
+
+from .retention import PURGE_SETTING
+
+# Largest ?limit= of a leaderboard request
+LEADERBOARD_MAX_LIMIT = int(os.getenv('LEADERBOARD_MAX_LIMIT', 100))
+
+TRIGGER_NAME = 'leaderboards'
+
+
+def source_boards(model_name, model_config):
+    """Normalized boards of one source entity: {name: {'by': field, 'sum': field or None}}"""
+    fields = model_config.get("fields", {})
+    boards = {}
+    for name, board in model_config.get("leaderboards", {}).items():
+        if not re.fullmatch(r'[a-z][a-z0-9_]{0,49}', name):
+            raise ValueError(f"{model_name}: leaderboard name '{name}' must be lowercase letters, digits and _")
+        if 'ForeignKey' not in str(fields.get(board.get("by"))):
+            raise ValueError(f"{model_name}: leaderboard '{name}' needs 'by' naming a ForeignKey")
+        if board.get("sum") and board["sum"] not in fields:
+            raise ValueError(f"{model_name}: leaderboard '{name}' sums unknown field '{board['sum']}'")
+        boards[name] = {"by": board["by"], "sum": board.get("sum")}
+    return boards
+
+
+@lru_cache(maxsize=1)
+def leaderboard_specs():
+    """{name: {'source': model_name, 'by': field, 'sum': field or None}} of all entities"""
+    config = json.loads(settings.DYNAMIC_MODELS_CONFIG['CONFIG_PATH'].read_text())
+    specs = {}
+    for model_name, model_config in config.items():
+        for name, board in source_boards(model_name, model_config).items():
+            if name in specs:
+                raise ValueError(f"Leaderboard '{name}' is declared by {specs[name]['source']} and {model_name}")
+            specs[name] = {"source": model_name, **board}
+    return specs
+
+
+def board_columns(model, boards):
+    """Boards with their column names resolved on the source model"""
+    meta = model._meta
+    return {
+        name: {"by": meta.get_field(board["by"]).column,
+               "sum": meta.get_field(board["sum"]).column if board["sum"] else None}
+        for name, board in boards.items()
+    }
+
+
+def trigger_function_sql(function, entry_table, boards):
+    """PL/pgSQL trigger function applying each row change to the entries of its boards"""
+    quote = connection.ops.quote_name
+    entries = quote(entry_table)
+    blocks = []
+    for name, board in boards.items():
+        by = quote(board["by"])
+        changed = f"OLD.{by} IS DISTINCT FROM NEW.{by}"
+        if board["sum"]:
+            changed += f" OR OLD.{quote(board['sum'])} IS DISTINCT FROM NEW.{quote(board['sum'])}"
+        old_score = f"coalesce(OLD.{quote(board['sum'])}, 0)" if board["sum"] else "1"
+        new_score = f"coalesce(NEW.{quote(board['sum'])}, 0)" if board["sum"] else "1"
+        blocks.append(f"""
+  IF TG_OP <> 'UPDATE' OR {changed} THEN
+    IF TG_OP <> 'INSERT' AND OLD.{by} IS NOT NULL THEN
+      UPDATE {entries} SET score = score - {old_score}, rows = rows - 1, updated_at = now()
+        WHERE board = '{name}' AND owner_id = OLD.{by};
+      DELETE FROM {entries} WHERE board = '{name}' AND owner_id = OLD.{by} AND rows <= 0;
+    END IF;
+    IF TG_OP <> 'DELETE' AND NEW.{by} IS NOT NULL THEN
+      INSERT INTO {entries} (board, owner_id, score, rows, updated_at)
+        VALUES ('{name}', NEW.{by}, {new_score}, 1, now())
+        ON CONFLICT (board, owner_id) DO UPDATE
+        SET score = {entries}.score + EXCLUDED.score, rows = {entries}.rows + 1, updated_at = now();
+    END IF;
+  END IF;""")
+    purge = f"""
+  IF TG_OP = 'DELETE' AND current_setting('{PURGE_SETTING}', true) = 'on' THEN
+    RETURN NULL;
+  END IF;"""
+    return (f"CREATE OR REPLACE FUNCTION {quote(function)}() RETURNS trigger LANGUAGE plpgsql AS $$\n"
+            f"BEGIN{purge}{''.join(blocks)}\n  RETURN NULL;\nEND\n$$")
+
+
+def drop_trigger(cursor, table):
+    """Drop the trigger from the table and from partitions that have their own copy"""
+    quote = connection.ops.quote_name
+    cursor.execute(
+        "SELECT c.relname FROM pg_trigger t JOIN pg_class c ON c.oid = t.tgrelid "
+        "WHERE t.tgname = %s AND t.tgparentid = 0 AND (c.oid = %s::regclass "
+        "OR c.oid IN (SELECT inhrelid FROM pg_inherits WHERE inhparent = %s::regclass))",
+        [TRIGGER_NAME, table, table],
+    )
+    for (relname,) in cursor.fetchall():
+        cursor.execute(f"DROP TRIGGER {quote(TRIGGER_NAME)} ON {quote(relname)}")
+    cursor.execute(f"DROP FUNCTION IF EXISTS {quote(table + '_leaderboards')}()")
+
+
+def install_trigger(cursor, table, entry_table, boards):
+    quote = connection.ops.quote_name
+    drop_trigger(cursor, table)
+    if not boards:
+        return
+    function = table + '_leaderboards'
+    cursor.execute(trigger_function_sql(function, entry_table, boards))
+    cursor.execute(
+        f"CREATE TRIGGER {quote(TRIGGER_NAME)} AFTER INSERT OR UPDATE OR DELETE ON {quote(table)} "
+        f"FOR EACH ROW EXECUTE FUNCTION {quote(function)}()"
+    )
+
+
+def rebuild_board(cursor, name, table, entry_table, board):
+    """Recompute one board from its source table; returns the number of entries"""
+    quote = connection.ops.quote_name
+    by = quote(board["by"])
+    score = f"coalesce(sum({quote(board['sum'])}), 0)" if board["sum"] else "count(*)"
+    # Writers wait for the rebuild, so no change is counted twice or missed
+    cursor.execute(f"LOCK TABLE {quote(table)} IN SHARE MODE")
+    cursor.execute(f"DELETE FROM {quote(entry_table)} WHERE board = %s", [name])
+    cursor.execute(
+        f"INSERT INTO {quote(entry_table)} (board, owner_id, score, rows, updated_at) "
+        f"SELECT %s, {by}, {score}, count(*), now() FROM {quote(table)} WHERE {by} IS NOT NULL GROUP BY {by}",
+        [name],
+    )
+    return cursor.rowcount
+
+
+def rebuild(name):
+    spec = leaderboard_specs()[name]
+    model = apps.get_model('adminpanel', spec["source"])
+    entry_table = apps.get_model('adminpanel', 'LeaderboardEntry')._meta.db_table
+    board = board_columns(model, {name: spec})[name]
+    with transaction.atomic(), connection.cursor() as cursor:
+        return rebuild_board(cursor, name, model._meta.db_table, entry_table, board)
+
+
+def owner_data(spec, owner_ids):
+    """Owners serialized with their list serializer, by id"""
+    from . import serializers
+
+    target = apps.get_model('adminpanel', spec["source"])._meta.get_field(spec["by"]).related_model
+    serializer = getattr(serializers, f"{target.__name__}ListSerializer")
+    return {owner.pk: serializer(owner).data for owner in target.objects.in_bulk(owner_ids).values()}
+
+
+def top(name, limit):
+    """The first limit entries with competition ranks (equal scores share a rank)"""
+    entries = list(
+        apps.get_model('adminpanel', 'LeaderboardEntry').objects
+        .filter(board=name).order_by('-score', 'owner_id')[:limit]
+    )
+    owners = owner_data(leaderboard_specs()[name], [entry.owner_id for entry in entries])
+    results = []
+    for position, entry in enumerate(entries, 1):
+        rank = results[-1]['rank'] if results and results[-1]['score'] == entry.score else position
+        results.append({'rank': rank, 'score': entry.score, 'owner': owners.get(entry.owner_id)})
+    return results
+
+
+def rank(name, owner_id):
+    """Rank and score of one owner, None if the owner has no entry"""
+    entries = apps.get_model('adminpanel', 'LeaderboardEntry').objects.filter(board=name)
+    entry = entries.filter(owner_id=owner_id).first()
+    if entry is None:
+        return None
+    above = entries.filter(score__gt=entry.score).count()
+    owners = owner_data(leaderboard_specs()[name], [owner_id])
+    return {'rank': above + 1, 'score': entry.score, 'owner': owners.get(entry.owner_id)}
+
+
+class LeaderboardViewSet(viewsets.ViewSet):
+    """Leaderboards declared in entities.json: /api/leaderboards/<name>/?limit=10 or ?owner=<id>"""
+
+    lookup_field = 'name'
+
+    def list(self, request):
+        return Response({
+            name: {'source': spec['source'], 'by': spec['by'], 'sum': spec['sum'],
+                   'url': request.build_absolute_uri(f"{name}/")}
+            for name, spec in leaderboard_specs().items()
+        })
+
+    def retrieve(self, request, name=None):
+        if name not in leaderboard_specs():
+            raise NotFound(f"No leaderboard named '{name}'")
+        owner = request.query_params.get('owner')
+        if owner is not None:
+            if not owner.isdigit():
+                raise ValidationError({'owner': 'Expected an id'})
+            result = rank(name, int(owner))
+            if result is None:
+                raise NotFound(f"Owner {owner} is not on leaderboard '{name}'")
+            return Response(result)
+        try:
+            limit = int(request.query_params.get('limit', 10))
+        except ValueError:
+            raise ValidationError({'limit': 'Expected an integer'})
+        if not 1 <= limit <= LEADERBOARD_MAX_LIMIT:
+            raise ValidationError({'limit': f"Must be between 1 and {LEADERBOARD_MAX_LIMIT}"})
+        return Response({'board': name, 'results': top(name, limit)})
@@ -0,0 +1,49 @@
+"""
+Move rows past their entity's retention period out of the live tables.
+Schedule it during quiet hours; a run that is stopped or times out resumes
+on the next start:
+
+    python manage.py apply_retention [--entity Match] [--max-seconds 600] [--dry-run]
+"""
+
+from django.apps import apps
+from django.core.management.base import BaseCommand, CommandError
+from django.db import IntegrityError, connection
+
+from adminpanel.retention import RetentionRun, retention_policies
+
+
+class Command(BaseCommand):
+    help = "Archive and delete expired rows in small batches"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--entity', action='append', help="Only these entities (repeatable)")
+        parser.add_argument('--max-seconds', type=float, help="Stop each entity after this long")
+        parser.add_argument('--dry-run', action='store_true', help="Only count expired rows")
+
+    def handle(self, *args, **options):
+        policies = retention_policies()
+        if options['entity']:
+            unknown = set(options['entity']) - set(policies)
+            if unknown:
+                raise CommandError(f"No retention policy for {', '.join(sorted(unknown))}")
+            policies = {name: policies[name] for name in options['entity']}
+        if not policies:
+            self.stdout.write("No retention policies in entities.json")
+            return
+
+        for model_name, policy in policies.items():
+            model = apps.get_model('adminpanel', model_name)
+            run = RetentionRun(connection, model, policy, dry_run=options['dry_run'])
+            self.stdout.write(f"{run.table}: {policy['field']} before {run.cutoff:%Y-%m-%d %H:%M} "
+                              f"-> {policy['archive']}")
+            try:
+                moved = run.run(max_seconds=options['max_seconds'])
+            except IntegrityError as e:
+                raise CommandError(f"{run.table}: expired rows are still referenced ({e})")
+            if options['dry_run']:
+                self.stdout.write(f"  {moved} rows expired")
+                continue
+            self.stdout.write(f"  {moved} rows moved at {run.rate():.0f} rows/s")
+            if run.archive_path and moved:
+                self.stdout.write(f"  archived to {run.archive_path}")
@@ -0,0 +1,119 @@
+"""
+Measure what the "storage" hints of entities.json buy on synthetic data:
+
+    python manage.py benchmark_storage [--rows 200000]
+
+- writes: LOGGED vs UNLOGGED inserts (time and WAL volume)
+- updates: fillfactor 100 vs 70 under in-place counter updates (HOT share and growth)
+- range reads: b-tree vs BRIN on an append-ordered timestamp (build time, size, lookup)
+
+Works on scratch tables named bench_storage_*, which are dropped afterwards.
+"""
+
+import time
+
+from django.core.management.base import BaseCommand
+from django.db import connection, transaction
+
+PREFIX = 'bench_storage'
+
+COLUMNS = "id bigserial PRIMARY KEY, created_at timestamptz NOT NULL, value integer NOT NULL, payload text"
+
+FILL = (
+    "INSERT INTO {table} (created_at, value, payload) "
+    "SELECT timestamptz '2024-01-01' + g * interval '1 second', g %% 1000, md5(g::text) "
+    "FROM generate_series(1, %s) g"
+)
+
+
+def megabytes(size):
+    if size < 1024 * 1024:
+        return f"{size / 1024:.0f} kB"
+    return f"{size / 1024 / 1024:.1f} MB"
+
+
+class Command(BaseCommand):
+    help = "Benchmark UNLOGGED tables, fillfactor and BRIN indexes on synthetic data"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--rows', type=int, default=200000, help="Rows per scratch table")
+
+    def handle(self, *args, **options):
+        rows = options['rows']
+        with connection.cursor() as cursor:
+            self.cursor = cursor
+            try:
+                self.writes(rows)
+                self.updates(rows)
+                self.range_reads(rows)
+            finally:
+                for name in ('logged', 'unlogged', 'ff100', 'ff70', 'index'):
+                    cursor.execute(f"DROP TABLE IF EXISTS {PREFIX}_{name}")
+
+    def timed(self, sql, params=None):
+        started = time.perf_counter()
+        self.cursor.execute(sql, params)
+        return time.perf_counter() - started
+
+    def value(self, sql, params=None):
+        self.cursor.execute(sql, params)
+        return self.cursor.fetchone()[0]
+
+    def writes(self, rows):
+        self.stdout.write(f"Writes ({rows} rows)")
+        for name, kind in (('logged', ''), ('unlogged', 'UNLOGGED ')):
+            table = f"{PREFIX}_{name}"
+            self.cursor.execute(f"CREATE {kind}TABLE {table} ({COLUMNS})")
+            self.cursor.execute(f"CREATE INDEX ON {table} (created_at)")
+            wal_before = self.value("SELECT pg_current_wal_insert_lsn()")
+            elapsed = self.timed(FILL.format(table=table), [rows])
+            wal = self.value("SELECT pg_wal_lsn_diff(pg_current_wal_insert_lsn(), %s)", [wal_before])
+            self.stdout.write(f"  {name.upper():9s}{elapsed:8.2f}s  {rows / elapsed:10.0f} rows/s  "
+                              f"WAL {megabytes(wal)}")
+
+    def updates(self, rows):
+        rounds = 5
+        self.stdout.write(f"Updates ({rounds} rounds over every row, indexed columns untouched)")
+        for fillfactor in (100, 70):
+            table = f"{PREFIX}_ff{fillfactor}"
+            self.cursor.execute(f"CREATE TABLE {table} ({COLUMNS}) WITH (fillfactor = {fillfactor}, "
+                                f"autovacuum_enabled = false)")
+            self.cursor.execute(f"CREATE INDEX ON {table} (created_at)")
+            self.cursor.execute(FILL.format(table=table), [rows])
+            self.cursor.execute(f"VACUUM ANALYZE {table}")
+            size_before = self.value("SELECT pg_total_relation_size(%s)", [table])
+            elapsed = updated = hot = 0
+            for _ in range(rounds):
+                # A tenth of the rows per transaction, so pages can be pruned in between
+                for part in range(10):
+                    with transaction.atomic():
+                        elapsed += self.timed(f"UPDATE {table} SET value = value + 1 WHERE id %% 10 = %s", [part])
+                        self.cursor.execute(f"SELECT pg_stat_get_xact_tuples_updated('{table}'::regclass), "
+                                            f"pg_stat_get_xact_tuples_hot_updated('{table}'::regclass)")
+                        counts = self.cursor.fetchone()
+                    updated += counts[0]
+                    hot += counts[1]
+            size_after = self.value("SELECT pg_total_relation_size(%s)", [table])
+            self.stdout.write(f"  fillfactor {fillfactor:3d}  {elapsed:8.2f}s  HOT {100 * hot / updated:5.1f}%  "
+                              f"size {megabytes(size_before)} -> {megabytes(size_after)}")
+
+    def range_reads(self, rows):
+        table = f"{PREFIX}_index"
+        self.stdout.write("Range reads on created_at (1% window)")
+        self.cursor.execute(f"CREATE TABLE {table} ({COLUMNS})")
+        self.cursor.execute(FILL.format(table=table), [rows])
+        self.cursor.execute(f"VACUUM ANALYZE {table}")
+        window = max(rows // 100, 1)
+        lookup = (f"SELECT count(*) FROM {table} WHERE created_at >= timestamptz '2024-01-01' + %s * interval '1 second' "
+                  f"AND created_at < timestamptz '2024-01-01' + %s * interval '1 second'")
+        for kind in ('btree', 'brin'):
+            index = f"{table}_{kind}"
+            build = self.timed(f"CREATE INDEX {index} ON {table} USING {kind} (created_at)")
+            self.cursor.execute(f"ANALYZE {table}")
+            size = self.value("SELECT pg_relation_size(%s)", [index])
+            start = rows // 2
+            self.cursor.execute(lookup, [start, start + window])  # warm up
+            reads = [self.timed(lookup, [start + i * 7, start + i * 7 + window]) for i in range(20)]
+            self.stdout.write(f"  {kind:5s}  build {build:6.2f}s  size {megabytes(size):>9s}  "
+                              f"lookup {1000 * sorted(reads)[len(reads) // 2]:6.2f}ms (median)")
+            self.cursor.execute(f"DROP INDEX {index}")
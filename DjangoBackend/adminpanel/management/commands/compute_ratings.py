@@ -0,0 +1,40 @@
+"""
+Compute skill ratings from match outcomes, e.g. every few minutes from cron:
+
+    python manage.py compute_ratings [--rating skill] [--full]
+
+Incremental runs rate the periods completed since the last run; --full
+recomputes a rating from all matches, needed after changing its parameters.
+"""
+
+from django.core.management.base import BaseCommand, CommandError
+
+from adminpanel.ratings import compute, rating_specs
+
+
+class Command(BaseCommand):
+    help = "Compute skill ratings from match outcomes"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--rating', action='append', help="Only these ratings (repeatable)")
+        parser.add_argument('--full', action='store_true', help="Recompute from all matches")
+
+    def handle(self, *args, **options):
+        specs = rating_specs()
+        if not specs:
+            self.stdout.write("No ratings in entities.json")
+            return
+        names = options['rating'] or list(specs)
+        unknown = set(names) - set(specs)
+        if unknown:
+            raise CommandError(f"No rating named {', '.join(sorted(unknown))}")
+
+        for name in names:
+            try:
+                summary = compute(name, full=options['full'])
+            except ValueError as e:
+                raise CommandError(str(e))
+            self.stdout.write(
+                f"{name}: {summary['matches']} matches in {summary['periods']} periods, "
+                f"{summary['owners']} owners updated"
+            )
@@ -0,0 +1,40 @@
+"""
+Flag statistical outliers for review in the admin (Anomalies), e.g. hourly from cron:
+
+    python manage.py detect_anomalies [--detector win_rate] [--days 7]
+
+Each run replaces the open flags of the detectors it runs; confirmed and
+dismissed flags are kept.
+"""
+
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+
+from adminpanel.anomalies import detect, detector_specs
+
+
+class Command(BaseCommand):
+    help = "Flag statistical outliers declared in entities.json"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--detector', action='append', help="Only these detectors (repeatable)")
+        parser.add_argument('--days', type=int, default=7, help="Rows of the last N days for rate detectors")
+
+    def handle(self, *args, **options):
+        specs = detector_specs()
+        if not specs:
+            self.stdout.write("No anomaly detectors in entities.json")
+            return
+        names = options['detector'] or list(specs)
+        unknown = set(names) - set(specs)
+        if unknown:
+            raise CommandError(f"No anomaly detector named {', '.join(sorted(unknown))}")
+
+        for name in names:
+            started = time.monotonic()
+            try:
+                flags = detect(name, options['days'])
+            except ValueError as e:
+                raise CommandError(str(e))
+            self.stdout.write(f"{name}: {len(flags)} flagged in {time.monotonic() - started:.1f}s")
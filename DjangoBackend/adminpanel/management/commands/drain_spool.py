@@ -0,0 +1,46 @@
+"""
+Replay the finish requests journaled while the database was unreachable,
+e.g. after an outage if no web process is draining them:
+
+    python manage.py drain_spool [--retry-failed] [--retry-dead-letters]
+
+Web processes drain the journal on their own once the database is back.
+"""
+
+from django.core.management.base import BaseCommand
+
+from adminpanel import spool
+
+
+class Command(BaseCommand):
+    help = "Replay the local spool of finish requests into the database"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--retry-failed', action='store_true',
+                            help="Also replay entries the database refused before")
+        parser.add_argument('--retry-dead-letters', action='store_true',
+                            help="Move dead letters back into the journal and replay them")
+
+    def handle(self, *args, **options):
+        if not spool.SPOOL_PATH.exists():
+            self.stdout.write(f"No spool at {spool.SPOOL_PATH}")
+            return
+        journal = spool.get_spool()
+        if options['retry_failed']:
+            with journal.lock:
+                journal.db.execute("UPDATE entries SET failed = 0 WHERE failed = 1")
+        if options['retry_dead_letters']:
+            with journal.lock:
+                journal.db.execute("BEGIN IMMEDIATE")
+                journal.db.execute(
+                    "INSERT OR IGNORE INTO entries (id, endpoint, key, fingerprint, view, lookup, data, spec, spooled_at) "
+                    "SELECT id, endpoint, key, fingerprint, view, lookup, data, spec, spooled_at FROM dead_letters"
+                )
+                journal.db.execute("DELETE FROM dead_letters")
+                journal.db.execute("COMMIT")
+        replayed = journal.drain()
+        stats = journal.stats()
+        self.stdout.write(f"{replayed} entries processed ({stats['replayed']} applied, "
+                          f"{stats['already_applied']} already applied, {stats['failed']} refused, "
+                          f"{stats['dead_lettered']} dead lettered), {stats['depth']} pending, "
+                          f"{stats['failed_entries']} failed, {stats['dead_letters']} dead letters")
@@ -0,0 +1,27 @@
+"""
+Fold the shard rows of sharded counters into their counter columns.
+run_maintenance runs it every COUNTER_FOLD_SECONDS; counters read from the
+row lag by that much:
+
+    python manage.py fold_counters
+"""
+
+from django.apps import apps
+from django.core.management.base import BaseCommand
+
+from adminpanel import counters
+
+
+class Command(BaseCommand):
+    help = "Move pending sharded counter increments into the counter columns"
+
+    def handle(self, *args, **options):
+        shard_models = [model for model in apps.get_app_config('adminpanel').get_models()
+                        if hasattr(model, 'counter_field')]
+        if not shard_models:
+            self.stdout.write("No sharded counters")
+            return
+        for shard_model in shard_models:
+            model = shard_model._meta.get_field('owner').related_model
+            rows = counters.fold(model, shard_model.counter_field, shard_model)
+            self.stdout.write(f"{model.__name__}.{shard_model.counter_field}: {rows} rows updated")
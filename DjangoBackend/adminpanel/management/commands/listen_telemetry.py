@@ -0,0 +1,53 @@
+"""
+Receive the UDP telemetry of the entities that declare "udp" in entities.json,
+next to the web process (entrypoint.sh starts it):
+
+    python manage.py listen_telemetry [--host 0.0.0.0] [--report 60]
+
+Counters are printed every --report seconds. SIGTERM or Ctrl-C writes the
+events still waiting before exiting.
+"""
+
+import asyncio
+import signal
+
+from django.apps import apps
+from django.core.management.base import BaseCommand, CommandError
+
+from adminpanel.datagrams import Listener, serve, udp_specs
+
+
+class Command(BaseCommand):
+    help = "Receive binary telemetry datagrams and write them to Postgres in bulk"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--host', default='0.0.0.0', help="Address to listen on")
+        parser.add_argument('--report', type=float, default=60, help="Seconds between counter reports")
+
+    def handle(self, *args, **options):
+        try:
+            specs = udp_specs()
+            listeners = {spec['port']: Listener(apps.get_model('adminpanel', model_name), spec)
+                         for model_name, spec in specs.items()}
+        except (ValueError, LookupError) as e:
+            raise CommandError(str(e))
+        if not listeners:
+            self.stdout.write("No UDP telemetry in entities.json")
+            return
+        for port, listener in listeners.items():
+            self.stdout.write(f"{listener.model.__name__}: listening on {options['host']}:{port}/udp")
+
+        async def main():
+            task = asyncio.create_task(serve(listeners, options['host'], options['report']))
+            loop = asyncio.get_running_loop()
+            for signum in (signal.SIGINT, signal.SIGTERM):
+                loop.add_signal_handler(signum, task.cancel)
+            try:
+                await task
+            except asyncio.CancelledError:
+                pass
+
+        asyncio.run(main())
+        for listener in listeners.values():
+            listener.flush_now()
+            self.stdout.write("\n".join(listener.report()))
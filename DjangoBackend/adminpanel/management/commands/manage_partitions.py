@@ -0,0 +1,35 @@
+"""
+Keep range-partitioned tables ready for new rows and expire old partitions.
+entrypoint.sh runs it at startup, and run_maintenance every hour after that:
+
+    python manage.py manage_partitions [--dry-run]
+"""
+
+from django.apps import apps
+from django.core.management.base import BaseCommand
+from django.db import connection
+
+from adminpanel.partitions import maintain, partition_specs
+
+
+class Command(BaseCommand):
+    help = "Pre-create future partitions and detach or drop expired ones"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--dry-run', action='store_true', help="Only report what would change")
+
+    def handle(self, *args, **options):
+        specs = partition_specs()
+        if not specs:
+            self.stdout.write("No partitioned entities in entities.json")
+            return
+        for model_name, spec in specs.items():
+            model = apps.get_model('adminpanel', model_name)
+            created, expired = maintain(connection, model, spec, dry_run=options['dry_run'])
+            table = model._meta.db_table
+            self.stdout.write(f"{table}: {len(created)} created, {len(expired)} expired")
+            for name in created:
+                self.stdout.write(f"  + {name}")
+            for name in expired:
+                action = 'detached' if spec['expire'] == 'detach' else 'dropped'
+                self.stdout.write(f"  - {name} ({'would be ' if options['dry_run'] else ''}{action})")
@@ -0,0 +1,33 @@
+"""
+Delete idempotency keys older than IDEMPOTENCY_KEY_HOURS.
+Expired keys are already ignored; run it daily to keep the table small:
+
+    python manage.py purge_idempotency_keys
+"""
+
+from datetime import timedelta
+
+from django.apps import apps
+from django.core.management.base import BaseCommand
+from django.db import connection
+from django.utils import timezone
+
+from adminpanel import finishing
+
+
+class Command(BaseCommand):
+    help = "Delete the stored responses of expired idempotency keys"
+
+    def handle(self, *args, **options):
+        try:
+            model = apps.get_model('adminpanel', 'IdempotencyKey')
+        except LookupError:
+            self.stdout.write("No entity declares a finish action")
+            return
+        cutoff = timezone.now() - timedelta(hours=finishing.IDEMPOTENCY_KEY_HOURS)
+        # Plain DELETE: the generic delete() loads every row for the signal receivers
+        with connection.cursor() as cursor:
+            cursor.execute(f"DELETE FROM {connection.ops.quote_name(model._meta.db_table)} WHERE created_at < %s",
+                           [cutoff])
+            deleted = cursor.rowcount
+        self.stdout.write(f"{deleted} expired keys deleted")
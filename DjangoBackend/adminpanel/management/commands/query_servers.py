@@ -0,0 +1,88 @@
+"""
+Query the game servers once with A2S_INFO and A2S_PLAYER and print how they answered:
+
+    python manage.py query_servers [--stand-in 1000] [--drop 0.05]
+
+--stand-in starts that many local responders and queries them instead of the
+registered servers, to check the poller at scale without game servers.
+"""
+
+import asyncio
+import random
+import resource
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+
+from adminpanel.a2s import DEFAULTS, Poller, StandIn, a2s_spec, load_servers
+
+
+class Command(BaseCommand):
+    help = "Query the game servers once over A2S and print the results"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--stand-in', type=int, default=0, help="Query this many local stand-in servers")
+        parser.add_argument('--drop', type=float, default=0.0, help="Fraction of requests stand-ins ignore")
+        parser.add_argument('--players', type=int, default=40, help="Most players per stand-in server")
+
+    def handle(self, *args, **options):
+        try:
+            spec = a2s_spec()
+        except ValueError as e:
+            raise CommandError(str(e))
+        if options['stand_in']:
+            spec = spec or {"model": None, **DEFAULTS}
+            servers = None
+        else:
+            if spec is None:
+                self.stdout.write("No a2s in entities.json and no A2S_SERVERS")
+                return
+            servers = load_servers(spec)
+        started = time.monotonic()
+        status = asyncio.run(self.query(spec, servers, options))
+        elapsed = time.monotonic() - started
+
+        for server in sorted(status.values(), key=lambda server: server['address'])[:20]:
+            if server['state'] == 'online':
+                info = server['info']
+                self.stdout.write(f"{server['address']}: {info['name']} on {info['map']}, "
+                                  f"{info['players']}/{info['max_players']} players, {server['ping_ms']} ms")
+            else:
+                self.stdout.write(f"{server['address']}: {server['state']}, {server['error']}")
+        if len(status) > 20:
+            self.stdout.write(f"... {len(status) - 20} more")
+        online = [server for server in status.values() if server['state'] == 'online']
+        pings = sorted(server['ping_ms'] for server in online)
+        self.stdout.write(f"{len(online)}/{len(status)} servers answered in {elapsed:.2f}s, "
+                          f"{sum(server['info']['players'] for server in online)} players online")
+        if pings:
+            self.stdout.write(f"ping p50 {pings[len(pings) // 2]} ms, p99 {pings[int(len(pings) * 0.99)]} ms, "
+                              f"max {pings[-1]} ms")
+
+    async def query(self, spec, servers, options):
+        poller = Poller(spec)
+        if servers is not None:
+            return await poller.poll_once(servers)
+
+        count = options['stand_in']
+        soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+        if soft < count + 64:
+            resource.setrlimit(resource.RLIMIT_NOFILE, (min(hard, count + 64), hard))
+        loop = asyncio.get_running_loop()
+        transports, servers = [], {}
+        try:
+            for index in range(count):
+                players = [(f"Player{n}", random.randint(0, 50), random.uniform(0, 3600))
+                           for n in range(random.randint(0, options['players']))]
+                transport, _ = await loop.create_datagram_endpoint(
+                    lambda: StandIn(name=f"Stand-in {index}", players=players, max_players=options['players'],
+                                    drop=options['drop']),
+                    local_addr=('127.0.0.1', 0),
+                )
+                transports.append(transport)
+                port = transport.get_extra_info('sockname')[1]
+                servers[f"127.0.0.1:{port}"] = {"name": f"Stand-in {index}", "host": "127.0.0.1", "port": port}
+            return await poller.poll_once(servers)
+        finally:
+            for transport in transports:
+                transport.close()
@@ -0,0 +1,38 @@
+"""
+Recompute leaderboards from their source tables, e.g. after a bulk load with
+triggers disabled or a restore. Writes to the source table wait meanwhile:
+
+    python manage.py rebuild_leaderboards [--board wins]
+
+Entries of boards no longer declared in entities.json are removed.
+"""
+
+from django.apps import apps
+from django.core.management.base import BaseCommand, CommandError
+
+from adminpanel.leaderboards import leaderboard_specs, rebuild
+
+
+class Command(BaseCommand):
+    help = "Rebuild leaderboard entries from their source tables"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--board', action='append', help="Only these boards (repeatable)")
+
+    def handle(self, *args, **options):
+        specs = leaderboard_specs()
+        if not specs:
+            self.stdout.write("No leaderboards in entities.json")
+            return
+        boards = options['board'] or list(specs)
+        unknown = set(boards) - set(specs)
+        if unknown:
+            raise CommandError(f"No leaderboard named {', '.join(sorted(unknown))}")
+
+        for name in boards:
+            entries = rebuild(name)
+            self.stdout.write(f"{name}: {entries} entries from {specs[name]['source']}")
+        if not options['board']:
+            removed, _ = apps.get_model('adminpanel', 'LeaderboardEntry').objects.exclude(board__in=specs).delete()
+            if removed:
+                self.stdout.write(f"Removed {removed} entries of undeclared boards")
@@ -0,0 +1,40 @@
+"""
+Close the buckets of the rollups declared in entities.json, every minute from cron:
+
+    python manage.py refresh_rollups [--rollup matches]
+
+Each run moves the watermark of a rollup to the minute "delay" seconds ago,
+aggregates the source rows in between and prunes rows older than "keep".
+"""
+
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+
+from adminpanel.rollups import refresh, rollup_specs
+
+
+class Command(BaseCommand):
+    help = "Aggregate new rows into the rollups declared in entities.json"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--rollup', action='append', help="Only these rollups (repeatable)")
+
+    def handle(self, *args, **options):
+        specs = rollup_specs()
+        if not specs:
+            self.stdout.write("No rollups in entities.json")
+            return
+        names = options['rollup'] or list(specs)
+        unknown = set(names) - set(specs)
+        if unknown:
+            raise CommandError(f"No rollup named {', '.join(sorted(unknown))}")
+
+        for name in names:
+            started = time.monotonic()
+            try:
+                old, new, written, pruned = refresh(name)
+            except ValueError as e:
+                raise CommandError(str(e))
+            self.stdout.write(f"{name}: watermark {old and old.isoformat()} -> {new.isoformat()}, "
+                              f"{written} rows written, {pruned} pruned in {time.monotonic() - started:.1f}s")
@@ -0,0 +1,71 @@
+"""
+Run the periodic maintenance that entities.json asks for, in one long-lived
+process next to the web process (entrypoint.sh starts it):
+
+    python manage.py run_maintenance [--once]
+
+- manage_partitions every PARTITION_MAINTENANCE_SECONDS (default 3600)
+- apply_retention every RETENTION_INTERVAL_SECONDS (default 3600), for at
+  most RETENTION_RUN_SECONDS (default 600); the next run resumes
+- fold_counters every COUNTER_FOLD_SECONDS (default 10), for sharded counters
+
+Each task runs at start and then on its interval. A failing task is
+reported and tried again on its next turn. Exits right away when no entity
+needs maintenance.
+"""
+
+import time
+
+from django.apps import apps
+from django.core.management import call_command
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+
+from adminpanel.counters import COUNTER_FOLD_SECONDS
+from adminpanel.partitions import PARTITION_MAINTENANCE_SECONDS, partition_specs
+from adminpanel.retention import RETENTION_INTERVAL_SECONDS, RETENTION_RUN_SECONDS, retention_policies
+
+
+def scheduled_tasks():
+    """[(command, interval in seconds, options)] of the maintenance entities.json needs"""
+    tasks = []
+    if partition_specs():
+        tasks.append(('manage_partitions', PARTITION_MAINTENANCE_SECONDS, {}))
+    if retention_policies():
+        tasks.append(('apply_retention', RETENTION_INTERVAL_SECONDS, {'max_seconds': RETENTION_RUN_SECONDS}))
+    if any(hasattr(model, 'counter_field') for model in apps.get_app_config('adminpanel').get_models()):
+        tasks.append(('fold_counters', COUNTER_FOLD_SECONDS, {}))
+    return tasks
+
+
+class Command(BaseCommand):
+    help = "Run partition maintenance, retention and other periodic tasks on their intervals"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--once', action='store_true', help="Run every task once and exit")
+
+    def handle(self, *args, **options):
+        try:
+            tasks = scheduled_tasks()
+        except ValueError as e:
+            raise CommandError(str(e))
+        if not tasks:
+            self.stdout.write("No periodic maintenance in entities.json")
+            return
+        for name, interval, _ in tasks:
+            self.stdout.write(f"{name}: every {interval}s")
+
+        due = {name: time.monotonic() for name, _, _ in tasks}
+        while True:
+            for name, interval, task_options in tasks:
+                if due[name] > time.monotonic():
+                    continue
+                due[name] = time.monotonic() + interval
+                try:
+                    call_command(name, stdout=self.stdout, **task_options)
+                except Exception as e:
+                    self.stderr.write(f"{name} failed, retrying in {interval}s: {e}")
+                    connection.close()
+            if options['once']:
+                return
+            time.sleep(max(1, min(due.values()) - time.monotonic()))
@@ -0,0 +1,306 @@
+# Generated by Django 4.2.30 on 2026-10-19 07:49
+
+import adminpanel.fields
+import adminpanel.operations
+import django.contrib.postgres.indexes
+import django.contrib.postgres.operations
+import django.core.serializers.json
+from django.db import migrations, models
+import django.db.models.deletion
+import django.db.models.functions.text
+
+
+class Migration(migrations.Migration):
+
+    atomic = False
+
+    dependencies = [
+        ('adminpanel', '0001_initial'),
+    ]
+
+    operations = [
+        django.contrib.postgres.operations.TrigramExtension(
+        ),
+        migrations.CreateModel(
+            name='Anomaly',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('detector', models.CharField(max_length=50)),
+                ('entity', models.CharField(max_length=50)),
+                ('object_id', models.BigIntegerField()),
+                ('score', models.FloatField()),
+                ('observed', models.FloatField()),
+                ('expected', models.FloatField()),
+                ('window_start', models.DateTimeField(blank=True, null=True)),
+                ('window_end', models.DateTimeField(blank=True, null=True)),
+                ('status', models.CharField(choices=[('open', 'Open'), ('confirmed', 'Confirmed'), ('dismissed', 'Dismissed')], default='open', max_length=10)),
+                ('note', models.TextField(blank=True)),
+                ('detected_at', models.DateTimeField(auto_now_add=True)),
+            ],
+            options={
+                'verbose_name_plural': 'anomalies',
+            },
+        ),
+        migrations.CreateModel(
+            name='GameServer',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('name', models.CharField(max_length=100, unique=True)),
+                ('host', models.CharField(max_length=255)),
+                ('query_port', models.IntegerField(default=27015)),
+                ('is_active', models.BooleanField(default=True)),
+            ],
+            options={
+                'verbose_name': 'GameServer',
+                'verbose_name_plural': 'GameServers',
+            },
+        ),
+        migrations.CreateModel(
+            name='GuildMemberCountShard',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('shard', models.SmallIntegerField()),
+                ('delta', models.BigIntegerField(default=0)),
+            ],
+        ),
+        migrations.CreateModel(
+            name='IdempotencyKey',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('endpoint', models.CharField(max_length=100)),
+                ('key', models.CharField(max_length=255)),
+                ('fingerprint', models.CharField(max_length=32)),
+                ('status', models.IntegerField()),
+                ('response', models.JSONField(encoder=django.core.serializers.json.DjangoJSONEncoder)),
+                ('created_at', models.DateTimeField()),
+            ],
+        ),
+        migrations.CreateModel(
+            name='LeaderboardEntry',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('board', models.CharField(max_length=50)),
+                ('owner_id', models.BigIntegerField()),
+                ('score', models.BigIntegerField(default=0)),
+                ('rows', models.BigIntegerField(default=0)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+            ],
+        ),
+        migrations.CreateModel(
+            name='Rating',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('name', models.CharField(max_length=50)),
+                ('owner_id', models.BigIntegerField()),
+                ('rating', models.FloatField()),
+                ('deviation', models.FloatField(blank=True, null=True)),
+                ('matches', models.IntegerField(default=0)),
+                ('period', models.BigIntegerField()),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+            ],
+        ),
+        migrations.CreateModel(
+            name='RatingCheckpoint',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('name', models.CharField(max_length=50, unique=True)),
+                ('params', models.CharField(max_length=32)),
+                ('period', models.BigIntegerField()),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+            ],
+        ),
+        migrations.CreateModel(
+            name='Rollup',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('rollup', models.CharField(max_length=50)),
+                ('grain', models.CharField(max_length=8)),
+                ('bucket', models.DateTimeField()),
+                ('dimensions', models.JSONField(default=dict)),
+                ('measure', models.CharField(blank=True, max_length=50)),
+                ('rows', models.BigIntegerField(default=0)),
+                ('total', models.FloatField(blank=True, null=True)),
+                ('minimum', models.FloatField(blank=True, null=True)),
+                ('maximum', models.FloatField(blank=True, null=True)),
+            ],
+        ),
+        migrations.CreateModel(
+            name='RollupWatermark',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('rollup', models.CharField(max_length=50, unique=True)),
+                ('watermark', models.DateTimeField(blank=True, null=True)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+            ],
+        ),
+        migrations.CreateModel(
+            name='TelemetryEvent',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('server', models.CharField(max_length=64)),
+                ('match_id', models.CharField(blank=True, default='', max_length=32)),
+                ('kind', models.CharField(max_length=32)),
+                ('time', models.DateTimeField()),
+                ('player', models.BigIntegerField(blank=True, null=True)),
+                ('x', models.FloatField(blank=True, null=True)),
+                ('y', models.FloatField(blank=True, null=True)),
+                ('z', models.FloatField(blank=True, null=True)),
+                ('value', models.FloatField(blank=True, null=True)),
+                ('data', models.JSONField(blank=True, null=True)),
+            ],
+            options={
+                'verbose_name': 'TelemetryEvent',
+                'verbose_name_plural': 'TelemetryEvents',
+            },
+        ),
+        migrations.AddField(
+            model_name='match',
+            name='duration',
+            field=adminpanel.fields.ComputedField(expression='end_time - start_time', output_field=models.DurationField()),
+        ),
+        migrations.AddField(
+            model_name='match',
+            name='loser',
+            field=models.ForeignKey(null=True, on_delete=django.db.models.deletion.DO_NOTHING, related_name='lost_matches', to='adminpanel.player'),
+        ),
+        migrations.AddField(
+            model_name='player',
+            name='matches_played',
+            field=models.IntegerField(default=0),
+        ),
+        adminpanel.operations.BuildIndexConcurrently(
+            model_name='guild',
+            index=models.Index(condition=models.Q(('is_active', True)), fields=['-id'], name='guild_active_id_934570_prt'),
+        ),
+        adminpanel.operations.BuildIndexConcurrently(
+            model_name='guild',
+            index=models.Index(fields=['created_at'], name='guild_created__f00915_idx'),
+        ),
+        adminpanel.operations.BuildIndexConcurrently(
+            model_name='guild',
+            index=django.contrib.postgres.indexes.GinIndex(django.contrib.postgres.indexes.OpClass(django.db.models.functions.text.Upper('name'), name='gin_trgm_ops'), name='guild_name_12e10d_trg'),
+        ),
+        adminpanel.operations.BuildIndexConcurrently(
+            model_name='guild',
+            index=django.contrib.postgres.indexes.GinIndex(django.contrib.postgres.indexes.OpClass(django.db.models.functions.text.Upper('description'), name='gin_trgm_ops'), name='guild_descript_0a63e9_trg'),
+        ),
+        adminpanel.operations.BuildIndexConcurrently(
+            model_name='item',
+            index=models.Index(fields=['rarity', 'value'], name='adminpanel__rarity_92aa77_idx'),
+        ),
+        adminpanel.operations.BuildIndexConcurrently(
+            model_name='item',
+            index=django.contrib.postgres.indexes.GinIndex(django.contrib.postgres.indexes.OpClass(django.db.models.functions.text.Upper('name'), name='gin_trgm_ops'), name='item_name_b93952_trg'),
+        ),
+        adminpanel.operations.BuildIndexConcurrently(
+            model_name='item',
+            index=django.contrib.postgres.indexes.GinIndex(django.contrib.postgres.indexes.OpClass(django.db.models.functions.text.Upper('description'), name='gin_trgm_ops'), name='item_descript_6066c0_trg'),
+        ),
+        adminpanel.operations.BuildIndexConcurrently(
+            model_name='item',
+            index=django.contrib.postgres.indexes.GinIndex(django.contrib.postgres.indexes.OpClass(django.db.models.functions.text.Upper('item_type'), name='gin_trgm_ops'), name='item_item_typ_766d0c_trg'),
+        ),
+        adminpanel.operations.BuildIndexConcurrently(
+            model_name='item',
+            index=django.contrib.postgres.indexes.GinIndex(django.contrib.postgres.indexes.OpClass(django.db.models.functions.text.Upper('rarity'), name='gin_trgm_ops'), name='item_rarity_c1458b_trg'),
+        ),
+        adminpanel.operations.BuildIndexConcurrently(
+            model_name='match',
+            index=models.Index(condition=models.Q(('end_time__isnull', True)), fields=['-id'], name='match_active_id_d58de5_prt'),
+        ),
+        adminpanel.operations.BuildIndexConcurrently(
+            model_name='match',
+            index=models.Index(fields=['start_time'], name='match_start_ti_88a0ac_idx'),
+        ),
+        adminpanel.operations.BuildIndexConcurrently(
+            model_name='match',
+            index=models.Index(fields=['end_time'], name='match_end_time_f1a8d1_idx'),
+        ),
+        adminpanel.operations.BuildIndexConcurrently(
+            model_name='match',
+            index=django.contrib.postgres.indexes.GinIndex(django.contrib.postgres.indexes.OpClass(django.db.models.functions.text.Upper('match_id'), name='gin_trgm_ops'), name='match_match_id_f4af4d_trg'),
+        ),
+        adminpanel.operations.BuildIndexConcurrently(
+            model_name='player',
+            index=models.Index(fields=['-created_at', '-id'], name='player_created__id_247e78_idx'),
+        ),
+        adminpanel.operations.BuildIndexConcurrently(
+            model_name='player',
+            index=django.contrib.postgres.indexes.GinIndex(django.contrib.postgres.indexes.OpClass(django.db.models.functions.text.Upper('username'), name='gin_trgm_ops'), name='player_username_f9c707_trg'),
+        ),
+        adminpanel.operations.BuildIndexConcurrently(
+            model_name='player',
+            index=django.contrib.postgres.indexes.GinIndex(django.contrib.postgres.indexes.OpClass(django.db.models.functions.text.Upper('email'), name='gin_trgm_ops'), name='player_email_23d495_trg'),
+        ),
+        migrations.AddIndex(
+            model_name='telemetryevent',
+            index=django.contrib.postgres.indexes.BrinIndex(fields=['time'], name='telemetr_time_ca5ffb_brn'),
+        ),
+        migrations.AddConstraint(
+            model_name='rollup',
+            constraint=models.UniqueConstraint(fields=('rollup', 'grain', 'measure', 'bucket', 'dimensions'), name='rollup_rollup_grain_f64135_unq'),
+        ),
+        migrations.AddIndex(
+            model_name='rating',
+            index=models.Index(fields=['name', 'rating'], name='rating_name_rating_1cc5ec_idx'),
+        ),
+        migrations.AddConstraint(
+            model_name='rating',
+            constraint=models.UniqueConstraint(fields=('name', 'owner_id'), name='rating_name_owner_i_1e047b_unq'),
+        ),
+        migrations.AddIndex(
+            model_name='leaderboardentry',
+            index=models.Index(fields=['board', '-score', 'owner_id'], name='leaderbo_board_scor_0d384a_idx'),
+        ),
+        migrations.AddConstraint(
+            model_name='leaderboardentry',
+            constraint=models.UniqueConstraint(fields=('board', 'owner_id'), name='leaderbo_board_owne_68203e_unq'),
+        ),
+        migrations.AddIndex(
+            model_name='idempotencykey',
+            index=models.Index(fields=['created_at'], name='idempote_created__e98244_idx'),
+        ),
+        migrations.AddConstraint(
+            model_name='idempotencykey',
+            constraint=models.UniqueConstraint(fields=('endpoint', 'key'), name='idempote_endpoint_k_7cb805_unq'),
+        ),
+        migrations.AddField(
+            model_name='guildmembercountshard',
+            name='owner',
+            field=models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='member_count_shards', to='adminpanel.guild'),
+        ),
+        migrations.AddIndex(
+            model_name='gameserver',
+            index=django.contrib.postgres.indexes.GinIndex(django.contrib.postgres.indexes.OpClass(django.db.models.functions.text.Upper('name'), name='gin_trgm_ops'), name='gameserv_name_7abac3_trg'),
+        ),
+        migrations.AddIndex(
+            model_name='gameserver',
+            index=django.contrib.postgres.indexes.GinIndex(django.contrib.postgres.indexes.OpClass(django.db.models.functions.text.Upper('host'), name='gin_trgm_ops'), name='gameserv_host_1edad0_trg'),
+        ),
+        migrations.AddIndex(
+            model_name='anomaly',
+            index=models.Index(fields=['detector', 'status'], name='anomaly_detector_st_e1a093_idx'),
+        ),
+        migrations.AddConstraint(
+            model_name='guildmembercountshard',
+            constraint=models.UniqueConstraint(fields=('owner', 'shard'), name='guildmem_owner_shar_cbb104_unq'),
+        ),
+        adminpanel.operations.PartitionTable(
+            model_name='TelemetryEvent',
+            field='time',
+            interval='day',
+            premake=2,
+        ),
+        adminpanel.operations.SyncLeaderboards(
+            model_name='Match',
+            boards={'wins': {'by': 'winner', 'sum': None}},
+        ),
+        adminpanel.operations.SyncRollups(
+            model_name='Match',
+            rollups={'matches': {'dimensions': [], 'measures': ['duration'], 'time': 'start_time'}},
+        ),
+        adminpanel.operations.SyncRollups(
+            model_name='TelemetryEvent',
+            rollups={'telemetry': {'dimensions': ['server', 'kind'], 'measures': ['value'], 'time': 'time'}},
+        ),
+    ]
@@ -0,0 +1,116 @@
+"""
+Multi-get for the generated ViewSets: many rows in one request and one query
+
+  /api/players/many/?ids=16,3,42
+  /api/players/many/?username=alice,bob
+
+Rows come back in request order, null where a key has no row:
+
+  {"results": [{...}, null, {...}], "missing": ["3"]}
+
+With OBJECT_CACHE_SECONDS > 0 the serialized rows are cached per key, and
+only the keys not in the cache are read, with a single IN query. Saves and
+deletes drop the cached entries of the row; nested related objects and
+renamed keys can be stale for up to OBJECT_CACHE_SECONDS.
+"""
+
+import hashlib
+import os
+
+from django.core.cache import cache
+from django.core.exceptions import ValidationError as DjangoValidationError
+from rest_framework.exceptions import ValidationError
+from rest_framework.response import Response
+
+from .fields import field_type
+
+# Most keys per request
+MULTIGET_MAX_IDS = int(os.getenv('MULTIGET_MAX_IDS', 100))
+
+# Lifetime of cached serialized rows, 0 disables the object cache
+OBJECT_CACHE_SECONDS = int(os.getenv('OBJECT_CACHE_SECONDS', 0))
+
+
+def natural_keys(model_name, model_config):
+    """
+    Unique non-relational fields of a model, served by lookup routes:
+    {route: field}. The route drops a "<model>_" prefix, so Match.match_id
+    is /api/matchs/by-id/<match_id>/ and Player.username /by-username/.
+    """
+    keys = {}
+    for name, field_def in model_config.get("fields", {}).items():
+        field_def_str = str(field_def)
+        if isinstance(field_def, dict) or 'unique=True' not in field_def_str or 'primary_key=True' in field_def_str:
+            continue
+        if field_type(field_def) in ['ForeignKey', 'OneToOneField', 'ManyToManyField']:
+            continue
+        prefix = f"{model_name.lower()}_"
+        route = name[len(prefix):] if name.startswith(prefix) and name != prefix else name
+        keys[f"by-{route.replace('_', '-')}"] = name
+    return keys
+
+
+def cache_key(model, field_name, value):
+    # Natural keys may hold characters cache backends reject in keys
+    return f"object:{model._meta.label_lower}:{field_name}:{hashlib.md5(str(value).encode()).hexdigest()}"
+
+
+def drop_cached(sender, instance, **kwargs):
+    """post_save/post_delete receiver: cached serializations of the row are outdated"""
+    if not OBJECT_CACHE_SECONDS or sender._meta.app_label != 'adminpanel':
+        return
+    keys = [cache_key(sender, 'pk', instance.pk)]
+    keys += [cache_key(sender, field.name, getattr(instance, field.attname))
+             for field in sender._meta.concrete_fields if field.unique and not field.primary_key]
+    cache.delete_many(keys)
+
+
+def related_queryset(queryset):
+    """The queryset with its forward relations joined and many-to-many fields prefetched"""
+    meta = queryset.model._meta
+    joined = [field.name for field in meta.concrete_fields if field.is_relation]
+    prefetched = [field.name for field in meta.many_to_many]
+    return queryset.select_related(*joined).prefetch_related(*prefetched)
+
+
+def requested_keys(request, natural_keys):
+    """(field name, raw keys) of ?ids= or one ?<natural key>="""
+    params = [param for param in ['ids'] + natural_keys if param in request.query_params]
+    if len(params) != 1:
+        raise ValidationError({'ids': f"Pass exactly one of {', '.join('?' + p + '=' for p in ['ids'] + natural_keys)}"})
+    raw = [key for key in request.query_params[params[0]].split(',') if key]
+    if not raw:
+        raise ValidationError({params[0]: 'Expected comma separated keys'})
+    if len(raw) > MULTIGET_MAX_IDS:
+        raise ValidationError({params[0]: f"At most {MULTIGET_MAX_IDS} keys"})
+    return ('pk' if params[0] == 'ids' else params[0]), raw
+
+
+def respond(view, request, natural_keys):
+    """Response of a many action: rows by pk or natural key, in request order"""
+    model = view.get_queryset().model
+    field_name, raw = requested_keys(request, natural_keys)
+    field = model._meta.pk if field_name == 'pk' else model._meta.get_field(field_name)
+    try:
+        keys = [field.to_python(key) for key in raw]
+    except DjangoValidationError as e:
+        raise ValidationError({'ids' if field_name == 'pk' else field_name: e.messages})
+
+    found = {}
+    if OBJECT_CACHE_SECONDS:
+        cached = cache.get_many([cache_key(model, field_name, key) for key in set(keys)])
+        found = {key: cached[cache_key(model, field_name, key)] for key in set(keys)
+                 if cache_key(model, field_name, key) in cached}
+    wanted = [key for key in set(keys) if key not in found]
+    if wanted:
+        rows = list(related_queryset(view.get_queryset()).filter(**{f"{field_name}__in": wanted}))
+        loaded = dict(zip((getattr(row, field.attname) for row in rows), view.get_serializer(rows, many=True).data))
+        if OBJECT_CACHE_SECONDS and loaded:
+            cache.set_many({cache_key(model, field_name, key): data for key, data in loaded.items()},
+                           OBJECT_CACHE_SECONDS)
+        found.update(loaded)
+
+    return Response({
+        'results': [found.get(key) for key in keys],
+        'missing': [raw_key for raw_key, key in zip(raw, keys) if key not in found],
+    })
@@ -0,0 +1,704 @@
+"""
+Custom migration operations used by generate_migrations.py
+Keeps schema changes on populated tables additive and non-blocking
+"""
+
+import copy
+import os
+import threading
+from contextlib import contextmanager
+
+from django.contrib.postgres.operations import AddIndexConcurrently, NotInTransactionMixin
+from django.db import connections, migrations, transaction
+from django.db.migrations.operations.base import Operation
+from django.db.models import NOT_PROVIDED
+
+from .leaderboards import board_columns, drop_trigger, install_trigger, rebuild_board
+from .partitions import (
+    DEFAULT_PREMAKE, INTERVALS, advance, create_partitions, existing_partitions, is_partitioned, truncate,
+)
+from .rollups import drop_triggers, install_triggers, reset_rollup, rollup_columns
+
+# Primary key range updated per backfill statement (each batch commits on its own)
+BACKFILL_BATCH_SIZE = int(os.getenv('MIGRATION_BACKFILL_BATCH_SIZE', 5000))
+
+# Maximum time a DDL statement may wait for its table lock
+LOCK_TIMEOUT = os.getenv('MIGRATION_LOCK_TIMEOUT', '5s')
+
+# Seconds between pg_stat_progress_create_index reports
+INDEX_PROGRESS_INTERVAL = float(os.getenv('MIGRATION_INDEX_PROGRESS_INTERVAL', 5))
+
+
+class AddFieldNonBlocking(migrations.AddField):
+    """
+    AddField for large, populated tables.
+    Adds the column as nullable without a default, backfills the default in
+    small primary key ranges and only then enforces NOT NULL through a
+    validated CHECK constraint, so no step holds an exclusive lock while
+    rewriting or scanning the table.
+    Must run in a non-atomic migration.
+    """
+
+    def __init__(self, model_name, name, field, preserve_default=True, batch_size=BACKFILL_BATCH_SIZE):
+        self.batch_size = batch_size
+        super().__init__(model_name, name, field, preserve_default)
+
+    def deconstruct(self):
+        name, args, kwargs = super().deconstruct()
+        if self.batch_size != BACKFILL_BATCH_SIZE:
+            kwargs['batch_size'] = self.batch_size
+        return self.__class__.__name__, args, kwargs
+
+    def database_forwards(self, app_label, schema_editor, from_state, to_state):
+        to_model = to_state.apps.get_model(app_label, self.model_name)
+        if not self.allow_migrate_model(schema_editor.connection.alias, to_model):
+            return
+        field = to_model._meta.get_field(self.name)
+        if schema_editor.connection.vendor != 'postgresql' or field.null:
+            return super().database_forwards(app_label, schema_editor, from_state, to_state)
+
+        from_model = from_state.apps.get_model(app_label, self.model_name)
+        quote = schema_editor.quote_name
+        table = to_model._meta.db_table
+        column = field.column
+        value = schema_editor.effective_default(field)
+
+        # 1. Nullable column without a default: catalog-only change, no table rewrite.
+        # With a default PostgreSQL would store it as a fast default and there would be nothing to backfill
+        nullable = copy.copy(field)
+        nullable.null = True
+        nullable.default = NOT_PROVIDED
+        schema_editor.execute(f"SET lock_timeout = '{LOCK_TIMEOUT}'")
+        schema_editor.add_field(from_model, nullable)
+
+        # 2. Backfill existing rows in small committed batches
+        self.backfill(schema_editor, table, to_model._meta.pk.column, column, value)
+
+        # 3. NOT NULL via a CHECK constraint validated without an exclusive lock
+        if value is not None:
+            check = schema_editor._create_index_name(table, [column], suffix='_notnull')
+            schema_editor.execute(
+                f"ALTER TABLE {quote(table)} ADD CONSTRAINT {quote(check)} "
+                f"CHECK ({quote(column)} IS NOT NULL) NOT VALID"
+            )
+            schema_editor.execute(f"ALTER TABLE {quote(table)} VALIDATE CONSTRAINT {quote(check)}")
+            schema_editor.execute(f"ALTER TABLE {quote(table)} ALTER COLUMN {quote(column)} SET NOT NULL")
+            schema_editor.execute(f"ALTER TABLE {quote(table)} DROP CONSTRAINT {quote(check)}")
+        schema_editor.execute("RESET lock_timeout")
+
+    def backfill(self, schema_editor, table, pk_column, column, value):
+        """Set the default on existing rows, one committed primary key range at a time"""
+        if value is None:
+            return
+        quote = schema_editor.quote_name
+        sql = (
+            f"UPDATE {quote(table)} SET {quote(column)} = %s "
+            f"WHERE {quote(pk_column)} > %s AND {quote(pk_column)} <= %s AND {quote(column)} IS NULL"
+        )
+        if schema_editor.collect_sql:
+            # sqlmigrate: show the statement once instead of looping
+            schema_editor.execute(sql, (value, 0, self.batch_size))
+            return
+        bounds = f"SELECT min({quote(pk_column)}), max({quote(pk_column)}) FROM {quote(table)}"
+        with schema_editor.connection.cursor() as cursor:
+            cursor.execute(bounds)
+            first, last = cursor.fetchone()
+        if first is None:
+            return
+        total = 0
+        done = first - 1
+        while done < last:
+            with schema_editor.connection.cursor() as cursor:
+                cursor.execute(sql, (value, done, done + self.batch_size))
+                total += cursor.rowcount
+            done += self.batch_size
+            if done >= last:
+                # Rows inserted meanwhile by code that does not know the column yet
+                with schema_editor.connection.cursor() as cursor:
+                    cursor.execute(bounds)
+                    last = cursor.fetchone()[1]
+        if total:
+            print(f"  Backfilled {total} rows of {table}.{column}")
+
+    def describe(self):
+        return f"Add field {self.name} to {self.model_name} (non-blocking)"
+
+
+class RetireField(migrations.RemoveField):
+    """
+    RemoveField that keeps the column and its data.
+    The field leaves the migration state, the column only loses NOT NULL so
+    inserts that no longer provide it keep working. Drop it by hand later.
+    """
+
+    def database_forwards(self, app_label, schema_editor, from_state, to_state):
+        from_model = from_state.apps.get_model(app_label, self.model_name)
+        if not self.allow_migrate_model(schema_editor.connection.alias, from_model):
+            return
+        field = from_model._meta.get_field(self.name)
+        if field.many_to_many or field.null:
+            return
+        quote = schema_editor.quote_name
+        schema_editor.execute(
+            f"ALTER TABLE {quote(from_model._meta.db_table)} "
+            f"ALTER COLUMN {quote(field.column)} DROP NOT NULL"
+        )
+
+    def database_backwards(self, app_label, schema_editor, from_state, to_state):
+        pass
+
+    def describe(self):
+        return f"Retire field {self.name} from {self.model_name} (column kept)"
+
+
+class RetireModel(migrations.DeleteModel):
+    """
+    DeleteModel that keeps the table and its data.
+    The model leaves the migration state only; drop the table by hand later.
+    """
+
+    def database_forwards(self, app_label, schema_editor, from_state, to_state):
+        pass
+
+    def database_backwards(self, app_label, schema_editor, from_state, to_state):
+        pass
+
+    def describe(self):
+        return f"Retire model {self.name} (table kept)"
+
+
+class RecreateComputedField(migrations.AlterField):
+    """
+    AlterField for computed columns, whose generation expression PostgreSQL
+    cannot change in place. Drops and re-adds the column, then recreates the
+    indexes that used it; no data is lost as the values are derived.
+    """
+
+    def database_forwards(self, app_label, schema_editor, from_state, to_state):
+        from_model = from_state.apps.get_model(app_label, self.model_name)
+        to_model = to_state.apps.get_model(app_label, self.model_name)
+        if not self.allow_migrate_model(schema_editor.connection.alias, to_model):
+            return
+        from_field = from_model._meta.get_field(self.name)
+        with schema_editor.connection.cursor() as cursor:
+            cursor.execute(
+                "SELECT DISTINCT pg_get_indexdef(i.indexrelid) FROM pg_index i "
+                "JOIN pg_depend d ON d.classid = 'pg_class'::regclass AND d.objid = i.indexrelid "
+                "JOIN pg_attribute a ON a.attrelid = d.refobjid AND a.attnum = d.refobjsubid "
+                "WHERE i.indrelid = %s::regclass AND a.attname = %s",
+                [from_model._meta.db_table, from_field.column],
+            )
+            # Indexes of partitioned tables are shown ON ONLY the parent
+            definitions = [row[0].replace(" ON ONLY ", " ON ") for row in cursor.fetchall()]
+        schema_editor.remove_field(from_model, from_field)
+        schema_editor.add_field(to_model, to_model._meta.get_field(self.name))
+        for definition in definitions:
+            schema_editor.execute(definition)
+
+    def describe(self):
+        return f"Recreate computed field {self.name} on {self.model_name}"
+
+
+class IndexBuildProgress(threading.Thread):
+    """Print pg_stat_progress_create_index for one backend while it builds an index"""
+
+    def __init__(self, alias, pid, label, interval=INDEX_PROGRESS_INTERVAL):
+        super().__init__(daemon=True)
+        self.alias = alias
+        self.pid = pid
+        self.label = label
+        self.interval = interval
+        self.finished = threading.Event()
+
+    def run(self):
+        # Connections are per thread, so this polls over its own session
+        connection = connections[self.alias]
+        try:
+            while not self.finished.wait(self.interval):
+                with connection.cursor() as cursor:
+                    cursor.execute(
+                        "SELECT phase, blocks_done, blocks_total, tuples_done, tuples_total "
+                        "FROM pg_stat_progress_create_index WHERE pid = %s",
+                        [self.pid],
+                    )
+                    row = cursor.fetchone()
+                if row:
+                    print(f"  {self.label}: {format_index_progress(*row)}")
+        except Exception as e:
+            print(f"  {self.label}: progress unavailable ({e})")
+        finally:
+            connection.close()
+
+    def stop(self):
+        self.finished.set()
+        self.join()
+
+
+def format_index_progress(phase, blocks_done, blocks_total, tuples_done, tuples_total):
+    if blocks_total:
+        return f"{phase} ({blocks_done}/{blocks_total} blocks, {100 * blocks_done // blocks_total}%)"
+    if tuples_total:
+        return f"{phase} ({tuples_done}/{tuples_total} tuples, {100 * tuples_done // tuples_total}%)"
+    return phase
+
+
+@contextmanager
+def index_build_progress(schema_editor, label):
+    """Report build progress of the index created inside the block"""
+    with schema_editor.connection.cursor() as cursor:
+        cursor.execute("SELECT pg_backend_pid()")
+        pid = cursor.fetchone()[0]
+    reporter = IndexBuildProgress(schema_editor.connection.alias, pid, label)
+    reporter.start()
+    try:
+        yield
+    finally:
+        reporter.stop()
+
+
+def index_is_valid(schema_editor, name):
+    """True/False for a valid/invalid index, None if it does not exist"""
+    with schema_editor.connection.cursor() as cursor:
+        cursor.execute(
+            "SELECT i.indisvalid FROM pg_index i "
+            "JOIN pg_class c ON c.oid = i.indexrelid WHERE c.relname = %s",
+            [name],
+        )
+        row = cursor.fetchone()
+    return row[0] if row else None
+
+
+class BuildIndexConcurrently(AddIndexConcurrently):
+    """
+    CREATE INDEX CONCURRENTLY with progress reporting.
+    An invalid index left behind by an interrupted build is dropped and
+    built again; an index that already exists and is valid is kept.
+    On partitioned tables the index is built concurrently per partition and
+    attached to an index created ON ONLY the parent.
+    """
+
+    def database_forwards(self, app_label, schema_editor, from_state, to_state):
+        self._ensure_not_in_transaction(schema_editor)
+        model = to_state.apps.get_model(app_label, self.model_name)
+        if not self.allow_migrate_model(schema_editor.connection.alias, model):
+            return
+        if schema_editor.collect_sql:
+            schema_editor.add_index(model, self.index, concurrently=True)
+            return
+
+        valid = index_is_valid(schema_editor, self.index.name)
+        if valid:
+            print(f"  Index {self.index.name} already exists and is valid")
+            return
+        with schema_editor.connection.cursor() as cursor:
+            partitions = is_partitioned(cursor, model._meta.db_table) and existing_partitions(cursor, model._meta.db_table)
+        if partitions:
+            return self.build_partitioned(model, schema_editor, [name for name, _, _ in partitions], valid is not None)
+        if valid is False:
+            print(f"  Index {self.index.name} is invalid (interrupted build), rebuilding")
+            schema_editor.remove_index(model, self.index, concurrently=True)
+
+        with index_build_progress(schema_editor, self.index.name):
+            schema_editor.add_index(model, self.index, concurrently=True)
+
+    def build_partitioned(self, model, schema_editor, partitions, resume):
+        """Build the index partition by partition; attached partitions are skipped on resume"""
+        quote = schema_editor.quote_name
+        parent = self.index.name
+        attached = set()
+        if resume:
+            with schema_editor.connection.cursor() as cursor:
+                cursor.execute(
+                    "SELECT t.relname FROM pg_inherits i JOIN pg_index x ON x.indexrelid = i.inhrelid "
+                    "JOIN pg_class t ON t.oid = x.indrelid WHERE i.inhparent = to_regclass(%s)",
+                    [parent],
+                )
+                attached = {row[0] for row in cursor.fetchall()}
+        else:
+            statement = self.index.create_sql(model, schema_editor)
+            statement.parts['table'] = f"ONLY {quote(model._meta.db_table)}"
+            schema_editor.execute(statement)
+
+        for partition in partitions:
+            if partition in attached:
+                continue
+            child = schema_editor._create_index_name(partition, [parent], suffix='_idx')
+            if index_is_valid(schema_editor, child) is False:
+                schema_editor.execute(f"DROP INDEX CONCURRENTLY {quote(child)}")
+            if not index_is_valid(schema_editor, child):
+                statement = self.index.create_sql(model, schema_editor, concurrently=True)
+                statement.parts['name'] = quote(child)
+                statement.parts['table'] = quote(partition)
+                with index_build_progress(schema_editor, child):
+                    schema_editor.execute(statement)
+            schema_editor.execute(f"ALTER INDEX {quote(parent)} ATTACH PARTITION {quote(child)}")
+
+
+class PartitionTable(NotInTransactionMixin, Operation):
+    """
+    Turn a model's table into a table range-partitioned by a timestamp field.
+    The existing table is attached as the partition holding every row before
+    the interval boundary after next, so no row is copied. Its partition bound and
+    the (pk, field) unique indexes are validated and built concurrently
+    beforehand; the swap itself only touches the catalog under a short lock.
+    Models with unique fields are refused: a unique constraint of a
+    partitioned table must include the partition field, so they would only
+    stay unique per timestamp.
+    Irreversible; must run in a non-atomic migration.
+    """
+
+    reversible = False
+
+    def __init__(self, model_name, field, interval='month', premake=DEFAULT_PREMAKE):
+        if interval not in INTERVALS:
+            raise ValueError(f"Partition interval must be one of {', '.join(INTERVALS)}")
+        self.model_name = model_name
+        self.field = field
+        self.interval = interval
+        self.premake = premake
+
+    def deconstruct(self):
+        kwargs = {'model_name': self.model_name, 'field': self.field, 'interval': self.interval}
+        if self.premake != DEFAULT_PREMAKE:
+            kwargs['premake'] = self.premake
+        return self.__class__.__name__, [], kwargs
+
+    def state_forwards(self, app_label, state):
+        pass
+
+    def database_forwards(self, app_label, schema_editor, from_state, to_state):
+        self._ensure_not_in_transaction(schema_editor)
+        model = to_state.apps.get_model(app_label, self.model_name)
+        if not self.allow_migrate_model(schema_editor.connection.alias, model) or schema_editor.collect_sql:
+            return
+        meta = model._meta
+        field = meta.get_field(self.field)
+        if field.null:
+            raise ValueError(f"Cannot partition {meta.label} by nullable field {self.field}")
+        if meta.related_objects:
+            # Foreign keys to a partitioned table must include the partition key
+            referenced_by = ", ".join(rel.related_model._meta.label for rel in meta.related_objects)
+            raise ValueError(f"Cannot partition {meta.label}, it is referenced by {referenced_by}")
+        unique = [f.name for f in meta.local_fields if f.unique and not f.primary_key]
+        if unique:
+            raise ValueError(f"Cannot partition {meta.label}, unique fields {', '.join(unique)} "
+                             f"would only be unique together with {self.field}")
+
+        connection = schema_editor.connection
+        quote = schema_editor.quote_name
+        table = meta.db_table
+        with connection.cursor() as cursor:
+            if is_partitioned(cursor, table):
+                print(f"  {table} is already partitioned")
+                return
+            cursor.execute(f"SELECT now(), max({quote(field.column)}) FROM {quote(table)}")
+            now, latest = cursor.fetchone()
+        # At least one whole interval ahead: the bound is checked on the live table from
+        # prepare() until the swap, inserts must not cross it while the index is built
+        boundary = advance(truncate(max(now, latest or now), self.interval), self.interval, 2)
+
+        check = self.prepare(schema_editor, meta, field, boundary)
+        with transaction.atomic(using=connection.alias):
+            self.swap(schema_editor, meta, field, boundary, check)
+            with connection.cursor() as cursor:
+                created = create_partitions(cursor, table, self.interval, boundary, self.premake)
+        print(f"  {table} partitioned by {field.column} ({self.interval}), "
+              f"existing rows kept in {table}_legacy, created {', '.join(created)}")
+
+    def prepare(self, schema_editor, meta, field, boundary):
+        """Validate the legacy bound and build the (pk, field) unique index without blocking"""
+        quote = schema_editor.quote_name
+        table = meta.db_table
+        column = field.column
+        check = schema_editor._create_index_name(table, [column], suffix='_bound')
+        schema_editor.execute(f"SET lock_timeout = '{LOCK_TIMEOUT}'")
+        schema_editor.execute(f"ALTER TABLE {quote(table)} DROP CONSTRAINT IF EXISTS {quote(check)}")
+        schema_editor.execute(
+            f"ALTER TABLE {quote(table)} ADD CONSTRAINT {quote(check)} "
+            f"CHECK ({quote(column)} IS NOT NULL AND {quote(column)} < %s) NOT VALID",
+            (boundary,),
+        )
+        schema_editor.execute(f"ALTER TABLE {quote(table)} VALIDATE CONSTRAINT {quote(check)}")
+        schema_editor.execute("RESET lock_timeout")
+
+        name = self.key_index_name(schema_editor, table, meta.pk, column)
+        if index_is_valid(schema_editor, name) is False:
+            schema_editor.execute(f"DROP INDEX CONCURRENTLY {quote(name)}")
+        with index_build_progress(schema_editor, name):
+            schema_editor.execute(
+                f"CREATE UNIQUE INDEX CONCURRENTLY IF NOT EXISTS {quote(name)} "
+                f"ON {quote(table)} ({quote(meta.pk.column)}, {quote(column)})"
+            )
+        return check
+
+    def swap(self, schema_editor, meta, field, boundary, check):
+        """Rename the table to its legacy partition and attach it under a new partitioned parent"""
+        quote = schema_editor.quote_name
+        table = meta.db_table
+        legacy = f"{table}_legacy"
+        pk = meta.pk.column
+        column = field.column
+
+        schema_editor.execute(f"SET LOCAL lock_timeout = '{LOCK_TIMEOUT}'")
+        schema_editor.execute(f"LOCK TABLE {quote(table)} IN ACCESS EXCLUSIVE MODE")
+        with schema_editor.connection.cursor() as cursor:
+            cursor.execute(
+                "SELECT conname, contype, pg_get_constraintdef(oid) FROM pg_constraint "
+                "WHERE conrelid = %s::regclass AND contype IN ('p', 'u', 'f')",
+                [table],
+            )
+            constraints = cursor.fetchall()
+            cursor.execute(
+                "SELECT c.relname, pg_get_indexdef(c.oid) FROM pg_index i "
+                "JOIN pg_class c ON c.oid = i.indexrelid "
+                "WHERE i.indrelid = %s::regclass AND NOT i.indisunique",
+                [table],
+            )
+            indexes = cursor.fetchall()
+            cursor.execute(f"SELECT coalesce(max({quote(pk)}), 0) + 1 FROM {quote(table)}")
+            next_id = cursor.fetchone()[0]
+            cursor.execute(
+                "SELECT attidentity <> '', pg_get_serial_sequence(%s, %s) FROM pg_attribute "
+                "WHERE attrelid = %s::regclass AND attname = %s",
+                [table, pk, table, pk],
+            )
+            identity, sequence = cursor.fetchone()
+
+        # Promote the (pk, partition field) index to the legacy table's primary key,
+        # ATTACH PARTITION then reuses it instead of building a new one
+        for name, kind, _ in constraints:
+            if kind in ('p', 'u'):
+                schema_editor.execute(f"ALTER TABLE {quote(table)} DROP CONSTRAINT {quote(name)}")
+        name = self.key_index_name(schema_editor, table, meta.pk, column)
+        schema_editor.execute(f"ALTER TABLE {quote(table)} ADD CONSTRAINT {quote(name)} PRIMARY KEY USING INDEX {quote(name)}")
+
+        # Partitions cannot have identity columns; ids keep counting from a plain sequence
+        if identity:
+            sequence = quote(f"{table}_{pk}_seq")
+            schema_editor.execute(f"ALTER TABLE {quote(table)} ALTER COLUMN {quote(pk)} DROP IDENTITY")
+            schema_editor.execute(f"CREATE SEQUENCE {sequence}")
+            schema_editor.execute("SELECT setval(%s, %s, false)", (sequence, next_id))
+            schema_editor.execute(
+                f"ALTER TABLE {quote(table)} ALTER COLUMN {quote(pk)} SET DEFAULT nextval(%s::regclass)",
+                (sequence,),
+            )
+
+        for name, _ in indexes:
+            schema_editor.execute(f"ALTER INDEX {quote(name)} RENAME TO {quote(name[:56] + '_legacy')}")
+        schema_editor.execute(f"ALTER TABLE {quote(table)} RENAME TO {quote(legacy)}")
+
+        schema_editor.execute(
+            f"CREATE TABLE {quote(table)} (LIKE {quote(legacy)} INCLUDING DEFAULTS INCLUDING CONSTRAINTS "
+            f"INCLUDING STORAGE) PARTITION BY RANGE ({quote(column)})"
+        )
+        schema_editor.execute(f"ALTER TABLE {quote(table)} DROP CONSTRAINT {quote(check)}")
+        if sequence:
+            schema_editor.execute(f"ALTER SEQUENCE {sequence} OWNED BY {quote(table)}.{quote(pk)}")
+
+        name = schema_editor._create_index_name(table, [pk, column], suffix='_pk')
+        schema_editor.execute(f"ALTER TABLE {quote(table)} ADD CONSTRAINT {quote(name)} PRIMARY KEY ({quote(pk)}, {quote(column)})")
+        for name, kind, definition in constraints:
+            if kind == 'f':
+                schema_editor.execute(f"ALTER TABLE {quote(table)} ADD CONSTRAINT {quote(name[:61] + '_p')} {definition}")
+        for _, definition in indexes:
+            # The definitions still name the original table, which is now the parent
+            schema_editor.execute(definition)
+
+        schema_editor.execute(
+            f"ALTER TABLE {quote(table)} ATTACH PARTITION {quote(legacy)} FOR VALUES FROM (MINVALUE) TO (%s)",
+            (boundary,),
+        )
+        schema_editor.execute(f"ALTER TABLE {quote(legacy)} DROP CONSTRAINT {quote(check)}")
+
+    @staticmethod
+    def key_index_name(schema_editor, table, key, column):
+        """Unique index on (key, partition field) built ahead of the swap"""
+        return schema_editor._create_index_name(table, [key.column, column], suffix='_part')
+
+    def describe(self):
+        return f"Partition {self.model_name} by {self.field} ({self.interval})"
+
+    @property
+    def migration_name_fragment(self):
+        return f"partition_{self.model_name.lower()}"
+
+
+class SetStorage(Operation):
+    """
+    Table storage options that Django models cannot express.
+    unlogged skips the WAL (faster writes, emptied after a crash, not
+    replicated) and rewrites the table under an exclusive lock when changed.
+    fillfactor leaves room in each page so updates stay HOT; it only applies
+    to pages written from then on. On partitioned tables the fillfactor is
+    set on every partition. Reverting restores the PostgreSQL defaults.
+    """
+
+    reduces_to_sql = False
+
+    def __init__(self, model_name, unlogged=False, fillfactor=None):
+        if fillfactor is not None and not 10 <= fillfactor <= 100:
+            raise ValueError("fillfactor must be between 10 and 100")
+        self.model_name = model_name
+        self.unlogged = unlogged
+        self.fillfactor = fillfactor
+
+    def deconstruct(self):
+        kwargs = {'model_name': self.model_name}
+        if self.unlogged:
+            kwargs['unlogged'] = True
+        if self.fillfactor is not None:
+            kwargs['fillfactor'] = self.fillfactor
+        return self.__class__.__name__, [], kwargs
+
+    def state_forwards(self, app_label, state):
+        pass
+
+    def database_forwards(self, app_label, schema_editor, from_state, to_state):
+        self.apply(app_label, schema_editor, to_state, self.unlogged, self.fillfactor)
+
+    def database_backwards(self, app_label, schema_editor, from_state, to_state):
+        self.apply(app_label, schema_editor, to_state, False, None)
+
+    def apply(self, app_label, schema_editor, state, unlogged, fillfactor):
+        model = state.apps.get_model(app_label, self.model_name)
+        if not self.allow_migrate_model(schema_editor.connection.alias, model):
+            return
+        meta = model._meta
+        quote = schema_editor.quote_name
+        table = meta.db_table
+        with schema_editor.connection.cursor() as cursor:
+            partitions = is_partitioned(cursor, table) and [name for name, _, _ in existing_partitions(cursor, table)]
+            cursor.execute("SELECT relpersistence = 'u' FROM pg_class WHERE oid = %s::regclass", [table])
+            is_unlogged = cursor.fetchone()[0]
+
+        if unlogged != is_unlogged:
+            if partitions:
+                raise ValueError(f"Cannot change {meta.label} to {'UN' if unlogged else ''}LOGGED, it is partitioned")
+            referencing = [rel.related_model._meta.label for rel in meta.related_objects]
+            if unlogged and referencing:
+                # Logged tables may only reference logged tables
+                raise ValueError(f"Cannot make {meta.label} UNLOGGED, it is referenced by {', '.join(referencing)}")
+            schema_editor.execute(f"SET lock_timeout = '{LOCK_TIMEOUT}'")
+            schema_editor.execute(f"ALTER TABLE {quote(table)} SET {'UNLOGGED' if unlogged else 'LOGGED'}")
+            schema_editor.execute("RESET lock_timeout")
+
+        storage = f"SET (fillfactor = {int(fillfactor)})" if fillfactor else "RESET (fillfactor)"
+        for name in partitions or [table]:
+            schema_editor.execute(f"ALTER TABLE {quote(name)} {storage}")
+
+    def describe(self):
+        options = ["UNLOGGED" if self.unlogged else "LOGGED"]
+        if self.fillfactor is not None:
+            options.append(f"fillfactor {self.fillfactor}")
+        return f"Set storage of {self.model_name} to {', '.join(options)}"
+
+    @property
+    def migration_name_fragment(self):
+        return f"storage_{self.model_name.lower()}"
+
+
+class SyncLeaderboards(Operation):
+    """
+    Installs the trigger that keeps the leaderboards of one source entity
+    up to date, replacing the previous one, and rebuilds those boards from
+    the table while writers wait. An empty boards dict only drops the
+    trigger. Runs after PartitionTable, so the trigger is on the partitioned
+    table. Reverting drops the trigger; the entries stay.
+    """
+
+    reduces_to_sql = False
+
+    def __init__(self, model_name, boards):
+        self.model_name = model_name
+        self.boards = boards
+
+    def deconstruct(self):
+        return self.__class__.__name__, [], {'model_name': self.model_name, 'boards': self.boards}
+
+    def state_forwards(self, app_label, state):
+        pass
+
+    def database_forwards(self, app_label, schema_editor, from_state, to_state):
+        model = to_state.apps.get_model(app_label, self.model_name)
+        if not self.allow_migrate_model(schema_editor.connection.alias, model):
+            return
+        table = model._meta.db_table
+        boards = board_columns(model, self.boards)
+        with transaction.atomic(using=schema_editor.connection.alias):
+            with schema_editor.connection.cursor() as cursor:
+                if not boards:
+                    drop_trigger(cursor, table)
+                    return
+                entry_table = to_state.apps.get_model(app_label, 'LeaderboardEntry')._meta.db_table
+                install_trigger(cursor, table, entry_table, boards)
+                for name, board in boards.items():
+                    entries = rebuild_board(cursor, name, table, entry_table, board)
+                    print(f"  Leaderboard {name}: {entries} entries")
+
+    def database_backwards(self, app_label, schema_editor, from_state, to_state):
+        model = from_state.apps.get_model(app_label, self.model_name)
+        with schema_editor.connection.cursor() as cursor:
+            drop_trigger(cursor, model._meta.db_table)
+
+    def describe(self):
+        return f"Sync leaderboards of {self.model_name} ({', '.join(self.boards) or 'none'})"
+
+    @property
+    def migration_name_fragment(self):
+        return f"leaderboards_{self.model_name.lower()}"
+
+
+class SyncRollups(Operation):
+    """
+    Installs the triggers that merge late and updated rows of one source
+    entity into its rollups, replacing the previous ones. The rollups in
+    reset changed definition: their rows and watermark are deleted and the
+    next refresh_rollups rebuilds them from the table. An empty rollups dict
+    only drops the triggers. Reverting drops the triggers; the rows stay.
+    """
+
+    reduces_to_sql = False
+
+    def __init__(self, model_name, rollups, reset=()):
+        self.model_name = model_name
+        self.rollups = rollups
+        self.reset = list(reset)
+
+    def deconstruct(self):
+        kwargs = {'model_name': self.model_name, 'rollups': self.rollups}
+        if self.reset:
+            kwargs['reset'] = self.reset
+        return self.__class__.__name__, [], kwargs
+
+    def state_forwards(self, app_label, state):
+        pass
+
+    def database_forwards(self, app_label, schema_editor, from_state, to_state):
+        model = to_state.apps.get_model(app_label, self.model_name)
+        if not self.allow_migrate_model(schema_editor.connection.alias, model):
+            return
+        table = model._meta.db_table
+        columns = {name: rollup_columns(model, rollup) for name, rollup in self.rollups.items()}
+        with transaction.atomic(using=schema_editor.connection.alias):
+            with schema_editor.connection.cursor() as cursor:
+                if not columns:
+                    drop_triggers(cursor, table)
+                    return
+                rollup_table = to_state.apps.get_model(app_label, 'Rollup')._meta.db_table
+                watermark_table = to_state.apps.get_model(app_label, 'RollupWatermark')._meta.db_table
+                install_triggers(cursor, table, rollup_table, watermark_table, columns)
+                for name in self.reset:
+                    reset_rollup(cursor, name, rollup_table, watermark_table)
+                    print(f"  Rollup {name}: reset, refresh_rollups rebuilds it")
+
+    def database_backwards(self, app_label, schema_editor, from_state, to_state):
+        model = from_state.apps.get_model(app_label, self.model_name)
+        with schema_editor.connection.cursor() as cursor:
+            drop_triggers(cursor, model._meta.db_table)
+
+    def describe(self):
+        return f"Sync rollups of {self.model_name} ({', '.join(self.rollups) or 'none'})"
+
+    @property
+    def migration_name_fragment(self):
+        return f"rollups_{self.model_name.lower()}"
@@ -0,0 +1,177 @@
+"""
+Range partition maintenance for entities declared with "partition_by"
+Creates partitions ahead of time and detaches or drops expired ones
+
+  "partition_by": {
+    "field": "start_time",
+    "interval": "month",   # day, week, month or year
+    "premake": 3,          # future partitions kept ready
+    "retain": 24,          # intervals of history to keep (omit to keep all)
+    "expire": "detach"     # or "drop"
+  }
+"""
+
+import json
+import os
+import re
+from datetime import datetime, timedelta, timezone
+
+from django.conf import settings
+
+INTERVALS = ('day', 'week', 'month', 'year')
+DEFAULT_PREMAKE = 3
+
+# Seconds between partition maintenance runs of run_maintenance
+PARTITION_MAINTENANCE_SECONDS = int(os.getenv('PARTITION_MAINTENANCE_SECONDS', 3600))
+
+BOUND_PATTERN = re.compile(r"FROM \((.+?)\) TO \((.+?)\)")
+
+
+def check_partitionable(model_name, model_config):
+    """
+    Reject partition_by specs PostgreSQL cannot honour as declared. A unique
+    constraint on a partitioned table must include the partition key, so a
+    unique field would only stay unique per timestamp.
+    """
+    spec = model_config['partition_by']
+    if spec.get('interval', 'month') not in INTERVALS:
+        raise ValueError(f"{model_name}: partition interval must be one of {', '.join(INTERVALS)}")
+    unique = [name for name, definition in model_config.get('fields', {}).items()
+              if isinstance(definition, str) and re.search(r"\bunique\s*=\s*True", definition)]
+    if unique:
+        raise ValueError(f"{model_name}: cannot partition an entity with unique fields ({', '.join(unique)}), "
+                         f"their uniqueness would only hold together with {spec['field']}")
+
+
+def partition_specs():
+    """{model_name: partition_by spec} for every partitioned entity in entities.json"""
+    config = json.loads(settings.DYNAMIC_MODELS_CONFIG['CONFIG_PATH'].read_text())
+    specs = {}
+    for model_name, model_config in config.items():
+        spec = model_config.get('partition_by')
+        if spec:
+            check_partitionable(model_name, model_config)
+            specs[model_name] = {'interval': 'month', 'premake': DEFAULT_PREMAKE, 'expire': 'detach', **spec,
+                                 'fillfactor': model_config.get('storage', {}).get('fillfactor')}
+    return specs
+
+
+def truncate(moment, interval):
+    """Start of the interval containing moment (UTC)"""
+    moment = moment.astimezone(timezone.utc).replace(hour=0, minute=0, second=0, microsecond=0)
+    if interval == 'week':
+        return moment - timedelta(days=moment.weekday())
+    if interval == 'month':
+        return moment.replace(day=1)
+    if interval == 'year':
+        return moment.replace(month=1, day=1)
+    return moment
+
+
+def advance(moment, interval, count=1):
+    """moment moved by count intervals"""
+    if interval == 'day':
+        return moment + timedelta(days=count)
+    if interval == 'week':
+        return moment + timedelta(weeks=count)
+    if interval == 'year':
+        return moment.replace(year=moment.year + count)
+    month = moment.month - 1 + count
+    return moment.replace(year=moment.year + month // 12, month=month % 12 + 1)
+
+
+def partition_name(table, start, interval):
+    if interval == 'year':
+        return f"{table}_p{start:%Y}"
+    if interval == 'month':
+        return f"{table}_p{start:%Y_%m}"
+    return f"{table}_p{start:%Y_%m_%d}"
+
+
+def is_partitioned(cursor, table):
+    cursor.execute("SELECT 1 FROM pg_partitioned_table WHERE partrelid = to_regclass(%s)", [table])
+    return cursor.fetchone() is not None
+
+
+def existing_partitions(cursor, table):
+    """[(name, lower, upper)] of attached partitions; None stands for MINVALUE/MAXVALUE"""
+    cursor.execute(
+        "SELECT c.relname, pg_get_expr(c.relpartbound, c.oid) FROM pg_inherits i "
+        "JOIN pg_class c ON c.oid = i.inhrelid WHERE i.inhparent = to_regclass(%s)",
+        [table],
+    )
+    partitions = []
+    for name, bound in cursor.fetchall():
+        match = BOUND_PATTERN.search(bound or "")
+        if match:
+            partitions.append((name, parse_bound(match.group(1)), parse_bound(match.group(2))))
+    return sorted(partitions, key=lambda p: p[1] or datetime.min.replace(tzinfo=timezone.utc))
+
+
+def parse_bound(value):
+    if value in ('MINVALUE', 'MAXVALUE'):
+        return None
+    return datetime.fromisoformat(value.strip("'")).astimezone(timezone.utc)
+
+
+def create_partitions(cursor, table, interval, start, count, dry_run=False, fillfactor=None):
+    """Create count partitions from start on; returns the names of new ones"""
+    quote = cursor.db.ops.quote_name
+    storage = f" WITH (fillfactor = {int(fillfactor)})" if fillfactor else ""
+    covered = {lower for _, lower, _ in existing_partitions(cursor, table)}
+    created = []
+    start = truncate(start, interval)
+    for _ in range(count):
+        end = advance(start, interval)
+        if start not in covered:
+            name = partition_name(table, start, interval)
+            if not dry_run:
+                cursor.execute(
+                    f"CREATE TABLE IF NOT EXISTS {quote(name)} PARTITION OF {quote(table)} "
+                    f"FOR VALUES FROM (%s) TO (%s){storage}",
+                    [start, end],
+                )
+            created.append(name)
+        start = end
+    return created
+
+
+def expired_partitions(cursor, table, cutoff):
+    """Partitions whose rows all lie before cutoff"""
+    return [name for name, _, upper in existing_partitions(cursor, table)
+            if upper is not None and upper <= cutoff]
+
+
+def maintain(connection, model, spec, now=None, dry_run=False):
+    """
+    Pre-create future partitions and expire old ones for one model.
+    Must run outside a transaction (DETACH ... CONCURRENTLY).
+    Returns (created, expired) partition names.
+    """
+    now = now or datetime.now(timezone.utc)
+    table = model._meta.db_table
+    interval = spec['interval']
+    quote = connection.ops.quote_name
+
+    with connection.cursor() as cursor:
+        if not is_partitioned(cursor, table):
+            return [], []
+        partitions = existing_partitions(cursor, table)
+        covered_until = max((upper for _, _, upper in partitions if upper), default=None)
+        # Start where coverage ends, so a lapsed schedule leaves no gaps
+        start = covered_until or truncate(now, interval)
+        wanted = advance(truncate(now, interval), interval, spec['premake'] + 1)
+        count = 0
+        while advance(start, interval, count) < wanted:
+            count += 1
+        created = create_partitions(cursor, table, interval, start, count, dry_run, spec['fillfactor'])
+
+        expired = []
+        if spec.get('retain'):
+            cutoff = advance(truncate(now, interval), interval, -spec['retain'])
+            expired = expired_partitions(cursor, table, cutoff)
+            for name in [] if dry_run else expired:
+                cursor.execute(f"ALTER TABLE {quote(table)} DETACH PARTITION {quote(name)} CONCURRENTLY")
+                if spec['expire'] == 'drop':
+                    cursor.execute(f"DROP TABLE {quote(name)}")
+    return created, expired
@@ -0,0 +1,296 @@
+"""
+Skill ratings computed from match outcomes, declared on the match entity
+
+  "Match": {
+    "ratings": {
+      "skill": {"winner": "winner", "loser": "loser", "time": "end_time",
+                "system": "glicko", "period": 3600}
+    }
+  }
+
+compute_ratings streams (time, winner, loser) of the rated rows in time order
+into NumPy arrays and applies one vectorized update per rating period: every
+match of a period is rated against the ratings at its start, as Glicko
+defines it, so results do not depend on how the rows are chunked.
+
+- elo: "k" (default 32), "initial" (1500)
+- glicko: "initial" (1500), "deviation" (350, also the maximum), "c" (34.6,
+  deviation growth per idle period)
+
+Ratings are stored in Rating, one row per rating and owner. RatingCheckpoint
+records the periods processed and the parameters used, so incremental runs
+only read the matches since then; changing a parameter needs a --full run.
+"""
+
+import hashlib
+import json
+import math
+import os
+import time
+from datetime import datetime, timezone as dt_timezone
+from functools import lru_cache
+from itertools import islice
+
+import numpy as np
+from django.apps import apps
+from django.conf import settings
+from django.db import transaction
+from django.db.models.functions import Extract
+from rest_framework import viewsets
+from rest_framework.exceptions import NotFound, ValidationError
+from rest_framework.response import Response
+
+# Rows fetched from the database per chunk
+RATING_CHUNK_SIZE = int(os.getenv('RATING_CHUNK_SIZE', 100000))
+
+# Periods are rated once they ended this many seconds ago, so late writes are included
+RATING_SETTLE_SECONDS = int(os.getenv('RATING_SETTLE_SECONDS', 60))
+
+# Most owners per ?owner= request
+RATING_MAX_OWNERS = int(os.getenv('RATING_MAX_OWNERS', 100))
+
+SYSTEMS = {
+    'elo': {'initial': 1500.0, 'k': 32.0},
+    'glicko': {'initial': 1500.0, 'deviation': 350.0, 'c': 34.6},
+}
+
+Q = math.log(10) / 400
+
+
+def source_ratings(model_name, model_config):
+    """Normalized ratings of one match entity, defaults filled in"""
+    fields = model_config.get("fields", {})
+    ratings = {}
+    for name, rating in model_config.get("ratings", {}).items():
+        system = rating.get("system", "elo")
+        if system not in SYSTEMS:
+            raise ValueError(f"{model_name}: rating '{name}' has unknown system '{system}'")
+        for role in ("winner", "loser"):
+            if 'ForeignKey' not in str(fields.get(rating.get(role))):
+                raise ValueError(f"{model_name}: rating '{name}' needs '{role}' naming a ForeignKey")
+        if 'DateTimeField' not in str(fields.get(rating.get("time"))):
+            raise ValueError(f"{model_name}: rating '{name}' needs 'time' naming a DateTimeField")
+        unknown = set(rating) - {"system", "winner", "loser", "time", "period"} - set(SYSTEMS[system])
+        if unknown:
+            raise ValueError(f"{model_name}: rating '{name}' has unknown parameters {', '.join(sorted(unknown))}")
+        ratings[name] = {
+            "system": system, "winner": rating["winner"], "loser": rating["loser"], "time": rating["time"],
+            "period": int(rating.get("period", 3600)),
+            **{key: float(rating.get(key, default)) for key, default in SYSTEMS[system].items()},
+        }
+    return ratings
+
+
+@lru_cache(maxsize=1)
+def rating_specs():
+    """{name: {'source': model_name, ...}} of all entities"""
+    config = json.loads(settings.DYNAMIC_MODELS_CONFIG['CONFIG_PATH'].read_text())
+    specs = {}
+    for model_name, model_config in config.items():
+        for name, rating in source_ratings(model_name, model_config).items():
+            if name in specs:
+                raise ValueError(f"Rating '{name}' is declared by {specs[name]['source']} and {model_name}")
+            specs[name] = {"source": model_name, **rating}
+    return specs
+
+
+def parameters_hash(spec):
+    return hashlib.md5(json.dumps(spec, sort_keys=True).encode()).hexdigest()
+
+
+def chunks(rows, size):
+    rows = iter(rows)
+    while chunk := list(islice(rows, size)):
+        yield chunk
+
+
+class Ratings:
+    """Ratings of the owners seen so far, as arrays sorted by owner id"""
+
+    def __init__(self, name, spec, stored):
+        self.name = name
+        self.spec = spec
+        self.stored = stored  # read existing Rating rows of new owners (incremental runs)
+        self.ids = np.empty(0, dtype=np.int64)
+        self.rating = np.empty(0)
+        self.deviation = np.empty(0)
+        self.matches = np.empty(0, dtype=np.int64)
+        self.period = np.empty(0, dtype=np.int64)  # last rated period, -1 if never
+        self.touched = np.empty(0, dtype=bool)
+
+    def add_owners(self, owner_ids):
+        new = np.setdiff1d(owner_ids, self.ids)
+        if not len(new):
+            return
+        rating = np.full(len(new), self.spec["initial"])
+        deviation = np.full(len(new), self.spec.get("deviation", np.nan))
+        matches = np.zeros(len(new), dtype=np.int64)
+        period = np.full(len(new), -1, dtype=np.int64)
+        if self.stored:
+            rows = apps.get_model('adminpanel', 'Rating').objects.filter(
+                name=self.name, owner_id__in=new.tolist(),
+            ).values_list('owner_id', 'rating', 'deviation', 'matches', 'period')
+            for owner_id, stored_rating, stored_deviation, stored_matches, stored_period in rows:
+                at = np.searchsorted(new, owner_id)
+                rating[at], matches[at], period[at] = stored_rating, stored_matches, stored_period
+                if stored_deviation is not None:
+                    deviation[at] = stored_deviation
+        order = np.argsort(np.concatenate([self.ids, new]), kind='stable')
+        self.ids = np.concatenate([self.ids, new])[order]
+        self.rating = np.concatenate([self.rating, rating])[order]
+        self.deviation = np.concatenate([self.deviation, deviation])[order]
+        self.matches = np.concatenate([self.matches, matches])[order]
+        self.period = np.concatenate([self.period, period])[order]
+        self.touched = np.concatenate([self.touched, np.zeros(len(new), dtype=bool)])[order]
+
+    def rate(self, period, winners, losers):
+        """Apply the matches of one period; winners and losers are owner ids"""
+        w = np.searchsorted(self.ids, winners)
+        l = np.searchsorted(self.ids, losers)
+        owners, side = np.unique(np.concatenate([w, l]), return_inverse=True)
+        if self.spec["system"] == 'elo':
+            expected = 1 / (1 + 10 ** ((self.rating[l] - self.rating[w]) / 400))
+            delta = self.spec["k"] * (1 - expected)
+            self.rating[owners] += np.bincount(side, np.concatenate([delta, -delta]), len(owners))
+        else:
+            self.glicko(period, owners, side, w, l)
+        self.matches[owners] += np.bincount(side, minlength=len(owners))
+        self.period[owners] = period
+        self.touched[owners] = True
+
+    def glicko(self, period, owners, side, w, l):
+        # Deviation grows with the periods an owner sat out
+        idle = np.where(self.period[owners] < 0, 0, period - self.period[owners])
+        self.deviation[owners] = np.minimum(
+            np.sqrt(self.deviation[owners] ** 2 + self.spec["c"] ** 2 * idle), self.spec["deviation"],
+        )
+        g_w = 1 / np.sqrt(1 + 3 * (Q * self.deviation[w] / math.pi) ** 2)
+        g_l = 1 / np.sqrt(1 + 3 * (Q * self.deviation[l] / math.pi) ** 2)
+        # Each match seen from both sides: opponent's g, expected and actual score
+        g = np.concatenate([g_l, g_w])
+        expected = np.concatenate([
+            1 / (1 + 10 ** (-g_l * (self.rating[w] - self.rating[l]) / 400)),
+            1 / (1 + 10 ** (-g_w * (self.rating[l] - self.rating[w]) / 400)),
+        ])
+        score = np.concatenate([np.ones(len(w)), np.zeros(len(l))])
+        d_inverse = Q ** 2 * np.bincount(side, g ** 2 * expected * (1 - expected), len(owners))
+        denominator = 1 / self.deviation[owners] ** 2 + d_inverse
+        self.rating[owners] += Q / denominator * np.bincount(side, g * (score - expected), len(owners))
+        self.deviation[owners] = np.sqrt(1 / denominator)
+
+    def objects(self, touched_only):
+        Rating = apps.get_model('adminpanel', 'Rating')
+        selected = np.flatnonzero(self.touched) if touched_only else np.arange(len(self.ids))
+        glicko = self.spec["system"] == 'glicko'
+        return [
+            Rating(name=self.name, owner_id=int(self.ids[i]), rating=float(self.rating[i]),
+                   deviation=float(self.deviation[i]) if glicko else None,
+                   matches=int(self.matches[i]), period=int(self.period[i]))
+            for i in selected
+        ]
+
+
+def rated_rows(spec, first_period, end_period):
+    """(epoch seconds, winner id, loser id) of the rated rows of [first_period, end_period), in time order"""
+    model = apps.get_model('adminpanel', spec["source"])
+    meta = model._meta
+    at = lambda period: datetime.fromtimestamp(period * spec["period"], dt_timezone.utc)
+    queryset = model.objects.filter(**{
+        f"{spec['winner']}__isnull": False, f"{spec['loser']}__isnull": False,
+        f"{spec['time']}__lt": at(end_period),
+    })
+    if first_period is not None:
+        queryset = queryset.filter(**{f"{spec['time']}__gte": at(first_period)})
+    return (
+        queryset.annotate(rating_epoch=Extract(spec["time"], 'epoch'))
+        .order_by(spec["time"])
+        .values_list('rating_epoch', meta.get_field(spec["winner"]).attname, meta.get_field(spec["loser"]).attname)
+        .iterator(chunk_size=RATING_CHUNK_SIZE)
+    )
+
+
+def compute(name, full=False):
+    """
+    Rate the matches of all complete periods since the checkpoint (all of
+    them if full) and store the ratings; returns a summary dict
+    """
+    spec = rating_specs()[name]
+    Rating = apps.get_model('adminpanel', 'Rating')
+    Checkpoint = apps.get_model('adminpanel', 'RatingCheckpoint')
+    params = parameters_hash(spec)
+    checkpoint = Checkpoint.objects.filter(name=name).first()
+    if checkpoint and not full and checkpoint.params != params:
+        raise ValueError(f"Parameters of rating '{name}' changed since the last run, recompute it with --full")
+    incremental = bool(checkpoint) and not full
+    first_period = checkpoint.period if incremental else None
+    end_period = (int(time.time()) - RATING_SETTLE_SECONDS) // spec["period"]
+
+    ratings = Ratings(name, spec, stored=incremental)
+    summary = {'matches': 0, 'periods': 0, 'first_period': first_period, 'end_period': end_period}
+    pending = np.empty((0, 3), dtype=np.int64)
+
+    def rate(rows):
+        rows = rows[rows[:, 1] != rows[:, 2]]
+        if not len(rows):
+            return
+        periods = rows[:, 0] // spec["period"]
+        ratings.add_owners(np.unique(rows[:, 1:]))
+        starts = np.flatnonzero(np.diff(periods)) + 1
+        for period_rows, period in zip(np.split(rows, starts), periods[np.r_[0, starts]]):
+            ratings.rate(int(period), period_rows[:, 1], period_rows[:, 2])
+        summary['matches'] += len(rows)
+        summary['periods'] += len(starts) + 1
+
+    for chunk in chunks(rated_rows(spec, first_period, end_period), RATING_CHUNK_SIZE):
+        rows = np.concatenate([pending, np.array(chunk, dtype=np.int64)])
+        # The last period may continue in the next chunk
+        last = np.searchsorted(rows[:, 0] // spec["period"], rows[-1, 0] // spec["period"])
+        rate(rows[:last])
+        pending = rows[last:]
+    rate(pending)
+
+    with transaction.atomic():
+        if incremental:
+            Rating.objects.bulk_create(
+                ratings.objects(touched_only=True), batch_size=5000, update_conflicts=True,
+                unique_fields=['name', 'owner_id'],
+                update_fields=['rating', 'deviation', 'matches', 'period', 'updated_at'],
+            )
+        else:
+            Rating.objects.filter(name=name).delete()
+            Rating.objects.bulk_create(ratings.objects(touched_only=False), batch_size=5000)
+        Checkpoint.objects.update_or_create(name=name, defaults={'params': params, 'period': end_period})
+    summary['owners'] = int(ratings.touched.sum())
+    return summary
+
+
+class RatingViewSet(viewsets.ViewSet):
+    """Ratings declared in entities.json: /api/ratings/<name>/?owner=1,2,3"""
+
+    lookup_field = 'name'
+
+    def list(self, request):
+        return Response({
+            name: {'source': spec['source'], 'system': spec['system'],
+                   'url': request.build_absolute_uri(f"{name}/")}
+            for name, spec in rating_specs().items()
+        })
+
+    def retrieve(self, request, name=None):
+        if name not in rating_specs():
+            raise NotFound(f"No rating named '{name}'")
+        owners = [owner for owner in request.query_params.get('owner', '').split(',') if owner]
+        if not owners or not all(owner.isdigit() for owner in owners):
+            raise ValidationError({'owner': 'Expected comma separated ids'})
+        if len(owners) > RATING_MAX_OWNERS:
+            raise ValidationError({'owner': f"At most {RATING_MAX_OWNERS} ids"})
+        rows = apps.get_model('adminpanel', 'Rating').objects.filter(name=name, owner_id__in=owners)
+        return Response({
+            'rating': name,
+            'results': [
+                {'owner': row.owner_id, 'rating': round(row.rating, 1),
+                 'deviation': None if row.deviation is None else round(row.deviation, 1),
+                 'matches': row.matches}
+                for row in rows.order_by('owner_id')
+            ],
+        })
@@ -0,0 +1,206 @@
+"""
+Retention policies for entities declared with "retention"
+Moves expired rows out in small batches with DELETE ... RETURNING, into an
+archive table or gzipped JSON lines, and backs off while replicas lag or
+the database is busy
+
+  "retention": {
+    "field": "start_time",
+    "days": 90,
+    "archive": "table",    # table (<table>_archive), file or none
+    "batch_size": 1000
+  }
+
+Every batch commits on its own and rows are selected by the policy alone,
+so a stopped run simply continues where it left off when started again.
+
+Purged rows count as history, not as corrections: each batch sets
+PURGE_SETTING, so the leaderboard triggers keep their scores, just as
+rollups keep the buckets of deleted rows.
+"""
+
+import gzip
+import json
+import os
+import time
+from datetime import datetime, timedelta, timezone
+from pathlib import Path
+
+from django.conf import settings
+from django.db import transaction
+
+ARCHIVE_MODES = ('table', 'file', 'none')
+
+# Rows moved per DELETE ... RETURNING statement
+RETENTION_BATCH_SIZE = int(os.getenv('RETENTION_BATCH_SIZE', 1000))
+
+# Pause between batches, in seconds
+RETENTION_BATCH_PAUSE = float(os.getenv('RETENTION_BATCH_PAUSE', 0.05))
+
+# Back off while replicas replay more than this many seconds behind
+RETENTION_MAX_REPLICATION_LAG = float(os.getenv('RETENTION_MAX_REPLICATION_LAG', 10))
+
+# Back off while more than this many other queries are running
+RETENTION_MAX_ACTIVE_QUERIES = int(os.getenv('RETENTION_MAX_ACTIVE_QUERIES', 20))
+
+# Where "file" archives are written, one directory per table
+RETENTION_ARCHIVE_DIR = Path(os.getenv('RETENTION_ARCHIVE_DIR', settings.BASE_DIR / 'archive'))
+
+# Seconds between apply_retention runs of run_maintenance, and the longest such run
+RETENTION_INTERVAL_SECONDS = int(os.getenv('RETENTION_INTERVAL_SECONDS', 3600))
+RETENTION_RUN_SECONDS = float(os.getenv('RETENTION_RUN_SECONDS', 600))
+
+# Transaction-local setting that marks deletes as retention purges for triggers
+PURGE_SETTING = 'adminpanel.retention_purge'
+
+
+def retention_policies():
+    """{model_name: retention policy} for every entity with a retention policy"""
+    config = json.loads(settings.DYNAMIC_MODELS_CONFIG['CONFIG_PATH'].read_text())
+    policies = {}
+    for model_name, model_config in config.items():
+        policy = model_config.get('retention')
+        if not policy:
+            continue
+        if 'field' not in policy or 'days' not in policy:
+            raise ValueError(f"{model_name}: retention needs a 'field' and 'days'")
+        if policy.get('archive', 'table') not in ARCHIVE_MODES:
+            raise ValueError(f"{model_name}: retention archive must be one of {', '.join(ARCHIVE_MODES)}")
+        policies[model_name] = {'archive': 'table', 'batch_size': RETENTION_BATCH_SIZE, **policy}
+    return policies
+
+
+def database_pressure(cursor):
+    """Reason to back off, or None while replicas keep up and the database is quiet"""
+    cursor.execute("SELECT coalesce(extract(epoch FROM max(replay_lag)), 0) FROM pg_stat_replication")
+    lag = cursor.fetchone()[0]
+    if lag > RETENTION_MAX_REPLICATION_LAG:
+        return f"replication lag {lag:.1f}s"
+    cursor.execute(
+        "SELECT count(*) FROM pg_stat_activity "
+        "WHERE state = 'active' AND backend_type = 'client backend' AND pid <> pg_backend_pid()"
+    )
+    active = cursor.fetchone()[0]
+    if active > RETENTION_MAX_ACTIVE_QUERIES:
+        return f"{active} active queries"
+    return None
+
+
+def ensure_archive_table(cursor, table, archive):
+    """Create the archive table, and add columns the live table gained since"""
+    quote = cursor.db.ops.quote_name
+    cursor.execute(f"CREATE TABLE IF NOT EXISTS {quote(archive)} (archived_at timestamptz NOT NULL DEFAULT now())")
+    cursor.execute(
+        "SELECT attname, format_type(atttypid, atttypmod) FROM pg_attribute "
+        "WHERE attrelid = %s::regclass AND attnum > 0 AND NOT attisdropped ORDER BY attnum",
+        [table],
+    )
+    columns = cursor.fetchall()
+    for name, column_type in columns:
+        cursor.execute(f"ALTER TABLE {quote(archive)} ADD COLUMN IF NOT EXISTS {quote(name)} {column_type}")
+    return [name for name, _ in columns]
+
+
+class RetentionRun:
+    """Moves the expired rows of one model, batch by batch"""
+
+    def __init__(self, connection, model, policy, now=None, dry_run=False):
+        self.connection = connection
+        self.model = model
+        self.policy = policy
+        self.dry_run = dry_run
+        self.table = model._meta.db_table
+        self.cutoff = (now or datetime.now(timezone.utc)) - timedelta(days=policy['days'])
+        self.column = model._meta.get_field(policy['field']).column
+        self.pk = model._meta.pk.column
+        self.moved = 0
+        self.started = None
+        self.archive_path = None
+
+    def expired_rows(self):
+        quote = self.connection.ops.quote_name
+        with self.connection.cursor() as cursor:
+            cursor.execute(f"SELECT count(*) FROM {quote(self.table)} WHERE {quote(self.column)} < %s", [self.cutoff])
+            return cursor.fetchone()[0]
+
+    def batch_sql(self, columns):
+        """One statement that deletes a batch and returns or archives it"""
+        quote = self.connection.ops.quote_name
+        table = quote(self.table)
+        pk = quote(self.pk)
+        delete = (
+            f"DELETE FROM {table} WHERE {pk} IN ("
+            f"SELECT {pk} FROM {table} WHERE {quote(self.column)} < %s "
+            f"LIMIT %s FOR UPDATE SKIP LOCKED)"
+        )
+        if self.policy['archive'] == 'table':
+            column_list = ", ".join(quote(c) for c in columns)
+            return (f"WITH moved AS ({delete} RETURNING {column_list}) "
+                    f"INSERT INTO {quote(self.table + '_archive')} ({column_list}) SELECT {column_list} FROM moved")
+        if self.policy['archive'] == 'file':
+            return f"{delete} RETURNING row_to_json({table}.*)::text"
+        return delete
+
+    def run(self, max_seconds=None, report_every=10):
+        """Move expired rows until none are left or max_seconds passed; returns rows moved"""
+        self.started = time.monotonic()
+        if self.dry_run:
+            self.moved = self.expired_rows()
+            return self.moved
+
+        columns = None
+        if self.policy['archive'] == 'table':
+            with self.connection.cursor() as cursor:
+                columns = ensure_archive_table(cursor, self.table, self.table + '_archive')
+        if self.policy['archive'] == 'file':
+            directory = RETENTION_ARCHIVE_DIR / self.table
+            directory.mkdir(parents=True, exist_ok=True)
+            self.archive_path = directory / f"{datetime.now(timezone.utc):%Y%m%d-%H%M%S}.jsonl.gz"
+
+        sql = self.batch_sql(columns)
+        last_report = self.started
+        batch_size = self.policy['batch_size']
+        while True:
+            if max_seconds and time.monotonic() - self.started >= max_seconds:
+                break
+            self.wait_for_headroom()
+            moved = self.move_batch(sql, batch_size)
+            self.moved += moved
+            if time.monotonic() - last_report >= report_every:
+                print(f"  {self.table}: {self.moved} rows, {self.rate():.0f} rows/s")
+                last_report = time.monotonic()
+            if moved < batch_size:
+                break
+            time.sleep(RETENTION_BATCH_PAUSE)
+        return self.moved
+
+    def move_batch(self, sql, batch_size):
+        with transaction.atomic(using=self.connection.alias):
+            with self.connection.cursor() as cursor:
+                cursor.execute("SELECT set_config(%s, 'on', true)", [PURGE_SETTING])
+                cursor.execute(sql, [self.cutoff, batch_size])
+                if self.policy['archive'] != 'file':
+                    return cursor.rowcount
+                rows = [row[0] for row in cursor.fetchall()]
+            if rows:
+                # Each batch is its own gzip member and reaches disk before the delete commits
+                with open(self.archive_path, 'ab') as archive:
+                    archive.write(gzip.compress(("\n".join(rows) + "\n").encode()))
+                    archive.flush()
+                    os.fsync(archive.fileno())
+            return len(rows)
+
+    def wait_for_headroom(self):
+        delay = 1
+        while True:
+            with self.connection.cursor() as cursor:
+                reason = database_pressure(cursor)
+            if not reason:
+                return
+            print(f"  {self.table}: backing off {delay}s ({reason})")
+            time.sleep(delay)
+            delay = min(delay * 2, 60)
+
+    def rate(self):
+        elapsed = time.monotonic() - self.started
+        return self.moved / elapsed if elapsed else 0
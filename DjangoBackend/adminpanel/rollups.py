@@ -0,0 +1,551 @@
+"""
+Time-series rollups declared on their source entity in entities.json
+
+  "Match": {
+    "rollups": {
+      "matches": {"time": "start_time", "measures": ["duration"]}
+    }
+  },
+  "TelemetryEvent": {
+    "rollups": {
+      "telemetry": {"time": "time", "dimensions": ["server", "kind"], "measures": ["value"],
+                    "keep": {"minute": 30, "hour": 400}}
+    }
+  }
+
+Rollup holds aggregates per minute, hour and day (UTC), one row per bucket,
+dimension values and measure: rows (the values that are not NULL), total,
+minimum and maximum; the measure '' counts the source rows.
+
+refresh_rollups, run every minute, moves the watermark of each rollup to
+the minute "delay" seconds (default 60) ago. Minute rows up to it are
+aggregated from the source table, hour rows from minute rows and day rows
+from hour rows once complete. Buckets below the watermark are closed: rows
+written into them later (late data, and updates such as a match getting its
+duration when it finishes) are merged by statement-level triggers on the
+source table, in the writing transaction. Counts and totals stay exact;
+minima and maxima take in new values but keep values updated away.
+
+Deletes are not rolled up, so retention and dropped partitions thin out
+the raw table without changing the rollups; "keep" (days per grain,
+default 30 for minute and 400 for hour rows) prunes the rollups themselves.
+The stats actions answer from the rollups when the request buckets by time
+or bounds it (or asks with ?source=rollup) and the parameters allow it,
+reading the source table only after the watermark. Other requests, a bare
+count among them, run on the source table, so they reflect deletes.
+"""
+
+import json
+import os
+import re
+import zlib
+from datetime import timedelta
+from functools import lru_cache
+
+from django.apps import apps
+from django.conf import settings
+from django.db import connection, transaction
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+
+from .filters import parse_value, value_field
+from .stats import STATS_MAX_GROUPS, split
+
+# Most source time a refresh aggregates per transaction; writers wait for each one
+ROLLUP_REFRESH_CHUNK = timedelta(hours=int(os.getenv('ROLLUP_REFRESH_CHUNK_HOURS', 24)))
+
+GRAINS = ('minute', 'hour', 'day')
+WIDTHS = {'minute': timedelta(minutes=1), 'hour': timedelta(hours=1), 'day': timedelta(days=1)}
+DEFAULT_KEEP = {'minute': 30, 'hour': 400, 'day': None}
+
+MEASURE_TYPES = ('IntegerField', 'BigIntegerField', 'SmallIntegerField', 'PositiveIntegerField',
+                 'PositiveSmallIntegerField', 'FloatField', 'DecimalField', 'DurationField')
+INTEGER_TYPES = ('IntegerField', 'BigIntegerField', 'SmallIntegerField', 'PositiveIntegerField',
+                 'PositiveSmallIntegerField')
+DIMENSION_TYPES = ('CharField', 'TextField', 'SlugField', 'EmailField', 'BooleanField', 'ForeignKey',
+                   'IntegerField', 'BigIntegerField', 'SmallIntegerField', 'PositiveIntegerField')
+
+# Grain whose rows a stats bucket is computed from
+BUCKET_GRAINS = {'minute': 'minute', 'hour': 'hour', 'day': 'day', 'week': 'day', 'month': 'day', 'year': 'day'}
+
+TRIGGER_NAMES = ('rollups_insert', 'rollups_update')
+
+MERGE_SQL = (
+    "ON CONFLICT (rollup, grain, measure, bucket, dimensions) DO UPDATE SET rows = r.rows + EXCLUDED.rows, "
+    "total = CASE WHEN EXCLUDED.total IS NULL THEN r.total ELSE coalesce(r.total, 0) + EXCLUDED.total END, "
+    "minimum = least(r.minimum, EXCLUDED.minimum), maximum = greatest(r.maximum, EXCLUDED.maximum)"
+)
+
+
+def source_rollups(model_name, model_config):
+    """Normalized rollups of one source entity: {name: {'time', 'dimensions', 'measures', 'delay', 'keep'}}"""
+    fields = model_config.get("fields", {})
+    rollups = {}
+    for name, rollup in model_config.get("rollups", {}).items():
+        if not re.fullmatch(r'[a-z][a-z0-9_]{0,49}', name):
+            raise ValueError(f"{model_name}: rollup name '{name}' must be lowercase letters, digits and _")
+        if rollup.get("time") not in fields:
+            raise ValueError(f"{model_name}: rollup '{name}' needs 'time' naming a DateTimeField")
+        for field_name in rollup.get("dimensions", []) + rollup.get("measures", []):
+            if field_name not in fields:
+                raise ValueError(f"{model_name}: rollup '{name}' names unknown field '{field_name}'")
+        keep = {**DEFAULT_KEEP, **rollup.get("keep", {})}
+        if set(keep) != set(GRAINS) or (keep["minute"] or 2) < 2 or (keep["hour"] or 2) < 2:
+            raise ValueError(f"{model_name}: rollup '{name}' keeps minute and hour rows at least 2 days")
+        rollups[name] = {
+            "time": rollup["time"],
+            "dimensions": list(rollup.get("dimensions", [])),
+            "measures": list(rollup.get("measures", [])),
+            "delay": int(rollup.get("delay", 60)),
+            "keep": keep,
+        }
+    return rollups
+
+
+@lru_cache(maxsize=1)
+def rollup_specs():
+    """{name: {'source': model_name, 'partitioned': bool, ...}} of all entities"""
+    config = json.loads(settings.DYNAMIC_MODELS_CONFIG['CONFIG_PATH'].read_text())
+    specs = {}
+    for model_name, model_config in config.items():
+        for name, rollup in source_rollups(model_name, model_config).items():
+            if name in specs:
+                raise ValueError(f"Rollup '{name}' is declared by {specs[name]['source']} and {model_name}")
+            partition_field = model_config.get("partition_by", {}).get("field")
+            specs[name] = {"source": model_name, "partitioned": partition_field == rollup["time"], **rollup}
+    return specs
+
+
+def lock_key(name):
+    """Advisory lock a refresh holds exclusively and writers of the source table shared"""
+    return zlib.crc32(f"rollup:{name}".encode())
+
+
+def rollup_columns(model, rollup):
+    """A rollup with its column names resolved on the source model"""
+    meta = model._meta
+    time = meta.get_field(rollup["time"])
+    if time.get_internal_type() != 'DateTimeField':
+        raise ValueError(f"{model.__name__}: rollup time '{time.name}' must be a DateTimeField")
+    dimensions = {}
+    for name in rollup["dimensions"]:
+        field = meta.get_field(name)
+        if field.get_internal_type() not in DIMENSION_TYPES:
+            raise ValueError(f"{model.__name__}: rollup dimension '{name}' must be text, an integer, "
+                             f"a boolean or a foreign key")
+        dimensions[name] = {"column": field.column, "type": field.get_internal_type()}
+    measures = {}
+    for name in rollup["measures"]:
+        field = meta.get_field(name)
+        if field.get_internal_type() not in MEASURE_TYPES:
+            raise ValueError(f"{model.__name__}: rollup measure '{name}' must be a number or a duration")
+        measures[name] = {"column": field.column, "type": field.get_internal_type()}
+    return {**rollup, "time": time.column, "dimensions": dimensions, "measures": measures}
+
+
+def dimension_type(columns, name):
+    """SQL type a dimension value is read back as from the dimensions object"""
+    return {'BooleanField': 'boolean', 'CharField': 'text', 'TextField': 'text', 'SlugField': 'text',
+            'EmailField': 'text'}.get(columns["dimensions"][name]["type"], 'bigint')
+
+
+def dimensions_sql(columns, alias):
+    quote = connection.ops.quote_name
+    if not columns["dimensions"]:
+        return "'{}'::jsonb"
+    pairs = ", ".join(f"'{name}', {alias}.{quote(dimension['column'])}"
+                      for name, dimension in columns["dimensions"].items())
+    return f"jsonb_build_object({pairs})"
+
+
+def measures_sql(columns, alias, names=None):
+    """LATERAL VALUES with the row count ('', 1) and each measure as double precision: m(measure, v)"""
+    quote = connection.ops.quote_name
+    values = ["('', 1::float8)"]
+    for name, measure in columns["measures"].items():
+        if names is not None and name not in names:
+            continue
+        column = f"{alias}.{quote(measure['column'])}"
+        value = f"extract(epoch FROM {column})::float8" if measure["type"] == 'DurationField' else f"{column}::float8"
+        values.append(f"('{name}', {value})")
+    return f"CROSS JOIN LATERAL (VALUES {', '.join(values)}) AS m(measure, v)"
+
+
+def source_columns(columns):
+    """Source columns a rollup reads"""
+    quote = connection.ops.quote_name
+    names = [columns["time"], *(d["column"] for d in columns["dimensions"].values()),
+             *(m["column"] for m in columns["measures"].values())]
+    return ", ".join(quote(name) for name in dict.fromkeys(names))
+
+
+def trigger_function_sql(function, rollup_table, watermark_table, rollups, changed):
+    """
+    PL/pgSQL statement trigger function merging the changed rows that fall
+    into closed buckets; changed(columns) is the SQL of (sign, columns...)
+    """
+    quote = connection.ops.quote_name
+    blocks = []
+    for name, columns in rollups.items():
+        time = f"c.{quote(columns['time'])}"
+        blocks.append(f"""
+  PERFORM pg_advisory_xact_lock_shared({lock_key(name)});
+  SELECT watermark INTO wm FROM {quote(watermark_table)} WHERE rollup = '{name}';
+  IF wm IS NOT NULL THEN
+    INSERT INTO {quote(rollup_table)} AS r (rollup, grain, bucket, dimensions, measure, rows, total, minimum, maximum)
+    SELECT '{name}', g.grain, date_trunc(g.grain, {time}, 'UTC'), {dimensions_sql(columns, 'c')}, m.measure,
+      sum(c.sign * (m.v IS NOT NULL)::int), sum(c.sign * m.v),
+      min(m.v) FILTER (WHERE c.sign = 1), max(m.v) FILTER (WHERE c.sign = 1)
+    FROM ({changed(source_columns(columns))}) AS c
+    {measures_sql(columns, 'c')}
+    CROSS JOIN (VALUES ('minute', interval '1 minute'), ('hour', interval '1 hour'), ('day', interval '1 day'))
+      AS g(grain, width)
+    WHERE {time} < wm AND date_trunc(g.grain, {time}, 'UTC') + g.width <= wm
+    GROUP BY 2, 3, 4, 5 ORDER BY 2, 3, 4, 5
+    {MERGE_SQL};
+  END IF;""")
+    return (f"CREATE OR REPLACE FUNCTION {quote(function)}() RETURNS trigger LANGUAGE plpgsql AS $$\n"
+            f"DECLARE wm timestamptz;\nBEGIN{''.join(blocks)}\n  RETURN NULL;\nEND\n$$")
+
+
+def drop_triggers(cursor, table):
+    """Drop the triggers from the table and from the partition it became when it was partitioned"""
+    quote = connection.ops.quote_name
+    cursor.execute(
+        "SELECT t.tgname, c.relname FROM pg_trigger t JOIN pg_class c ON c.oid = t.tgrelid "
+        "WHERE t.tgname = ANY(%s) AND (c.oid = %s::regclass "
+        "OR c.oid IN (SELECT inhrelid FROM pg_inherits WHERE inhparent = %s::regclass))",
+        [list(TRIGGER_NAMES), table, table],
+    )
+    for trigger, relname in cursor.fetchall():
+        cursor.execute(f"DROP TRIGGER {quote(trigger)} ON {quote(relname)}")
+    for trigger in TRIGGER_NAMES:
+        cursor.execute(f"DROP FUNCTION IF EXISTS {quote(f'{table}_{trigger}')}()")
+
+
+def install_triggers(cursor, table, rollup_table, watermark_table, rollups):
+    """Statement triggers for inserts and updates; the rows they change arrive as transition tables"""
+    quote = connection.ops.quote_name
+    drop_triggers(cursor, table)
+    if not rollups:
+        return
+    inserted = lambda columns: f"SELECT 1 AS sign, {columns} FROM new_rows"
+    # Rows whose rolled-up columns did not change cancel out
+    updated = lambda columns: (
+        f"SELECT 1 AS sign, * FROM (SELECT {columns} FROM new_rows EXCEPT ALL SELECT {columns} FROM old_rows) AS n "
+        f"UNION ALL "
+        f"SELECT -1, * FROM (SELECT {columns} FROM old_rows EXCEPT ALL SELECT {columns} FROM new_rows) AS o"
+    )
+    for trigger, changed, event, referencing in (
+        ('rollups_insert', inserted, 'INSERT', 'NEW TABLE AS new_rows'),
+        ('rollups_update', updated, 'UPDATE', 'OLD TABLE AS old_rows NEW TABLE AS new_rows'),
+    ):
+        function = f"{table}_{trigger}"
+        cursor.execute(trigger_function_sql(function, rollup_table, watermark_table, rollups, changed))
+        cursor.execute(
+            f"CREATE TRIGGER {quote(trigger)} AFTER {event} ON {quote(table)} REFERENCING {referencing} "
+            f"FOR EACH STATEMENT EXECUTE FUNCTION {quote(function)}()"
+        )
+
+
+def reset_rollup(cursor, name, rollup_table, watermark_table):
+    """Forget a rollup; the next refresh rebuilds it from the rows still in the source table"""
+    quote = connection.ops.quote_name
+    cursor.execute(f"DELETE FROM {quote(rollup_table)} WHERE rollup = %s", [name])
+    cursor.execute(f"DELETE FROM {quote(watermark_table)} WHERE rollup = %s", [name])
+
+
+def floor(moment, grain):
+    moment = moment.astimezone(timezone.utc).replace(second=0, microsecond=0)
+    if grain in ('hour', 'day'):
+        moment = moment.replace(minute=0)
+    if grain == 'day':
+        moment = moment.replace(hour=0)
+    return moment
+
+
+def close_buckets(cursor, name, columns, table, rollup_table, start, end):
+    """Aggregate the source rows of [start, end) into minute rows, and complete hours and days; returns rows written"""
+    quote = connection.ops.quote_name
+    time = f"c.{quote(columns['time'])}"
+    cursor.execute(
+        f"INSERT INTO {quote(rollup_table)} AS r (rollup, grain, bucket, dimensions, measure, rows, total, minimum, "
+        f"maximum) "
+        f"SELECT %s, 'minute', date_trunc('minute', {time}, 'UTC'), {dimensions_sql(columns, 'c')}, m.measure, "
+        f"count(m.v), sum(m.v), min(m.v), max(m.v) "
+        f"FROM {quote(table)} AS c {measures_sql(columns, 'c')} "
+        f"WHERE {time} >= %s AND {time} < %s GROUP BY 3, 4, 5 ORDER BY 3, 4, 5 {MERGE_SQL}",
+        [name, start, end],
+    )
+    written = cursor.rowcount
+    for grain, finer in (('hour', 'minute'), ('day', 'hour')):
+        low, high = floor(start, grain), floor(end, grain)
+        if high <= low:
+            continue
+        cursor.execute(
+            f"INSERT INTO {quote(rollup_table)} AS r (rollup, grain, bucket, dimensions, measure, rows, total, "
+            f"minimum, maximum) "
+            f"SELECT rollup, %s, date_trunc(%s, bucket, 'UTC'), dimensions, measure, sum(rows), sum(total), "
+            f"min(minimum), max(maximum) FROM {quote(rollup_table)} "
+            f"WHERE rollup = %s AND grain = %s AND bucket >= %s AND bucket < %s "
+            f"GROUP BY 1, 3, 4, 5 ORDER BY 3, 4, 5 {MERGE_SQL}",
+            [grain, grain, name, finer, low, high],
+        )
+        written += cursor.rowcount
+    return written
+
+
+def refresh(name, now=None):
+    """
+    Move a rollup's watermark to the minute "delay" seconds before now, one
+    chunk per transaction; returns (old watermark, new watermark, rows
+    written, rows pruned)
+    """
+    spec = rollup_specs()[name]
+    model = apps.get_model('adminpanel', spec["source"])
+    columns = rollup_columns(model, spec)
+    table = model._meta.db_table
+    rollup_table = apps.get_model('adminpanel', 'Rollup')._meta.db_table
+    watermark_table = apps.get_model('adminpanel', 'RollupWatermark')._meta.db_table
+    quote = connection.ops.quote_name
+    target = floor((now or timezone.now()) - timedelta(seconds=spec["delay"]), 'minute')
+
+    first = None
+    written = 0
+    while True:
+        with transaction.atomic(), connection.cursor() as cursor:
+            # Waits for the writers of the source table and holds new ones until commit, so a row
+            # is either merged by the triggers or read here
+            cursor.execute("SELECT pg_advisory_xact_lock(%s)", [lock_key(name)])
+            cursor.execute(
+                f"INSERT INTO {quote(watermark_table)} (rollup, watermark, updated_at) VALUES (%s, NULL, now()) "
+                f"ON CONFLICT (rollup) DO NOTHING", [name],
+            )
+            cursor.execute(f"SELECT watermark FROM {quote(watermark_table)} WHERE rollup = %s", [name])
+            watermark = cursor.fetchone()[0]
+            first = watermark if first is None else first
+            time = quote(columns["time"])
+            cursor.execute(f"SELECT min({time}) FROM {quote(table)} WHERE {time} < %s"
+                           + (f" AND {time} >= %s" if watermark else ""),
+                           [target, watermark] if watermark else [target])
+            earliest = cursor.fetchone()[0]
+            start = watermark or (floor(earliest, 'minute') if earliest else target)
+            if start >= target:
+                if watermark is None:
+                    cursor.execute(f"UPDATE {quote(watermark_table)} SET watermark = %s, updated_at = now() "
+                                   f"WHERE rollup = %s", [target, name])
+                    first = target
+                break
+            # Skip stretches without rows
+            end = min(target, max(start, floor(earliest, 'minute') if earliest else target) + ROLLUP_REFRESH_CHUNK)
+            written += close_buckets(cursor, name, columns, table, rollup_table, start, end)
+            cursor.execute(f"UPDATE {quote(watermark_table)} SET watermark = %s, updated_at = now() "
+                           f"WHERE rollup = %s", [end, name])
+        if end >= target:
+            break
+
+    pruned = 0
+    with connection.cursor() as cursor:
+        for grain, days in spec["keep"].items():
+            if days:
+                cursor.execute(
+                    f"DELETE FROM {quote(rollup_table)} WHERE rollup = %s AND grain = %s AND bucket < %s",
+                    [name, grain, target - timedelta(days=days)],
+                )
+                pruned += cursor.rowcount
+    return first, target, written, pruned
+
+
+def parse_moment(value):
+    moment = parse_datetime(value)
+    if moment is not None and timezone.is_naive(moment):
+        moment = timezone.make_aware(moment)
+    return moment
+
+
+def aligned(moment, grain):
+    return moment is None or floor(moment, grain) == moment
+
+
+def plan(model, spec, params):
+    """How a rollup answers a stats request, None when it cannot"""
+    columns = rollup_columns(model, spec)
+    aggregates = {}
+    for item in split(params.get('aggregate')):
+        measure, _, function = item.rpartition('__')
+        if measure not in columns["measures"] or function not in ('sum', 'avg', 'min', 'max'):
+            return None
+        aggregates[item] = (measure, function)
+    groups = {}
+    for name in split(params.get('group_by')):
+        if name not in columns["dimensions"]:
+            return None
+        groups[name] = ('dimension', name)
+    grain = 'day'
+    for item in split(params.get('bucket')):
+        field_name, _, kind = item.rpartition('__')
+        stride = re.fullmatch(r'([1-9]\d{0,3})(minute|hour)', kind)
+        if field_name != spec["time"] or (kind not in BUCKET_GRAINS and not stride):
+            return None
+        needed = stride.group(2) if stride else BUCKET_GRAINS[kind]
+        grain = min(grain, needed, key=GRAINS.index)
+        groups[item] = ('bin', timedelta(**{f"{stride.group(2)}s": int(stride.group(1))})) if stride else \
+            ('trunc', kind)
+
+    low = high = None
+    filters = {}
+    for param, raw in params.items():
+        if param in ('aggregate', 'group_by', 'bucket', 'format'):
+            continue
+        if param in (f"{spec['time']}__gte", 'since') and (param != 'since' or spec["partitioned"]):
+            low = parse_moment(raw)
+            if low is None:
+                return None
+        elif param in (f"{spec['time']}__lt", 'until') and (param != 'until' or spec["partitioned"]):
+            high = parse_moment(raw)
+            if high is None:
+                return None
+        elif param in columns["dimensions"]:
+            try:
+                filters[param] = parse_value(value_field(model, param), 'exact', raw)
+            except Exception:
+                return None
+        else:
+            return None
+    while not (aligned(low, grain) and aligned(high, grain)):
+        if grain == 'minute':
+            return None
+        grain = GRAINS[GRAINS.index(grain) - 1]
+    return {"columns": columns, "aggregates": aggregates, "groups": groups, "grain": grain,
+            "keep": spec["keep"][grain], "low": low, "high": high, "filters": filters}
+
+
+def answer(model, params):
+    """
+    Result of a stats request computed from a rollup of the entity, in the
+    shape stats.compute() returns; None when no rollup can answer it or the
+    request neither buckets nor bounds the rollup's time and does not ask
+    for ?source=rollup
+    """
+    source = params.get('source')
+    if source == 'raw':
+        return None
+    params = {key: value for key, value in params.items() if key != 'source'}
+    for name, spec in rollup_specs().items():
+        if spec["source"] != model.__name__:
+            continue
+        query = plan(model, spec, params)
+        if query is None:
+            continue
+        if source != 'rollup' and not (params.get('bucket') or query["low"] or query["high"]):
+            continue
+        result = run(name, model, query)
+        if result is not None:
+            return result
+    return None
+
+
+def run(name, model, query):
+    quote = connection.ops.quote_name
+    columns = query["columns"]
+    rollup_table = apps.get_model('adminpanel', 'Rollup')._meta.db_table
+    watermark_table = apps.get_model('adminpanel', 'RollupWatermark')._meta.db_table
+    with connection.cursor() as cursor:
+        cursor.execute(f"SELECT watermark FROM {quote(watermark_table)} WHERE rollup = %s", [name])
+        row = cursor.fetchone()
+        if row is None or row[0] is None:
+            return None
+        watermark = row[0]
+
+        low, high = query["low"], query["high"]
+        if query["keep"] and (low is None or low < watermark - timedelta(days=query["keep"])):
+            # Older rows of this grain are pruned
+            return None
+        measures = [''] + sorted({measure for measure, _ in query["aggregates"].values()})
+        containment = json.dumps(query["filters"])
+        # Coarsest rows for the oldest part, finer ones up to the watermark
+        edges = {'day': floor(watermark, 'day'), 'hour': floor(watermark, 'hour'), 'minute': watermark}
+        tiers = GRAINS[:GRAINS.index(query["grain"]) + 1]
+        parts = []
+        params = []
+        start = low
+        for grain in reversed(tiers):
+            end = edges[grain] if high is None else min(edges[grain], high)
+            if start is not None and end <= start:
+                continue
+            parts.append(
+                f"SELECT bucket, dimensions, measure, rows, total, minimum, maximum FROM {quote(rollup_table)} "
+                f"WHERE rollup = %s AND grain = %s AND measure = ANY(%s) AND bucket < %s"
+                + (" AND bucket >= %s" if start is not None else "")
+                + (" AND dimensions @> %s::jsonb" if query["filters"] else "")
+            )
+            params += [name, grain, measures, end] + ([start] if start is not None else []) + (
+                [containment] if query["filters"] else [])
+            start = end
+        if high is None or high > watermark:
+            time = f"c.{quote(columns['time'])}"
+            conditions = [f"{time} >= %s"] + ([f"{time} < %s"] if high is not None else [])
+            params_tail = [max(watermark, low) if low else watermark] + ([high] if high is not None else [])
+            for dimension, value in query["filters"].items():
+                conditions.append(f"c.{quote(columns['dimensions'][dimension]['column'])} = %s")
+                params_tail.append(value)
+            parts.append(
+                f"SELECT date_trunc('minute', {time}, 'UTC'), {dimensions_sql(columns, 'c')}, m.measure, "
+                f"count(m.v), sum(m.v), min(m.v), max(m.v) "
+                f"FROM {quote(model._meta.db_table)} AS c {measures_sql(columns, 'c', measures)} "
+                f"WHERE {' AND '.join(conditions)} GROUP BY 1, 2, 3"
+            )
+            params += params_tail
+
+        keys = []
+        selects = []
+        for key, (kind, value) in query["groups"].items():
+            keys.append(key)
+            if kind == 'dimension':
+                selects.append(f"(dimensions ->> '{value}')::{dimension_type(columns, value)}")
+            elif kind == 'bin':
+                selects.append("date_bin(%s, bucket, TIMESTAMPTZ '2000-01-01 00:00:00+00')")
+                params.append(value)
+            else:
+                selects.append(f"date_trunc('{value}', bucket, 'UTC')")
+        selects.append("coalesce(sum(rows) FILTER (WHERE measure = ''), 0)::bigint")
+        for item, (measure, function) in query["aggregates"].items():
+            only = f"FILTER (WHERE measure = '{measure}')"
+            selects.append({
+                'sum': f"sum(total) {only}",
+                'avg': f"sum(total) {only} / nullif(sum(rows) {only}, 0)",
+                'min': f"min(minimum) {only}",
+                'max': f"max(maximum) {only}",
+            }[function])
+        positions = ", ".join(str(position) for position in range(1, len(keys) + 1))
+        if not parts:
+            parts.append("SELECT NULL::timestamptz, NULL::jsonb, NULL::text, NULL::bigint, NULL::float8, "
+                         "NULL::float8, NULL::float8 WHERE false")
+        sql = (f"WITH r (bucket, dimensions, measure, rows, total, minimum, maximum) AS "
+               f"({' UNION ALL '.join(parts)}) SELECT {', '.join(selects)} FROM r")
+        if keys:
+            sql += f" GROUP BY {positions} ORDER BY {positions} LIMIT {STATS_MAX_GROUPS + 1}"
+        cursor.execute(sql, params)
+        rows = cursor.fetchall()
+
+    results = []
+    for row in rows:
+        result = dict(zip(keys, row[:len(keys)]))
+        result['count'] = row[len(keys)]
+        for (item, (measure, function)), value in zip(query["aggregates"].items(), row[len(keys) + 1:]):
+            result[item] = convert(columns["measures"][measure]["type"], function, value)
+        results.append(result)
+    if not keys:
+        return results[0]
+    return {'groups': results[:STATS_MAX_GROUPS], 'truncated': len(results) > STATS_MAX_GROUPS}
+
+
+def convert(field_type, function, value):
+    """An aggregate of double precision values as the source field type would give it"""
+    if value is None:
+        return None
+    if field_type == 'DurationField':
+        return timedelta(seconds=value)
+    if field_type in INTEGER_TYPES and function != 'avg':
+        return int(round(value))
+    return value
@@ -0,0 +1,427 @@
+"""
+Local spool for finish actions declared with "spool": true in entities.json
+
+  "Match": {"finish": {"lookup": "match_id", ..., "spool": true}}
+
+When the database is unreachable, a finish request that passed validation
+is appended to a SQLite journal (SPOOL_PATH, on the backend's volume) and
+answered with 202 instead of failing. Its end time is fixed at that moment
+and it carries an idempotency key: the client's Idempotency-Key, or one
+generated for it. A drainer thread replays the journal in id order once the
+database is back, SPOOL_BATCH entries per Postgres transaction, each entry
+in its own savepoint and through the same statements as a live finish,
+stored response included. Entries leave the journal only after their batch
+committed; replaying an entry whose batch committed before a crash finds
+its stored response and is counted as already applied.
+
+Entries the database refuses (unknown row, already finished, invalid
+values) stay in the journal marked failed, with the error, for inspection.
+An entry whose replay raises anything else moves to the dead_letters table
+with the error, and the rest of its batch goes on.
+The health endpoint reports the spool depth and the drain rate.
+
+Spooled finish actions authenticate with AUTHENTICATION_CLASSES: session
+and token authentication that remember the user of each credential they
+accept. While the database is unreachable, a credential accepted in the
+last SPOOL_SESSION_SECONDS keeps authenticating as that user; any other
+gets 503. Logging out, and saving or deleting the user, forgets it, but a
+session revoked during the outage keeps working until the database is back
+or its time is up.
+"""
+
+import json
+import os
+import sqlite3
+import threading
+import time
+import uuid
+from collections import OrderedDict, deque
+from pathlib import Path
+
+from django.conf import settings
+from django.db import InterfaceError, OperationalError, connection, transaction
+from django.utils.module_loading import import_string
+from rest_framework import status
+from rest_framework.authentication import SessionAuthentication, TokenAuthentication, get_authorization_header
+from rest_framework.exceptions import APIException
+from rest_framework.response import Response
+
+# SQLite journal of spooled requests
+SPOOL_PATH = Path(os.getenv('SPOOL_PATH', settings.BASE_DIR / 'spool' / 'finish.sqlite3'))
+
+# Entries replayed per Postgres transaction
+SPOOL_BATCH = int(os.getenv('SPOOL_BATCH', 200))
+
+# Entries the journal holds before requests are refused with 503
+SPOOL_MAX_ENTRIES = int(os.getenv('SPOOL_MAX_ENTRIES', 100000))
+
+# Seconds a seen session or token keeps authenticating while the database is unreachable
+SPOOL_SESSION_SECONDS = int(os.getenv('SPOOL_SESSION_SECONDS', 900))
+
+# Most sessions and tokens remembered per process, least recently used ones are forgotten first
+SPOOL_SESSION_MAX = int(os.getenv('SPOOL_SESSION_MAX', 10000))
+
+# Errors that mean the database cannot be reached, rather than that it refused the request
+UNAVAILABLE = (OperationalError, InterfaceError)
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS entries (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    endpoint TEXT NOT NULL,
+    key TEXT NOT NULL,
+    fingerprint TEXT NOT NULL,
+    view TEXT NOT NULL,
+    lookup TEXT NOT NULL,
+    data TEXT NOT NULL,
+    spec TEXT NOT NULL,
+    spooled_at REAL NOT NULL,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    failed INTEGER NOT NULL DEFAULT 0,
+    error TEXT,
+    UNIQUE (endpoint, key)
+);
+CREATE TABLE IF NOT EXISTS dead_letters (
+    id INTEGER PRIMARY KEY,
+    endpoint TEXT NOT NULL,
+    key TEXT NOT NULL,
+    fingerprint TEXT NOT NULL,
+    view TEXT NOT NULL,
+    lookup TEXT NOT NULL,
+    data TEXT NOT NULL,
+    spec TEXT NOT NULL,
+    spooled_at REAL NOT NULL,
+    error TEXT NOT NULL,
+    dead_at REAL NOT NULL
+);
+-- Rows in entries, kept by triggers so appending does not count them
+CREATE TABLE IF NOT EXISTS depth (entries INTEGER NOT NULL);
+INSERT INTO depth SELECT count(*) FROM entries WHERE NOT EXISTS (SELECT 1 FROM depth);
+CREATE TRIGGER IF NOT EXISTS entries_added AFTER INSERT ON entries
+BEGIN UPDATE depth SET entries = entries + 1; END;
+CREATE TRIGGER IF NOT EXISTS entries_removed AFTER DELETE ON entries
+BEGIN UPDATE depth SET entries = entries - 1; END;
+"""
+
+
+class Refused(Exception):
+    """The database answered the replay with an error response; the entry cannot succeed"""
+
+
+class Spool:
+    """The journal of one process, and the thread that drains it"""
+
+    def __init__(self, path):
+        self.path = path
+        path.parent.mkdir(parents=True, exist_ok=True)
+        self.db = sqlite3.connect(str(path), timeout=30, isolation_level=None, check_same_thread=False)
+        # WAL with synchronous=FULL: an entry is on disk before its 202 is sent
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=FULL")
+        self.db.executescript(f"BEGIN IMMEDIATE; {SCHEMA} COMMIT;")
+        self.lock = threading.Lock()
+        # Held for a whole batch, so the drain command and the thread never replay the same batch at once
+        self.drain_lock = threading.Lock()
+        self.wakeup = threading.Event()
+        self.drainer = None
+        self.counters = {
+            'spooled': 0, 'respooled': 0, 'refused': 0, 'replayed': 0, 'already_applied': 0, 'failed': 0,
+            'dead_lettered': 0, 'batches': 0, 'drain_failures': 0,
+        }
+        self.last_drain = {'entries': 0, 'seconds': 0.0}
+        # (time, entries) of recent batches, for the drain rate
+        self.recent = deque()
+
+    def append(self, endpoint, key, fingerprint, view, lookup, data, spec):
+        """Journal a request; returns (id, whether it was new), or None when the journal is full"""
+        with self.lock:
+            row = self.db.execute("SELECT id, fingerprint FROM entries WHERE endpoint = ? AND key = ?",
+                                  (endpoint, key)).fetchone()
+            if row is not None:
+                self.counters['respooled'] += 1
+                return row[0], row[1] == fingerprint
+            if self.db.execute("SELECT entries FROM depth").fetchone()[0] >= SPOOL_MAX_ENTRIES:
+                self.counters['refused'] += 1
+                return None
+            cursor = self.db.execute(
+                "INSERT INTO entries (endpoint, key, fingerprint, view, lookup, data, spec, spooled_at) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                (endpoint, key, fingerprint, view, lookup, data, json.dumps(spec), time.time()),
+            )
+            self.counters['spooled'] += 1
+        self.start()
+        self.wakeup.set()
+        return cursor.lastrowid, True
+
+    def start(self):
+        """Start the drainer thread once per process"""
+        with self.lock:
+            if self.drainer is None:
+                self.drainer = threading.Thread(target=self.run, name='spool-drainer', daemon=True)
+                self.drainer.start()
+
+    def run(self):
+        failures = 0
+        while True:
+            # Back off up to 30 seconds while the database is unreachable
+            self.wakeup.wait(min(2 ** failures, 30))
+            self.wakeup.clear()
+            try:
+                self.drain()
+                failures = 0
+            except Exception as e:
+                failures = min(failures + 1, 16)
+                self.counters['drain_failures'] += 1
+                print(f"Spool drain failed, retrying: {e}")
+                connection.close()
+
+    def drain(self):
+        """Replay batches until no pending entry is left; returns the number of entries replayed"""
+        total = 0
+        while True:
+            with self.drain_lock:
+                done = self.replay_batch()
+            total += done
+            if done < SPOOL_BATCH:
+                return total
+
+    def replay_batch(self):
+        with self.lock:
+            entries = self.db.execute(
+                "SELECT id, endpoint, key, fingerprint, view, lookup, data, spec FROM entries "
+                "WHERE failed = 0 ORDER BY id LIMIT ?", (SPOOL_BATCH,),
+            ).fetchall()
+        if not entries:
+            return 0
+        from .finishing import replay
+
+        connection.close_if_unusable_or_obsolete()
+        began = time.monotonic()
+        outcomes = {}
+        dead = {}
+        views = {}
+        with transaction.atomic():
+            # Foreign keys are deferred to COMMIT by default; checked per statement, an entry naming a
+            # missing row fails in its own savepoint instead of failing the whole batch on every retry
+            with connection.cursor() as cursor:
+                cursor.execute("SET CONSTRAINTS ALL IMMEDIATE")
+            for entry_id, endpoint, key, fingerprint, view, lookup, data, spec in entries:
+                try:
+                    if view not in views:
+                        views[view] = import_string(view)(request=None, format_kwarg=None, kwargs={},
+                                                          action='finish')
+                    with transaction.atomic():
+                        outcomes[entry_id] = replay(views[view], lookup, json.loads(data), json.loads(spec),
+                                                    endpoint, key, fingerprint)
+                except Refused as e:
+                    outcomes[entry_id] = str(e)
+                except UNAVAILABLE:
+                    raise
+                except Exception as e:
+                    # Rolled back to its savepoint; the rest of the batch goes on
+                    dead[entry_id] = f"{type(e).__name__}: {e}"
+        # Committed: the journal may forget the batch
+        replayed = [entry_id for entry_id, outcome in outcomes.items() if outcome == 'replayed']
+        applied = [entry_id for entry_id, outcome in outcomes.items() if outcome == 'already_applied']
+        failed = {entry_id: outcome for entry_id, outcome in outcomes.items()
+                  if outcome not in ('replayed', 'already_applied')}
+        with self.lock:
+            self.db.execute("BEGIN IMMEDIATE")
+            self.db.executemany("DELETE FROM entries WHERE id = ?", [(i,) for i in replayed + applied])
+            self.db.executemany("UPDATE entries SET failed = 1, attempts = attempts + 1, error = ? WHERE id = ?",
+                                [(error, i) for i, error in failed.items()])
+            now = time.time()
+            self.db.executemany(
+                "INSERT OR REPLACE INTO dead_letters SELECT id, endpoint, key, fingerprint, view, lookup, data, spec, "
+                "spooled_at, ?, ? FROM entries WHERE id = ?", [(error, now, i) for i, error in dead.items()],
+            )
+            self.db.executemany("DELETE FROM entries WHERE id = ?", [(i,) for i in dead])
+            self.db.execute("COMMIT")
+            self.counters['replayed'] += len(replayed)
+            self.counters['already_applied'] += len(applied)
+            self.counters['failed'] += len(failed)
+            self.counters['dead_lettered'] += len(dead)
+            self.counters['batches'] += 1
+            self.recent.append((now, len(entries)))
+            while self.recent and self.recent[0][0] < now - 60:
+                self.recent.popleft()
+        for entry_id, error in failed.items():
+            print(f"Spooled request {entry_id} refused by the database, kept as failed: {error}")
+        for entry_id, error in dead.items():
+            print(f"Spooled request {entry_id} could not be replayed, moved to dead_letters: {error}")
+        self.last_drain = {'entries': len(entries), 'seconds': round(time.monotonic() - began, 4)}
+        return len(entries)
+
+    def stats(self):
+        with self.lock:
+            pending, failed, oldest = self.db.execute(
+                "SELECT count(*) FILTER (WHERE failed = 0), count(*) FILTER (WHERE failed = 1), "
+                "min(spooled_at) FILTER (WHERE failed = 0) FROM entries"
+            ).fetchone()
+            dead = self.db.execute("SELECT count(*) FROM dead_letters").fetchone()[0]
+            now = time.time()
+            recent = sum(entries for moment, entries in self.recent if moment >= now - 60)
+        return {
+            **self.counters,
+            'depth': pending,
+            'failed_entries': failed,
+            'dead_letters': dead,
+            'oldest_seconds': round(now - oldest, 1) if oldest else 0.0,
+            'drained_per_second': round(recent / 60, 2),
+            'last_drain': self.last_drain,
+            'draining': self.drainer is not None,
+        }
+
+
+spool = None
+spool_lock = threading.Lock()
+resumed = False
+
+
+def get_spool():
+    """The process's spool; entries left by a previous process start draining on first use"""
+    global spool
+    with spool_lock:
+        if spool is None:
+            spool = Spool(SPOOL_PATH)
+            if spool.db.execute("SELECT 1 FROM entries WHERE failed = 0 LIMIT 1").fetchone():
+                spool.start()
+        return spool
+
+
+def respond(view, lookup_value, data, spec, endpoint, key, fingerprint):
+    """Response of a finish request journaled because the database is unreachable"""
+    key = key or f"spool:{uuid.uuid4()}"
+    view_path = f"{type(view).__module__}.{type(view).__qualname__}"
+    spooled = get_spool().append(endpoint, key, fingerprint, view_path, str(lookup_value),
+                                 json.dumps(data), spec)
+    if spooled is None:
+        return Response({'detail': 'Database unavailable and spool full, retry later'},
+                        status=status.HTTP_503_SERVICE_UNAVAILABLE, headers={'Retry-After': '30'})
+    entry_id, same = spooled
+    if not same:
+        return Response({'detail': "Idempotency-Key was already used with a different request"},
+                        status=status.HTTP_422_UNPROCESSABLE_ENTITY)
+    return Response({'detail': 'Database unavailable, request spooled', 'spooled': entry_id},
+                    status=status.HTTP_202_ACCEPTED, headers={'Spooled': 'true'})
+
+
+def resume():
+    """Open an existing journal once per process, so entries of a previous process drain"""
+    global resumed
+    if not resumed:
+        resumed = True
+        if SPOOL_PATH.exists():
+            get_spool()
+
+
+def stats():
+    """Spool counters for the health endpoint, None when there is no journal"""
+    resume()
+    return spool.stats() if spool is not None else None
+
+
+class Unavailable(APIException):
+    status_code = status.HTTP_503_SERVICE_UNAVAILABLE
+    default_detail = 'Database unavailable, retry later'
+    default_code = 'unavailable'
+
+
+class KnownCredentials:
+    """Users of recently accepted sessions and tokens, at most size of them, least recently used first"""
+
+    def __init__(self, size, seconds):
+        self.size = size
+        self.seconds = seconds
+        self.users = OrderedDict()
+        self.lock = threading.Lock()
+
+    def remember(self, credential, user):
+        with self.lock:
+            self.users[credential] = (time.monotonic() + self.seconds, user)
+            self.users.move_to_end(credential)
+            while len(self.users) > self.size:
+                self.users.popitem(last=False)
+
+    def recall(self, credential):
+        """The user of a credential accepted in the last seconds, None otherwise"""
+        with self.lock:
+            known = self.users.get(credential)
+            if known is not None and known[0] < time.monotonic():
+                del self.users[credential]
+                known = None
+        return known[1] if known is not None else None
+
+    def forget(self, credential):
+        with self.lock:
+            self.users.pop(credential, None)
+
+    def forget_user(self, pk):
+        with self.lock:
+            for credential in [credential for credential, (_, user) in self.users.items() if user.pk == pk]:
+                del self.users[credential]
+
+
+known_credentials = KnownCredentials(SPOOL_SESSION_MAX, SPOOL_SESSION_SECONDS)
+
+
+def forget_logged_out(sender, request, **kwargs):
+    """user_logged_out receiver: the session may not authenticate from memory any more"""
+    if request is not None and request.session.session_key:
+        known_credentials.forget(('session', request.session.session_key))
+
+
+def forget_user(sender, instance, **kwargs):
+    """post_save/post_delete receiver of the user model: a changed user is looked up again"""
+    known_credentials.forget_user(instance.pk)
+
+
+class CachedCredentials:
+    """
+    Authentication that keeps accepting the credentials it accepted in the
+    last SPOOL_SESSION_SECONDS while the database is unreachable, as the
+    user they had then; unknown credentials get 503 instead of an error.
+    Subclasses define credential(request), the key the user is cached under
+    """
+
+    def authenticate(self, request):
+        credential = self.credential(request)
+        try:
+            authenticated = super().authenticate(request)
+        except UNAVAILABLE:
+            user = known_credentials.recall(credential) if credential is not None else None
+            if user is None:
+                raise Unavailable()
+            return self.recalled(request, user)
+        if credential is not None:
+            if authenticated is None:
+                known_credentials.forget(credential)
+            else:
+                known_credentials.remember(credential, authenticated[0])
+        return authenticated
+
+    def recalled(self, request, user):
+        return user, None
+
+
+class CachedSessionAuthentication(CachedCredentials, SessionAuthentication):
+
+    def credential(self, request):
+        session_key = request._request.COOKIES.get(settings.SESSION_COOKIE_NAME)
+        return ('session', session_key) if session_key else None
+
+    def recalled(self, request, user):
+        self.enforce_csrf(request)
+        return user, None
+
+
+class CachedTokenAuthentication(CachedCredentials, TokenAuthentication):
+
+    def credential(self, request):
+        auth = get_authorization_header(request).split()
+        if len(auth) == 2 and auth[0].lower() == self.keyword.lower().encode():
+            return ('token', auth[1])
+        return None
+
+
+# Authentication of spooled finish actions, in the order of DEFAULT_AUTHENTICATION_CLASSES
+AUTHENTICATION_CLASSES = [CachedSessionAuthentication, CachedTokenAuthentication]
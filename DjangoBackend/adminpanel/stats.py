@@ -0,0 +1,176 @@
+"""
+Aggregate statistics for the generated stats actions, one SQL query per request
+
+  /api/items/stats/?aggregate=value__avg,value__max,value__p95&group_by=rarity
+  /api/matchs/stats/?bucket=start_time__day&aggregate=duration__avg
+
+- aggregate: <field>__<sum|avg|min|max|pNN> on the numeric fields of the entity
+- group_by: fields declared in "stats": {"group_by": [...]} and boolean fields
+- bucket: <datetime field>__<minute|hour|day|week|month|year>, grouped by
+  date_trunc, or __<N>minute / __<N>hour (5minute, 6hour), grouped by date_bin
+
+The query runs on the filtered queryset (?rarity=epic, ?since=, ...). Results
+are cached per entity generation, which every save and delete advances, and
+for at most STATS_CACHE_SECONDS since bulk updates do not advance it.
+"""
+
+import hashlib
+import os
+import re
+from datetime import timedelta
+
+from django.core.cache import cache
+from django.db.models import Aggregate, Avg, Count, DateTimeField, DurationField, FloatField, Func, Max, Min, Sum, Value
+from django.db.models.functions import Trunc
+from rest_framework.exceptions import ValidationError
+
+from .counters import counter_fields
+from .fields import RANGE_FIELDS, computed_fields, field_type
+
+# Upper bound on how long cached stats may lag behind writes
+STATS_CACHE_SECONDS = int(os.getenv('STATS_CACHE_SECONDS', 60))
+
+# Maximum number of groups returned by one request
+STATS_MAX_GROUPS = int(os.getenv('STATS_MAX_GROUPS', 1000))
+
+BUCKETS = ('minute', 'hour', 'day', 'week', 'month', 'year')
+
+FUNCTIONS = {'sum': Sum, 'avg': Avg, 'min': Min, 'max': Max}
+
+
+def stats_fields(model_config):
+    """
+    Fields usable by the stats action: (aggregate, group_by, bucket).
+    Numbers and durations can be aggregated; boolean fields, fields with
+    choices, rollup dimensions and those in "stats": {"group_by": [...]}
+    grouped; dates bucketed.
+    """
+    fields = model_config.get("fields", {})
+    counters = counter_fields(model_config)
+    computed = computed_fields(model_config)
+    aggregate, group_by, bucket = [], [], []
+    for name, field_def in fields.items():
+        if name in counters:
+            ftype = 'IntegerField'
+        elif name in computed:
+            ftype = field_type(computed[name]['output'])
+        else:
+            ftype = field_type(field_def)
+        if ftype in RANGE_FIELDS and ftype not in ('DateTimeField', 'DateField', 'TimeField'):
+            aggregate.append(name)
+        elif ftype in ('DateTimeField', 'DateField'):
+            bucket.append(name)
+        if ftype == 'BooleanField' or 'choices=' in str(field_def):
+            group_by.append(name)
+    declared = model_config.get("stats", {}).get("group_by", [])
+    for rollup in model_config.get("rollups", {}).values():
+        declared = declared + rollup.get("dimensions", [])
+    group_by += [f for f in dict.fromkeys(declared) if f in fields and f not in group_by]
+    return aggregate, group_by, bucket
+
+
+class Percentile(Aggregate):
+    """percentile_cont(fraction) WITHIN GROUP (ORDER BY expression)"""
+
+    function = 'percentile_cont'
+    template = '%(function)s(%(fraction)s) WITHIN GROUP (ORDER BY %(expressions)s)'
+
+    def __init__(self, expression, fraction, **extra):
+        super().__init__(expression, fraction=float(fraction), **extra)
+
+
+class DateBin(Func):
+    """date_bin(stride, expression, origin): buckets of any width, counted from 2000-01-01 UTC"""
+
+    function = 'date_bin'
+    template = "%(function)s(%(expressions)s, TIMESTAMPTZ '2000-01-01 00:00:00+00')"
+    output_field = DateTimeField()
+
+    def __init__(self, stride, expression, **extra):
+        super().__init__(Value(stride, output_field=DurationField()), expression, **extra)
+
+
+def split(value):
+    return [item for item in (value or '').split(',') if item]
+
+
+def aggregate_expression(model, spec, numeric):
+    field_name, _, function = spec.rpartition('__')
+    if field_name not in numeric:
+        raise ValidationError({'aggregate': f"{spec}: aggregates work on {', '.join(numeric) or 'no fields'}"})
+    if function in FUNCTIONS:
+        return FUNCTIONS[function](field_name)
+    percentile = re.fullmatch(r'p(\d{1,2}(?:\.\d+)?)', function)
+    if not percentile:
+        raise ValidationError({'aggregate': f"{spec}: use __sum, __avg, __min, __max or __pNN"})
+    # percentile_cont() interpolates intervals as intervals, anything else as double precision
+    is_duration = model._meta.get_field(field_name).get_internal_type() == 'DurationField'
+    return Percentile(field_name, float(percentile.group(1)) / 100,
+                      output_field=DurationField() if is_duration else FloatField())
+
+
+def bucket_expression(spec, buckets):
+    field_name, _, kind = spec.rpartition('__')
+    stride = re.fullmatch(r'([1-9]\d{0,3})(minute|hour)', kind)
+    if field_name not in buckets or (kind not in BUCKETS and not stride):
+        raise ValidationError({'bucket': f"{spec}: use <{'|'.join(buckets) or 'field'}>__<{'|'.join(BUCKETS)}> "
+                                         f"or __<N>minute, __<N>hour"})
+    if stride:
+        return DateBin(timedelta(**{f"{stride.group(2)}s": int(stride.group(1))}), field_name)
+    return Trunc(field_name, kind)
+
+
+def compute(queryset, params, numeric, group_by, buckets):
+    """Run the aggregate query described by the request parameters"""
+    model = queryset.model
+    aggregates = {'count': Count('*')}
+    for spec in split(params.get('aggregate')):
+        aggregates[spec] = aggregate_expression(model, spec, numeric)
+
+    groups = {}
+    for field_name in split(params.get('group_by')):
+        if field_name not in group_by:
+            raise ValidationError({'group_by': f"{field_name}: can group by {', '.join(group_by) or 'nothing'}"})
+        groups[field_name] = field_name
+    for spec in split(params.get('bucket')):
+        groups[spec] = bucket_expression(spec, buckets)
+
+    if not groups:
+        return queryset.order_by().aggregate(**aggregates)
+
+    keys = list(groups)
+    annotations = {key: expression for key, expression in groups.items() if not isinstance(expression, str)}
+    rows = list(
+        queryset.order_by().annotate(**annotations).values(*keys)
+        .annotate(**aggregates).order_by(*keys)[:STATS_MAX_GROUPS + 1]
+    )
+    return {'groups': rows[:STATS_MAX_GROUPS], 'truncated': len(rows) > STATS_MAX_GROUPS}
+
+
+def generation_key(model):
+    return f"stats:generation:{model._meta.label_lower}"
+
+
+def advance_generation(sender, **kwargs):
+    """post_save/post_delete receiver: cached stats of the entity are outdated"""
+    if sender._meta.app_label != 'adminpanel':
+        return
+    key = generation_key(sender)
+    try:
+        cache.incr(key)
+    except ValueError:
+        cache.set(key, 1, None)
+
+
+def cached(queryset, params, numeric, group_by, buckets):
+    """compute() through the cache, keyed by entity generation and request parameters"""
+    model = queryset.model
+    generation = cache.get(generation_key(model), 0)
+    # The parameters also select the filters applied to queryset
+    query = '&'.join(f"{k}={v}" for k, v in sorted(params.items()))
+    key = f"stats:{model._meta.label_lower}:{generation}:{hashlib.md5(query.encode()).hexdigest()}"
+    result = cache.get(key)
+    if result is None:
+        result = compute(queryset, params, numeric, group_by, buckets)
+        cache.set(key, result, STATS_CACHE_SECONDS)
+    return result
@@ -0,0 +1,73 @@
+"""
+A2S poller against StandIn servers on 127.0.0.1: challenges, split player
+lists and servers that do not answer
+"""
+
+import asyncio
+import random
+
+from django.test import SimpleTestCase
+
+from adminpanel.a2s import DEFAULTS, Poller, StandIn
+
+
+def poll(stand_ins, timeout=DEFAULTS["timeout"]):
+    """Status of one poll_once over the given StandIn protocols"""
+
+    async def main():
+        loop = asyncio.get_running_loop()
+        transports, servers = [], {}
+        try:
+            for index, stand_in in enumerate(stand_ins):
+                transport, _ = await loop.create_datagram_endpoint(lambda: stand_in, local_addr=('127.0.0.1', 0))
+                transports.append(transport)
+                port = transport.get_extra_info('sockname')[1]
+                servers[f"127.0.0.1:{port}"] = {"name": f"Server {index}", "host": "127.0.0.1", "port": port}
+            poller = Poller({"model": None, **DEFAULTS, "timeout": timeout})
+            status = await poller.poll_once(servers)
+            return [status[key] for key in servers], poller
+        finally:
+            for transport in transports:
+                transport.close()
+
+    return asyncio.run(main())
+
+
+class PollerTests(SimpleTestCase):
+
+    def test_info_and_players(self):
+        players = [("Alice", 12, 65.5), ("Bob", -1, 3.0)]
+        (server,), poller = poll([StandIn(name="EU Arena", map_name="Docks", players=players, max_players=24)])
+
+        self.assertEqual(server['state'], 'online')
+        self.assertEqual(server['name'], 'Server 0')
+        info = server['info']
+        self.assertEqual((info['name'], info['map'], info['players'], info['max_players']), ("EU Arena", "Docks", 2, 24))
+        self.assertEqual(info['port'], int(server['address'].rpartition(':')[2]))
+        self.assertEqual(server['players'], [{'name': "Alice", 'score': 12, 'duration': 65.5},
+                                             {'name': "Bob", 'score': -1, 'duration': 3.0}])
+        self.assertIsNotNone(server['ping_ms'])
+        self.assertEqual(poller.counters['answered'], 1)
+
+    def test_split_player_list(self):
+        players = [(f"Player{index:03}", index, float(index)) for index in range(100)]
+        (server,), _ = poll([StandIn(players=players, max_players=100, split=300)])
+
+        self.assertEqual(server['state'], 'online')
+        self.assertEqual([player['name'] for player in server['players']], [name for name, _, _ in players])
+        self.assertEqual(server['players'][99]['score'], 99)
+
+    def test_lost_requests_are_resent(self):
+        random.seed(47)
+        (server,), _ = poll([StandIn(drop=0.5)], timeout=5.0)
+
+        self.assertEqual(server['state'], 'online')
+
+    def test_silent_server_goes_offline(self):
+        (online, silent), poller = poll([StandIn(), StandIn(drop=1.0)], timeout=0.5)
+
+        self.assertEqual(online['state'], 'online')
+        self.assertEqual(silent['state'], 'offline')
+        self.assertEqual(silent['failures'], 1)
+        self.assertIn('No reply', silent['error'])
+        self.assertEqual(poller.counters['timeouts'], 1)
@@ -0,0 +1,88 @@
+"""
+/api/batch/: steps in order, references between them, and atomic batches
+that stop and roll back at the first failing step
+"""
+
+import json
+from datetime import timedelta
+
+from django.apps import apps
+from django.contrib.auth import get_user_model
+from django.test import TransactionTestCase
+from django.utils import timezone
+
+
+class BatchTests(TransactionTestCase):
+
+    def setUp(self):
+        self.Player = apps.get_model('adminpanel', 'Player')
+        self.Match = apps.get_model('adminpanel', 'Match')
+        self.Guild = apps.get_model('adminpanel', 'Guild')
+        user = get_user_model().objects.create_user('server', password='secret')
+        self.client.force_login(user)
+        self.alice = self.Player.objects.create(username='alice', email='alice@example.com')
+        self.bob = self.Player.objects.create(username='bob', email='bob@example.com')
+        self.start = (timezone.now() - timedelta(minutes=20)).isoformat()
+
+    def batch(self, body, **headers):
+        return self.client.post('/api/batch/', json.dumps(body), content_type='application/json', **headers)
+
+    def test_steps_refer_to_earlier_responses(self):
+        response = self.batch({"requests": [
+            {"id": "match", "method": "POST", "path": "/api/matchs/",
+             "body": {"match_id": "m-1", "start_time": self.start}},
+            {"method": "GET", "path": "/api/matchs/{{match.id}}/"},
+        ]})
+
+        self.assertEqual(response.status_code, 200)
+        steps = response.json()['responses']
+        self.assertEqual([step['status'] for step in steps], [201, 200])
+        self.assertEqual(steps[1]['body']['match_id'], 'm-1')
+
+    def test_atomic_batch_rolls_back_at_a_missing_foreign_key(self):
+        response = self.batch({"atomic": True, "requests": [
+            {"method": "POST", "path": "/api/matchs/", "body": {"match_id": "m-1", "start_time": self.start}},
+            {"method": "POST", "path": "/api/matchs/m-1/finish/", "body": {"winner": 999999, "loser": self.bob.pk}},
+            {"method": "GET", "path": "/api/matchs/"},
+        ]})
+
+        self.assertEqual(response.status_code, 200)
+        body = response.json()
+        self.assertFalse(body['committed'])
+        self.assertEqual([step['status'] for step in body['responses']], [201, 400])
+        self.assertFalse(self.Match.objects.exists())
+
+    def test_atomic_batch_increment_of_a_missing_row(self):
+        guild = self.Guild.objects.create(name='Knights')
+        response = self.batch({"atomic": True, "requests": [
+            {"method": "POST", "path": f"/api/guilds/{guild.pk}/member_count/increment/", "body": {"by": 2}},
+            {"method": "POST", "path": "/api/guilds/999999/member_count/increment/", "body": {"by": 1}},
+        ]})
+
+        body = response.json()
+        self.assertFalse(body['committed'])
+        self.assertEqual([step['status'] for step in body['responses']], [202, 404])
+        shards = apps.get_model('adminpanel', 'GuildMemberCountShard')
+        self.assertFalse(shards.objects.exists())
+
+    def test_atomic_batch_commits(self):
+        response = self.batch({"atomic": True, "requests": [
+            {"method": "POST", "path": "/api/matchs/", "body": {"match_id": "m-1", "start_time": self.start}},
+            {"method": "POST", "path": "/api/matchs/m-1/finish/",
+             "body": {"winner": self.alice.pk, "loser": self.bob.pk}},
+        ]})
+
+        self.assertTrue(response.json()['committed'])
+        self.assertEqual(self.Match.objects.get(match_id='m-1').winner_id, self.alice.pk)
+
+    def test_steps_do_not_inherit_request_headers(self):
+        self.Match.objects.create(match_id='m-1', start_time=self.start)
+        step = {"method": "POST", "path": "/api/matchs/m-1/finish/",
+                "body": {"winner": self.alice.pk, "loser": self.bob.pk}}
+        response = self.batch({"requests": [step, {**step, "headers": {"Idempotency-Key": "finish-m-1"}}]},
+                              HTTP_IDEMPOTENCY_KEY='finish-m-1')
+
+        self.assertEqual([step['status'] for step in response.json()['responses']], [200, 409])
+
+    def test_body_must_be_an_object(self):
+        self.assertEqual(self.batch([{"method": "GET", "path": "/api/matchs/"}]).status_code, 400)
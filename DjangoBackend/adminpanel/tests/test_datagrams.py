@@ -0,0 +1,110 @@
+"""
+UDP telemetry: datagrams packed with pack_datagram, received by a Listener
+over a local socket and written to the table with COPY
+"""
+
+import asyncio
+import math
+import socket
+import time
+
+from django.apps import apps
+from django.db import connection
+from django.test import TransactionTestCase
+
+from adminpanel.datagrams import Listener, pack_datagram, udp_specs
+
+
+def receive(listener, datagrams, timeout=2.0):
+    """Send datagrams to the listener over 127.0.0.1 and wait until it took them all"""
+
+    async def main():
+        loop = asyncio.get_running_loop()
+        transport, _ = await loop.create_datagram_endpoint(lambda: listener, local_addr=('127.0.0.1', 0))
+        sender = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        try:
+            for data in datagrams:
+                sender.sendto(data, transport.get_extra_info('sockname'))
+            deadline = time.monotonic() + timeout
+            while time.monotonic() < deadline:
+                seen = sum(counters['packets'] + counters['malformed'] for counters in listener.servers.values())
+                if seen + listener.counters['malformed'] >= len(datagrams):
+                    return
+                await asyncio.sleep(0.01)
+        finally:
+            sender.close()
+            transport.close()
+
+    asyncio.run(main())
+
+
+class ListenerTests(TransactionTestCase):
+
+    def setUp(self):
+        self.model = apps.get_model('adminpanel', 'TelemetryEvent')
+        self.spec = udp_specs()['TelemetryEvent']
+        self.listener = Listener(self.model, self.spec)
+
+    def tearDown(self):
+        # The writer thread has its own connection, which would keep the test database in use
+        self.listener.executor.submit(lambda: connection.close()).result()
+        self.listener.executor.shutdown()
+
+    def test_round_trip(self):
+        now = time.time()
+        receive(self.listener, [
+            pack_datagram(self.spec, 'position', 0, ['eu-1', 'm-77'],
+                          [(now, 5, 1.5, -2.0, 0.25), (now + 0.1, 6, 3.0, 4.0, 0.0)]),
+            pack_datagram(self.spec, 'kill', 1, ['eu-1', 'm-77'], [(now + 0.2, 5, 100.0)]),
+            pack_datagram(self.spec, 'tick', 0, ['us-2', ''], [(now, 60.0)]),
+        ])
+        self.listener.flush_now()
+
+        self.assertEqual(self.listener.counters['flushed'], 4)
+        self.assertEqual(self.model.objects.count(), 4)
+        position = self.model.objects.get(kind='position', player=5)
+        self.assertEqual((position.server, position.match_id), ('eu-1', 'm-77'))
+        self.assertEqual((position.x, position.y, position.z), (1.5, -2.0, 0.25))
+        self.assertAlmostEqual(position.time.timestamp(), now, places=5)
+        self.assertIsNone(position.value)
+        kill = self.model.objects.get(kind='kill')
+        self.assertEqual((kill.player, kill.value), (5, 100.0))
+        tick = self.model.objects.get(kind='tick')
+        self.assertEqual((tick.server, tick.match_id, tick.player), ('us-2', '', None))
+        self.assertEqual(self.listener.servers['eu-1']['events'], 3)
+        self.assertEqual(self.listener.servers['us-2']['packets'], 1)
+
+    def test_invalid_times_are_counted_not_written(self):
+        now = time.time()
+        receive(self.listener, [
+            pack_datagram(self.spec, 'tick', 0, ['eu-1', ''], [(now, 1.0), (math.nan, 2.0), (1e300, 3.0)]),
+        ])
+        self.listener.flush_now()
+
+        self.assertEqual(list(self.model.objects.values_list('value', flat=True)), [1.0])
+        self.assertEqual(self.listener.servers['eu-1']['invalid'], 2)
+        self.assertEqual(self.listener.counters['flushed'], 1)
+
+    def test_sequence_gaps_out_of_order_and_restarts(self):
+        tick = [(time.time(), 1.0)]
+        receive(self.listener, [pack_datagram(self.spec, 'tick', sequence, ['eu-1', ''], tick)
+                                for sequence in (0, 1, 4, 2, 0)])
+
+        counters = self.listener.servers['eu-1']
+        self.assertEqual(counters['packets'], 5)
+        self.assertEqual(counters['sequence_gaps'], 2)
+        self.assertEqual(counters['out_of_order'], 1)
+        self.assertEqual(counters['restarts'], 1)
+
+    def test_malformed_datagrams(self):
+        good = pack_datagram(self.spec, 'tick', 0, ['eu-1', ''], [(time.time(), 1.0)])
+        receive(self.listener, [
+            b'UT',
+            b'XX' + good[2:],
+            good[:-1],
+            pack_datagram(self.spec, 'tick', 0, ['eu-1', 'x' * 33], [(time.time(), 1.0)]),
+        ])
+
+        self.assertEqual(self.listener.counters['malformed'], 3)
+        self.assertEqual(self.listener.servers['eu-1']['malformed'], 1)
+        self.assertEqual(self.listener.filling.total, 0)
@@ -0,0 +1,71 @@
+"""
+The finish action: one transaction that sets the end of a row and adds to
+the counters of its related rows, replayable by Idempotency-Key
+"""
+
+import json
+from datetime import timedelta
+
+from django.apps import apps
+from django.contrib.auth import get_user_model
+from django.test import TransactionTestCase
+from django.utils import timezone
+
+
+class FinishTests(TransactionTestCase):
+
+    def setUp(self):
+        self.Player = apps.get_model('adminpanel', 'Player')
+        self.Match = apps.get_model('adminpanel', 'Match')
+        user = get_user_model().objects.create_user('server', password='secret')
+        self.client.force_login(user)
+        self.alice = self.Player.objects.create(username='alice', email='alice@example.com')
+        self.bob = self.Player.objects.create(username='bob', email='bob@example.com')
+        self.Match.objects.create(match_id='m-1', start_time=timezone.now() - timedelta(minutes=20))
+
+    def finish(self, match_id, body, **headers):
+        return self.client.post(f'/api/matchs/{match_id}/finish/', json.dumps(body),
+                                content_type='application/json', **headers)
+
+    def test_finish_sets_fields_and_counters(self):
+        response = self.finish('m-1', {'winner': self.alice.pk, 'loser': self.bob.pk})
+
+        self.assertEqual(response.status_code, 200)
+        match = self.Match.objects.get(match_id='m-1')
+        self.assertIsNotNone(match.end_time)
+        self.assertEqual((match.winner_id, match.loser_id), (self.alice.pk, self.bob.pk))
+        self.assertEqual(response.json()['winner']['matches_played'], 1)
+        for player in (self.alice, self.bob):
+            player.refresh_from_db()
+            self.assertEqual(player.matches_played, 1)
+
+    def test_second_finish_conflicts(self):
+        self.finish('m-1', {'winner': self.alice.pk, 'loser': self.bob.pk})
+        response = self.finish('m-1', {'winner': self.bob.pk, 'loser': self.alice.pk})
+
+        self.assertEqual(response.status_code, 409)
+        self.assertEqual(self.Match.objects.get(match_id='m-1').winner_id, self.alice.pk)
+
+    def test_idempotency_key_replays_the_response(self):
+        body = {'winner': self.alice.pk, 'loser': self.bob.pk}
+        first = self.finish('m-1', body, HTTP_IDEMPOTENCY_KEY='finish-m-1')
+        again = self.finish('m-1', body, HTTP_IDEMPOTENCY_KEY='finish-m-1')
+        other = self.finish('m-1', {'winner': self.bob.pk}, HTTP_IDEMPOTENCY_KEY='finish-m-1')
+
+        self.assertEqual(again.status_code, 200)
+        self.assertEqual(again.json(), first.json())
+        self.assertEqual(again.headers['Idempotent-Replayed'], 'true')
+        self.assertEqual(other.status_code, 422)
+        self.alice.refresh_from_db()
+        self.assertEqual(self.alice.matches_played, 1)
+
+    def test_unknown_player_is_rejected(self):
+        response = self.finish('m-1', {'winner': 999999, 'loser': self.bob.pk})
+
+        self.assertEqual(response.status_code, 400)
+        self.assertIsNone(self.Match.objects.get(match_id='m-1').end_time)
+        self.bob.refresh_from_db()
+        self.assertEqual(self.bob.matches_played, 0)
+
+    def test_unknown_match(self):
+        self.assertEqual(self.finish('m-404', {'winner': self.alice.pk}).status_code, 404)
@@ -0,0 +1,93 @@
+"""
+Replaying the finish spool: entries are applied in batches, and an entry the
+database refuses is kept as failed without holding up the rest
+"""
+
+import json
+import tempfile
+from datetime import timedelta
+from pathlib import Path
+from unittest import mock
+
+from django.apps import apps
+from django.conf import settings
+from django.test import TransactionTestCase
+from django.utils import timezone
+
+from adminpanel.finishing import finish_spec, request_fingerprint
+from adminpanel.spool import Spool
+
+ENDPOINT = 'adminpanel.match.finish'
+VIEW = 'adminpanel.views.MatchViewSet'
+
+
+class ReplayTests(TransactionTestCase):
+
+    def setUp(self):
+        self.Player = apps.get_model('adminpanel', 'Player')
+        self.Match = apps.get_model('adminpanel', 'Match')
+        config = json.loads(settings.DYNAMIC_MODELS_CONFIG['CONFIG_PATH'].read_text())
+        self.spec = finish_spec('Match', config['Match'], config)
+        self.directory = tempfile.TemporaryDirectory()
+        self.spool = Spool(Path(self.directory.name) / 'finish.sqlite3')
+        # Replayed by the tests, not by a drainer thread
+        patcher = mock.patch.object(Spool, 'start')
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.alice = self.Player.objects.create(username='alice', email='alice@example.com')
+        self.bob = self.Player.objects.create(username='bob', email='bob@example.com')
+        started = timezone.now() - timedelta(minutes=20)
+        for match_id in ('m-1', 'm-2', 'm-3'):
+            self.Match.objects.create(match_id=match_id, start_time=started)
+
+    def tearDown(self):
+        self.spool.db.close()
+        self.directory.cleanup()
+
+    def spool_finish(self, match_id, winner, loser, end_time=None):
+        data = {'winner': winner, 'loser': loser, 'end_time': end_time or timezone.now().isoformat()}
+        key = f"spool:{match_id}"
+        return self.spool.append(ENDPOINT, key, request_fingerprint(match_id, data), VIEW, match_id,
+                                 json.dumps(data), self.spec)
+
+    def test_replay_applies_entries_and_counters(self):
+        self.spool_finish('m-1', self.alice.pk, self.bob.pk)
+        self.spool_finish('m-2', self.bob.pk, self.alice.pk)
+
+        self.assertEqual(self.spool.replay_batch(), 2)
+
+        self.assertEqual(self.Match.objects.get(match_id='m-1').winner_id, self.alice.pk)
+        self.assertEqual(self.Match.objects.get(match_id='m-2').winner_id, self.bob.pk)
+        self.alice.refresh_from_db()
+        self.assertEqual(self.alice.matches_played, 2)
+        stats = self.spool.stats()
+        self.assertEqual((stats['replayed'], stats['depth'], stats['failed_entries']), (2, 0, 0))
+
+    def test_unknown_player_fails_only_its_entry(self):
+        self.spool_finish('m-1', self.alice.pk, self.bob.pk)
+        missing = self.spool_finish('m-2', 999999, self.alice.pk)[0]
+        self.spool_finish('m-3', self.bob.pk, self.alice.pk)
+
+        self.assertEqual(self.spool.replay_batch(), 3)
+
+        finished = self.Match.objects.filter(end_time__isnull=False)
+        self.assertEqual(sorted(finished.values_list('match_id', flat=True)), ['m-1', 'm-3'])
+        self.assertIsNone(self.Match.objects.get(match_id='m-2').end_time)
+        rows = self.spool.db.execute("SELECT id, failed, error FROM entries").fetchall()
+        self.assertEqual([(entry_id, failed) for entry_id, failed, _ in rows], [(missing, 1)])
+        self.assertIn('foreign key', rows[0][2])
+        # Nothing pending is left to retry
+        self.assertEqual(self.spool.replay_batch(), 0)
+
+    def test_already_applied_entry_is_forgotten(self):
+        end_time = timezone.now().isoformat()
+        self.spool_finish('m-1', self.alice.pk, self.bob.pk, end_time)
+        self.assertEqual(self.spool.replay_batch(), 1)
+        # As if the journal lost track of the commit: the stored response answers the replay
+        self.spool_finish('m-1', self.alice.pk, self.bob.pk, end_time)
+        self.assertEqual(self.spool.replay_batch(), 1)
+
+        stats = self.spool.stats()
+        self.assertEqual((stats['already_applied'], stats['depth']), (1, 0))
+        self.alice.refresh_from_db()
+        self.assertEqual(self.alice.matches_played, 1)
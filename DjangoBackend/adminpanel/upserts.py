@@ -0,0 +1,263 @@
+"""
+Upsert actions declared with "upsert" in entities.json
+
+  "Player": {"upsert": {"on": "username", "update": ["email"]}}
+
+  POST /api/players/upsert/
+  [{"username": "alice", "email": "alice@example.com"}, ...]
+
+  {"results": [{"id": 16, "username": "alice", "created": false}, ...]}
+
+Rows are validated in Python, without uniqueness queries, and written with
+one INSERT ... ON CONFLICT (username) DO UPDATE ... RETURNING per batch.
+Conflicting rows only take the "update" fields, and only when they differ,
+so repeating an upsert writes nothing. Concurrent requests in one process
+are coalesced: a writer thread collects rows for UPSERT_WINDOW_MS (or until
+UPSERT_BATCH_SIZE rows are queued) and writes them all in one statement,
+while the requests wait for their ids. Inside a transaction rows are
+written right away, in it.
+"""
+
+import os
+import threading
+
+from django.core.exceptions import FieldDoesNotExist, ValidationError as DjangoValidationError
+from django.db import DEFAULT_DB_ALIAS, connection, connections
+from rest_framework.exceptions import ValidationError
+from rest_framework.response import Response
+
+from . import multiget, stats
+from .counters import counter_fields
+from .fields import ComputedField, field_type
+
+# Most rows per request
+UPSERT_MAX_ROWS = int(os.getenv('UPSERT_MAX_ROWS', 5000))
+
+# Most rows per statement; a full queue is written without waiting for the window
+UPSERT_BATCH_SIZE = int(os.getenv('UPSERT_BATCH_SIZE', 5000))
+
+# Milliseconds the first of concurrent upserts waits for others to join its statement
+UPSERT_WINDOW_MS = float(os.getenv('UPSERT_WINDOW_MS', 5))
+
+
+def upsert_spec(model_name, model_config):
+    """
+    The upsert action of a model, None if it declares none:
+      "upsert": {"on": "username", "update": ["email"]}
+    "on" is a unique field; "update" lists the fields a conflicting row takes
+    from the request, all others are only written on insert. Counters are
+    read-only and start at their default.
+    """
+    upsert = model_config.get("upsert")
+    if not upsert:
+        return None
+    fields = model_config.get("fields", {})
+    on = upsert.get("on")
+    if on not in multiget.natural_keys(model_name, model_config).values():
+        raise ValueError(f"{model_name}: upsert 'on' must name a unique field")
+    for name in upsert.get("update", []):
+        if name not in fields or name == on or field_type(fields[name]) in ("counter", "computed"):
+            raise ValueError(f"{model_name}: upsert cannot update field '{name}'")
+    return {"on": on, "update": list(upsert.get("update", [])), "read_only": list(counter_fields(model_config))}
+
+
+def insert_fields(model):
+    """Fields an upsert writes on insert: all stored, non-generated columns but the pk"""
+    return [field for field in model._meta.concrete_fields
+            if not field.primary_key and not isinstance(field, ComputedField)]
+
+
+def clean_row(model, spec, data):
+    """Column values of one request row, in insert_fields() order; raises DjangoValidationError"""
+    if not isinstance(data, dict):
+        raise DjangoValidationError({'non_field_errors': ['Expected an object']})
+    fields = insert_fields(model)
+    errors = {}
+    values = {}
+    for name, raw in data.items():
+        try:
+            field = model._meta.get_field(name)
+        except FieldDoesNotExist:
+            errors[name] = ['Unknown field']
+            continue
+        if field not in fields or field.name in spec["read_only"]:
+            errors[name] = ['Cannot be written']
+            continue
+        try:
+            value = field.target_field.to_python(raw) if field.is_relation else field.to_python(raw)
+            if value is None and not field.null:
+                raise DjangoValidationError(field.error_messages['null'])
+            if value is not None:
+                field.run_validators(value)
+        except DjangoValidationError as e:
+            errors[name] = e.messages
+            continue
+        values[field.attname] = value
+    for field in fields:
+        required = field.name in [spec["on"]] + spec["update"] or not (
+            field.has_default() or field.null or getattr(field, 'auto_now', False)
+            or getattr(field, 'auto_now_add', False))
+        if required and field.attname not in values and field.name not in errors:
+            errors[field.name] = ['This field is required.']
+    if errors:
+        raise DjangoValidationError(errors)
+    instance = model(**values)
+    # The connection proxy is a thread-local lookup on every access
+    db = connections[DEFAULT_DB_ALIAS]
+    return [field.get_db_prep_save(field.pre_save(instance, True), db) for field in fields]
+
+
+def write(model, spec, rows):
+    """Upsert cleaned rows; returns (pk, created) per row, in order"""
+    quote = connection.ops.quote_name
+    meta = model._meta
+    table = quote(meta.db_table)
+    fields = insert_fields(model)
+    key_field = meta.get_field(spec["on"])
+    key_index = fields.index(key_field)
+    key = quote(key_field.column)
+    columns = ", ".join(quote(field.column) for field in fields)
+    arrays = ", ".join(f"%s::{field.db_type(connection)}[]" for field in fields)
+    # A statement may not update a row twice: the last row of a key wins
+    latest = {row[key_index]: row for row in rows}
+    if spec["update"]:
+        targets = [quote(meta.get_field(name).column) for name in spec["update"]]
+        conflict = (
+            f"DO UPDATE SET {', '.join(f'{column} = EXCLUDED.{column}' for column in targets)} "
+            f"WHERE ({', '.join(f'{table}.{column}' for column in targets)}) "
+            f"IS DISTINCT FROM ({', '.join(f'EXCLUDED.{column}' for column in targets)})"
+        )
+    else:
+        conflict = "DO NOTHING"
+
+    found = {}
+    batch = sorted(latest)
+    with connection.cursor() as cursor:
+        for start in range(0, len(batch), UPSERT_BATCH_SIZE):
+            chunk = [latest[value] for value in batch[start:start + UPSERT_BATCH_SIZE]]
+            # One array parameter per column; rows go in key order so concurrent batches lock alike.
+            # Rows left unchanged are not returned by the INSERT, the second SELECT finds them.
+            cursor.execute(
+                f"WITH v AS (SELECT * FROM unnest({arrays}) AS v({columns})), "
+                f"written AS (INSERT INTO {table} ({columns}) SELECT {columns} FROM v ORDER BY {key} "
+                f"ON CONFLICT ({key}) {conflict} "
+                f"RETURNING {table}.{quote(meta.pk.column)}, {table}.{key}, xmax = 0) "
+                f"SELECT * FROM written UNION ALL "
+                f"SELECT {table}.{quote(meta.pk.column)}, {table}.{key}, false FROM {table} JOIN v USING ({key}) "
+                f"WHERE {table}.{key} NOT IN (SELECT {key} FROM written)",
+                [list(column) for column in zip(*chunk)],
+            )
+            for pk, value, created in cursor.fetchall():
+                found[value] = (pk, created)
+        # Rows committed by a concurrent batch after this statement started
+        missing = [value for value in batch if value not in found]
+        if missing:
+            cursor.execute(
+                f"SELECT {quote(meta.pk.column)}, {key} FROM {table} WHERE {key} = ANY(%s)", [missing]
+            )
+            for pk, value in cursor.fetchall():
+                found[value] = (pk, False)
+
+    # Receivers of a regular save, once per batch instead of once per row
+    stats.advance_generation(model)
+    if multiget.OBJECT_CACHE_SECONDS:
+        for value in batch:
+            multiget.drop_cached(model, model(pk=found[value][0], **{key_field.attname: value}))
+    return [found[row[key_index]] for row in rows]
+
+
+class Batch:
+    """Rows queued for one statement"""
+
+    def __init__(self):
+        self.rows = []
+        self.full = threading.Event()
+        self.done = threading.Event()
+        self.results = None
+        self.error = None
+
+
+class Coalescer:
+    """Upserts of concurrent callers, written together by one writer thread on its own connection"""
+
+    def __init__(self, model, spec):
+        self.model = model
+        self.spec = spec
+        self.lock = threading.Lock()
+        self.pending = Batch()
+        self.queued = threading.Event()
+        self.writer = None
+
+    def upsert(self, rows):
+        """(pk, created) per cleaned row, once the batch they joined is written"""
+        with self.lock:
+            batch = self.pending
+            start = len(batch.rows)
+            batch.rows.extend(rows)
+            if len(batch.rows) >= UPSERT_BATCH_SIZE:
+                batch.full.set()
+            if self.writer is None:
+                self.writer = threading.Thread(target=self.run, name='upsert-writer', daemon=True)
+                self.writer.start()
+        self.queued.set()
+        batch.done.wait()
+        if batch.error is not None:
+            raise batch.error
+        return batch.results[start:start + len(rows)]
+
+    def run(self):
+        while True:
+            self.queued.wait()
+            # Rows arriving while the previous batch was written start the next one right away
+            self.pending.full.wait(UPSERT_WINDOW_MS / 1000)
+            with self.lock:
+                batch, self.pending = self.pending, Batch()
+                self.queued.clear()
+            connection.close_if_unusable_or_obsolete()
+            try:
+                batch.results = write(self.model, self.spec, batch.rows)
+            except Exception as e:
+                batch.error = e
+                connection.close()
+            finally:
+                batch.done.set()
+
+
+coalescers = {}
+coalescers_lock = threading.Lock()
+
+
+def upsert(model, spec, rows):
+    """(pk, created) per cleaned row"""
+    if connection.in_atomic_block or not UPSERT_WINDOW_MS:
+        return write(model, spec, rows)
+    with coalescers_lock:
+        if model not in coalescers:
+            coalescers[model] = Coalescer(model, spec)
+        coalescer = coalescers[model]
+    return coalescer.upsert(rows)
+
+
+def respond(view, request, spec):
+    """Response of an upsert action: an object or a list of objects in, their ids out"""
+    model = view.get_queryset().model
+    data = request.data if isinstance(request.data, list) else [request.data]
+    if not data:
+        raise ValidationError({'non_field_errors': ['Expected at least one row']})
+    if len(data) > UPSERT_MAX_ROWS:
+        raise ValidationError({'non_field_errors': [f"At most {UPSERT_MAX_ROWS} rows"]})
+    rows = []
+    errors = []
+    for item in data:
+        try:
+            rows.append(clean_row(model, spec, item))
+            errors.append({})
+        except DjangoValidationError as e:
+            errors.append(e.message_dict)
+    if any(errors):
+        raise ValidationError(errors if isinstance(request.data, list) else errors[0])
+
+    key_index = insert_fields(model).index(model._meta.get_field(spec["on"]))
+    results = [{'id': pk, spec["on"]: row[key_index], 'created': created}
+               for row, (pk, created) in zip(rows, upsert(model, spec, rows))]
+    return Response({'results': results})
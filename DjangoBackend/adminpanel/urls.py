@@ -2,6 +2,9 @@ from django.urls import path, include
 from rest_framework.routers import DefaultRouter
 from django.http import JsonResponse
 
+from . import spool
+from .batch import BatchView
+
 # Import views safely
 try:
     from . import views
@@ -29,6 +32,26 @@ if VIEWS_AVAILABLE:
         router.register(r'guilds', views.GuildViewSet)
     except AttributeError:
         pass  # GuildViewSet not found
+    try:
+        router.register(r'telemetryevents', views.TelemetryEventViewSet)
+    except AttributeError:
+        pass  # TelemetryEventViewSet not found
+    try:
+        router.register(r'gameservers', views.GameServerViewSet)
+    except AttributeError:
+        pass  # GameServerViewSet not found
+    try:
+        router.register(r'leaderboards', views.LeaderboardViewSet, basename='leaderboard')
+    except AttributeError:
+        pass  # no leaderboards declared
+    try:
+        router.register(r'ratings', views.RatingViewSet, basename='rating')
+    except AttributeError:
+        pass  # no ratings declared
+    try:
+        router.register(r'servers', views.ServerViewSet, basename='server')
+    except AttributeError:
+        pass  # no a2s declared
 
 def api_health(request):
     """Health check endpoint with model information"""
@@ -52,6 +75,14 @@ def api_health(request):
                 model_info['guilds'] = models.Guild.objects.count()
             except Exception:
                 model_info['guilds'] = 'unavailable'
+            try:
+                model_info['telemetryevents'] = models.TelemetryEvent.objects.count()
+            except Exception:
+                model_info['telemetryevents'] = 'unavailable'
+            try:
+                model_info['gameservers'] = models.GameServer.objects.count()
+            except Exception:
+                model_info['gameservers'] = 'unavailable'
         except ImportError:
             pass
 
@@ -59,13 +90,16 @@ def api_health(request):
         'status': 'ok',
         'service': 'django-backend',
         'views_available': VIEWS_AVAILABLE,
-        'configured_models': ['Player', 'Match', 'Item', 'Guild'],
+        'configured_models': ['Player', 'Match', 'Item', 'Guild', 'TelemetryEvent', 'GameServer'],
         'model_counts': model_info,
+        'spool': spool.stats(),
         'endpoints': {
             'players': '/api/players/',
             'matchs': '/api/matchs/',
             'items': '/api/items/',
             'guilds': '/api/guilds/',
+            'telemetryevents': '/api/telemetryevents/',
+            'gameservers': '/api/gameservers/',
         },
         'api_docs': '/api/schema/',
         'admin_panel': '/admin/'
@@ -78,5 +112,6 @@ def api_status(request):
 urlpatterns = [
     path('health/', api_health, name='api-health'),
     path('status/', api_status, name='api-status'),
+    path('batch/', BatchView.as_view(), name='api-batch'),
     path('', include(router.urls)),
 ]
\ No newline at end of file
@@ -22,6 +22,7 @@ INSTALLED_APPS = [
     'django.contrib.staticfiles',
     # Third party apps
     'rest_framework',
+    'rest_framework.authtoken',
     'drf_spectacular',
     'corsheaders',
     # Local apps
@@ -68,6 +69,8 @@ DATABASES = {
         'PASSWORD': os.getenv('DB_PASSWORD'),
         'HOST': os.getenv('DB_HOST', 'ue-database'),
         'PORT': os.getenv('DB_PORT', '5432'),
+        # Fail fast while the database restarts, so spooled endpoints can fall back
+        'OPTIONS': {'connect_timeout': int(os.getenv('DB_CONNECT_TIMEOUT', 5))},
     }
 }
 
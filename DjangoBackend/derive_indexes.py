@@ -0,0 +1,322 @@
+#!/usr/bin/env python3
+"""
+Derive database indexes from entities.json configuration
+Looks at meta.ordering, foreign keys, admin list filters, admin search fields,
+keyset sort keys, the partition field, the retention field, rollup time fields
+and indexed computed fields, and reports each derived index with the query it
+serves.
+Used by generate_models.py; run directly to print the report.
+
+Per-entity overrides in entities.json:
+  "indexing": {
+    "auto": false,                 # derive nothing for this entity
+    "exclude": ["created_at"],     # skip derived indexes led by these fields
+    "keyset": ["-start_time"]      # sort keys used for keyset pagination
+  }
+
+Storage hints declare BRIN indexes for append-ordered timestamp columns;
+they replace single-column b-tree indexes on those columns:
+  "storage": {"brin": ["start_time"]}     # or {"start_time": {"pages_per_range": 32}}
+
+Query parameter filters are only generated for fields that lead an index,
+others can be allowed explicitly:
+  "filtering": {"allow": ["item_type"]}
+
+Named scopes always get a partial index over the rows they select:
+  "scopes": {
+    "active": "end_time__isnull=True",
+    "richest": {"filter": "is_active=True", "order_by": ["-member_count"]}
+  }
+"""
+
+import ast
+import hashlib
+import json
+from pathlib import Path
+
+from adminpanel.counters import counter_fields
+from adminpanel.fields import RANGE_FIELDS, computed_fields, field_type
+from generate_admin import configure_admin_fields
+
+# Configuration paths
+CONFIG_PATH = Path("config/entities.json")
+
+TEXT_FIELDS = ['CharField', 'TextField', 'EmailField', 'SlugField']
+
+
+def has_own_index(field_def):
+    """Whether Django already creates an index for the field itself"""
+    field_def_str = str(field_def)
+    if "db_index=False" in field_def_str:
+        return False
+    return (field_type(field_def) in ['ForeignKey', 'OneToOneField']
+            or any(opt in field_def_str for opt in ['unique=True', 'primary_key=True', 'db_index=True']))
+
+
+def index_name(model_name, fields, suffix="idx"):
+    """Short, stable index name (Django limits index names to 30 characters)"""
+    columns = [f.lstrip('-') for f in fields]
+    digest = hashlib.md5(f"{model_name}:{','.join(fields)}:{suffix}".encode()).hexdigest()[:6]
+    base = f"{model_name[:8]}_{'_'.join(c[:8] for c in columns)}".lower()[:19]
+    return f"{base}_{digest}_{suffix}"
+
+
+def covers(index_fields, wanted):
+    """Whether a b-tree index on index_fields also serves wanted"""
+    if len(wanted) > len(index_fields):
+        return False
+    if len(wanted) == 1:
+        # A single column can be scanned in either direction
+        return index_fields[0].lstrip('-') == wanted[0].lstrip('-')
+    prefix = index_fields[:len(wanted)]
+    flipped = [f[1:] if f.startswith('-') else f"-{f}" for f in prefix]
+    return prefix == wanted or flipped == wanted
+
+
+def order_by_sql(fields):
+    return ", ".join(f"{f[1:]} DESC" if f.startswith('-') else f for f in fields)
+
+
+def with_tiebreaker(sort_keys):
+    """Append the pk in the direction of the leading sort key (stable keyset order)"""
+    if any(f.lstrip('-') == 'id' for f in sort_keys):
+        return list(sort_keys)
+    return list(sort_keys) + ['-id' if sort_keys[0].startswith('-') else 'id']
+
+
+def parse_filter(expression):
+    """
+    Parse a Django filter string such as "is_active=True, value__gte=100"
+    into lookup kwargs. Only literal values are accepted.
+    """
+    call = ast.parse(f"Q({expression})", mode="eval").body
+    if call.args:
+        raise ValueError(f"Filter '{expression}' must only use lookup=value pairs")
+    return {kw.arg: ast.literal_eval(kw.value) for kw in call.keywords}
+
+
+def q_code(expression):
+    """Python code of a Q object for a filter string"""
+    lookups = parse_filter(expression)
+    return f"Q({', '.join(f'{lookup}={value!r}' for lookup, value in lookups.items())})"
+
+
+def model_scopes(model_config):
+    """
+    Normalized scopes of a model: {name: {'filter': str, 'order_by': list}}.
+    Scopes order by their own order_by, else meta.ordering, newest first by id
+    otherwise, always with the pk as tiebreaker.
+    """
+    fields = model_config.get("fields", {})
+    ordering = [f for f in model_config.get("meta", {}).get("ordering", []) if f.lstrip('-') in fields]
+    scopes = {}
+    for name, scope in model_config.get("scopes", {}).items():
+        if not name.isidentifier():
+            print(f"Warning: scope '{name}' is not a valid Python identifier, skipped")
+            continue
+        if isinstance(scope, str):
+            scope = {"filter": scope}
+        order_by = scope.get("order_by") or ordering or ['-id']
+        scopes[name] = {"filter": scope["filter"], "order_by": with_tiebreaker(order_by)}
+    return scopes
+
+
+def derive_indexes(model_name, model_config):
+    """
+    Derive the indexes a model needs from its configuration.
+    Returns (derived, skipped). Derived entries have 'name', 'kind' ('btree',
+    'partial', 'brin' or 'trigram'), 'fields', 'serves' and 'source', partial
+    ones also a 'condition', brin ones 'pages_per_range'; skipped entries
+    carry a 'reason' instead of a name.
+    """
+    fields = model_config.get("fields", {})
+    meta = model_config.get("meta", {})
+    indexing = model_config.get("indexing", {})
+
+    # Scoped endpoints rely on their partial index, so these are not optional
+    derived = []
+    for scope_name, scope in model_scopes(model_config).items():
+        derived.append({
+            'kind': 'partial', 'fields': scope['order_by'], 'condition': scope['filter'],
+            'serves': f"WHERE {scope['filter']} ORDER BY {order_by_sql(scope['order_by'])}",
+            'source': f"scope '{scope_name}'",
+            'name': index_name(model_name, [scope_name] + scope['order_by'], 'prt'),
+        })
+    brin = model_config.get("storage", {}).get("brin", [])
+    if isinstance(brin, list):
+        brin = {name: {} for name in brin}
+    for name, options in brin.items():
+        if name not in fields:
+            print(f"Warning: BRIN field '{name}' of {model_name} is not a field, skipped")
+            continue
+        derived.append({
+            'kind': 'brin', 'fields': [name], 'pages_per_range': options.get("pages_per_range"),
+            'serves': f"WHERE {name} BETWEEN ? AND ? (rows stored in {name} order)",
+            'source': "storage.brin", 'name': index_name(model_name, [name], 'brn'),
+        })
+    if indexing.get("auto", True) is False:
+        return derived, []
+
+    exclude = set(indexing.get("exclude", []))
+    ordering = [f for f in meta.get("ordering", []) if f.lstrip('-') in fields]
+    keyset = [f for f in indexing.get("keyset", []) if f.lstrip('-') in fields or f.lstrip('-') == 'id']
+    foreign_keys = [f for f, d in fields.items() if field_type(d) in ['ForeignKey', 'OneToOneField']]
+    _, search_fields, list_filter, _ = configure_admin_fields(model_config)
+
+    # (kind, fields, serves, source)
+    candidates = []
+    if ordering:
+        sort_keys = with_tiebreaker(ordering)
+        candidates.append(('btree', sort_keys, f"ORDER BY {order_by_sql(sort_keys)}", "meta.ordering"))
+    if keyset:
+        sort_keys = with_tiebreaker(keyset)
+        candidates.append(('btree', sort_keys,
+                           f"WHERE ({', '.join(f.lstrip('-') for f in sort_keys)}) < (?) "
+                           f"ORDER BY {order_by_sql(sort_keys)}", "indexing.keyset"))
+    partition_field = model_config.get("partition_by", {}).get("field")
+    if partition_field in fields:
+        # Serves ordered appends across partitions and ranges within one
+        candidates.append(('btree', [partition_field],
+                           f"WHERE {partition_field} >= ? ORDER BY {partition_field} DESC", "partition_by"))
+    retention_field = model_config.get("retention", {}).get("field")
+    if retention_field in fields:
+        candidates.append(('btree', [retention_field], f"WHERE {retention_field} < ? LIMIT ?", "retention"))
+    for rollup in model_config.get("rollups", {}).values():
+        # refresh_rollups reads each new minute range; stats read the range after the watermark
+        if rollup.get("time") in fields:
+            candidates.append(('btree', [rollup["time"]], f"WHERE {rollup['time']} >= ? AND {rollup['time']} < ?",
+                               "rollups"))
+    for name, computed in computed_fields(model_config).items():
+        if computed["index"]:
+            candidates.append(('btree', [name], f"WHERE {name} > ? ORDER BY {name}", "computed field"))
+    for fk in foreign_keys:
+        if ordering:
+            candidates.append(('btree', [fk] + ordering,
+                               f"WHERE {fk}_id = ? ORDER BY {order_by_sql(ordering)}", "foreign key + meta.ordering"))
+    for name in list_filter:
+        if name not in fields:
+            continue
+        ftype = field_type(fields[name])
+        if ftype == 'BooleanField':
+            if ordering:
+                candidates.append(('btree', [name] + ordering,
+                                   f"WHERE {name} = ? ORDER BY {order_by_sql(ordering)}", "admin list_filter"))
+            continue
+        shape = f"WHERE {name} BETWEEN ? AND ?" if 'Date' in ftype else f"WHERE {name} = ?"
+        candidates.append(('btree', [name], shape, "admin list_filter"))
+    for name in search_fields:
+        if name in fields and field_type(fields[name]) in TEXT_FIELDS:
+            candidates.append(('trigram', [name], f"WHERE UPPER({name}) LIKE UPPER('%term%')", "admin search_fields"))
+
+    existing = [['id']] + [[f] for f, d in fields.items() if has_own_index(d)]
+    existing += [idx["fields"] for idx in meta.get("indexes", []) if isinstance(idx, dict) and "fields" in idx]
+    skipped = []
+    for kind, index_fields, serves, source in candidates:
+        entry = {'kind': kind, 'fields': index_fields, 'serves': serves, 'source': source}
+        leading = index_fields[0].lstrip('-')
+        if leading in exclude:
+            skipped.append({**entry, 'reason': "excluded in entities.json"})
+            continue
+        if kind == 'btree' and len(index_fields) == 1 and leading in brin:
+            skipped.append({**entry, 'reason': "served by BRIN index"})
+            continue
+        if kind == 'btree':
+            covering = next((e for e in existing if covers(e, index_fields)), None)
+            if covering:
+                skipped.append({**entry, 'reason': f"covered by index on ({', '.join(covering)})"})
+                continue
+            existing.append(index_fields)
+        elif any(d['kind'] == kind and d['fields'] == index_fields for d in derived):
+            continue
+        derived.append({**entry, 'name': index_name(model_name, index_fields, 'idx' if kind == 'btree' else 'trg')})
+
+    return derived, skipped
+
+
+def filter_lookups(model_name, model_config):
+    """
+    Query parameter filters of a model: {field: [lookups]}.
+    Fields leading a b-tree or BRIN index (or allowed in "filtering") get
+    exact and in, plus range lookups for numbers and dates and isnull when
+    nullable; text fields with a trigram index get icontains.
+    """
+    fields = model_config.get("fields", {})
+    meta = model_config.get("meta", {})
+    counters = counter_fields(model_config)
+    computed = computed_fields(model_config)
+    derived, _ = derive_indexes(model_name, model_config)
+
+    indexed = {'id'} | {f for f, d in fields.items() if has_own_index(d)}
+    indexed |= {idx["fields"][0].lstrip('-') for idx in meta.get("indexes", [])
+                if isinstance(idx, dict) and idx.get("fields") and "condition" not in idx}
+    indexed |= {index['fields'][0].lstrip('-') for index in derived if index['kind'] in ('btree', 'brin')}
+    indexed |= set(model_config.get("filtering", {}).get("allow", []))
+    trigram = {index['fields'][0] for index in derived if index['kind'] == 'trigram'}
+
+    lookups = {}
+    for name in ['id'] + list(fields):
+        if name in counters:
+            ftype = 'BigIntegerField' if counters[name]['big'] else 'IntegerField'
+        elif name in computed:
+            ftype = field_type(computed[name]['output'])
+        else:
+            ftype = field_type(fields.get(name, 'AutoField'))
+        if ftype == 'ManyToManyField':
+            continue
+        allowed = []
+        if name in indexed:
+            allowed = ['exact'] if ftype == 'BooleanField' else ['exact', 'in']
+            if ftype in RANGE_FIELDS:
+                allowed += ['gt', 'gte', 'lt', 'lte']
+            if name in computed or 'null=True' in str(fields.get(name)):
+                allowed.append('isnull')
+        if name in trigram:
+            allowed.append('icontains')
+        if allowed:
+            lookups[name] = allowed
+    return lookups
+
+
+def index_code(index):
+    """Python expression for a derived index in models.py"""
+    if index['kind'] == 'brin':
+        pages = f", pages_per_range={index['pages_per_range']}" if index['pages_per_range'] else ""
+        return f"BrinIndex(fields=['{index['fields'][0]}'], name='{index['name']}'{pages})"
+    if index['kind'] == 'trigram':
+        return (f"GinIndex(OpClass(Upper('{index['fields'][0]}'), name='gin_trgm_ops'), "
+                f"name='{index['name']}')")
+    fields_list = ", ".join(f"'{f}'" for f in index['fields'])
+    if index['kind'] == 'partial':
+        return (f"models.Index(fields=[{fields_list}], condition={q_code(index['condition'])}, "
+                f"name='{index['name']}')")
+    return f"models.Index(fields=[{fields_list}], name='{index['name']}')"
+
+
+def format_report(config):
+    """Human readable list of derived and skipped indexes per model"""
+    lines = ["Derived indexes:"]
+    for model_name, model_config in config.items():
+        derived, skipped = derive_indexes(model_name, model_config)
+        if not derived and not skipped:
+            continue
+        lines.append(f"  {model_name}")
+        for index in derived:
+            lines.append(f"    + {index['name']} {index['kind']} ({', '.join(index['fields'])})")
+            lines.append(f"        serves: {index['serves']}  [{index['source']}]")
+        for index in skipped:
+            lines.append(f"    - ({', '.join(index['fields'])}) {index['reason']}  [{index['source']}]")
+    return lines
+
+
+def main():
+    if not CONFIG_PATH.exists():
+        print("No entities.json found.")
+        return False
+    config = json.loads(CONFIG_PATH.read_text())
+    print("\n".join(format_report(config)))
+    return True
+
+
+if __name__ == "__main__":
+    import sys
+    sys.exit(0 if main() else 1)
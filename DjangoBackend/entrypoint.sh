@@ -165,6 +165,9 @@ python manage.py migrate --noinput || {
 
 echo -e "${GREEN}Database migrations completed${NC}"
 
+# Partitioned entities: make sure upcoming partitions exist (run_maintenance keeps them coming)
+python manage.py manage_partitions || echo -e "${YELLOW}Partition maintenance completed with warnings${NC}"
+
 # =============================================================================
 # SUPERUSER CREATION
 # =============================================================================
@@ -243,6 +246,18 @@ if [ "$CREATE_SUPERUSER" = "1" ]; then
     echo
 fi
 
+# =============================================================================
+# UDP TELEMETRY LISTENER
+# =============================================================================
+# Runs next to the web process; exits right away when no entity declares "udp"
+python manage.py listen_telemetry &
+
+# =============================================================================
+# PERIODIC MAINTENANCE
+# =============================================================================
+# Partition maintenance, retention purges and counter folds; exits right away when nothing needs them
+python manage.py run_maintenance &
+
 # =============================================================================
 # START DJANGO SERVER
 # =============================================================================
@@ -11,6 +11,56 @@ from pathlib import Path
 CONFIG_PATH = Path("config/entities.json")
 APP_PATH = Path("adminpanel")
 
+def configure_admin_fields(model_config):
+    """
+    Determine list_display, search_fields, list_filter and readonly_fields
+    for a model, applying admin_options overrides from the config
+    """
+    fields = model_config.get("fields", {})
+    admin_options = model_config.get("admin_options", {})
+    
+    # Determine which fields to display in list view
+    list_display_fields = []
+    search_fields = []
+    list_filter_fields = []
+    readonly_fields = []
+
+    # Analyze fields to auto-configure admin
+    for field_name, field_def in fields.items():
+        field_def_str = str(field_def)
+
+        # Add to search fields if it's a text field
+        if any(field_type in field_def_str for field_type in ['CharField', 'TextField', 'EmailField']):
+            search_fields.append(field_name)
+
+        # Add to list filter if it's a boolean, choice, or foreign key
+        if any(field_type in field_def_str for field_type in ['BooleanField', 'ForeignKey', 'DateTimeField']):
+            list_filter_fields.append(field_name)
+
+        # Add to readonly if it's an auto field, a counter (changed by atomic adds only)
+        # or a computed field (calculated by the database)
+        kind = field_def.get("type") if isinstance(field_def, dict) else field_def
+        if 'auto_now' in field_def_str or 'auto_now_add' in field_def_str or kind in ("counter", "computed"):
+            readonly_fields.append(field_name)
+
+        # Always include in list display (limit to first 6 fields for readability)
+        if len(list_display_fields) < 6:
+            list_display_fields.append(field_name)
+
+    # Always include 'id' as first field in list display
+    if 'id' not in list_display_fields:
+        list_display_fields.insert(0, 'id')
+
+    # Apply admin options from config if provided
+    if admin_options:
+        list_display_fields = admin_options.get("list_display", list_display_fields)
+        search_fields = admin_options.get("search_fields", search_fields)
+        list_filter_fields = admin_options.get("list_filter", list_filter_fields)
+        readonly_fields = admin_options.get("readonly_fields", readonly_fields)
+    
+    # Only the first 4 search fields and filters are used by the admin
+    return list_display_fields, search_fields[:4], list_filter_fields[:4], readonly_fields
+
 def generate_admin():
     """Generate Django admin interfaces based on entities.json configuration"""
     try:
@@ -36,42 +86,8 @@ def generate_admin():
             fields = model_config.get("fields", {})
             admin_options = model_config.get("admin_options", {})
             
-            # Determine which fields to display in list view
-            list_display_fields = []
-            search_fields = []
-            list_filter_fields = []
-            readonly_fields = []
-            
-            # Analyze fields to auto-configure admin
-            for field_name, field_def in fields.items():
-                field_def_str = str(field_def)
-                
-                # Add to search fields if it's a text field
-                if any(field_type in field_def_str for field_type in ['CharField', 'TextField', 'EmailField']):
-                    search_fields.append(field_name)
-                
-                # Add to list filter if it's a boolean, choice, or foreign key
-                if any(field_type in field_def_str for field_type in ['BooleanField', 'ForeignKey', 'DateTimeField']):
-                    list_filter_fields.append(field_name)
-                
-                # Add to readonly if it's an auto field
-                if 'auto_now' in field_def_str or 'auto_now_add' in field_def_str:
-                    readonly_fields.append(field_name)
-                
-                # Always include in list display (limit to first 6 fields for readability)
-                if len(list_display_fields) < 6:
-                    list_display_fields.append(field_name)
-            
-            # Always include 'id' as first field in list display
-            if 'id' not in list_display_fields:
-                list_display_fields.insert(0, 'id')
-            
-            # Apply admin options from config if provided
-            if admin_options:
-                list_display_fields = admin_options.get("list_display", list_display_fields)
-                search_fields = admin_options.get("search_fields", search_fields)
-                list_filter_fields = admin_options.get("list_filter", list_filter_fields)
-                readonly_fields = admin_options.get("readonly_fields", readonly_fields)
+            list_display_fields, search_fields, list_filter_fields, readonly_fields = \
+                configure_admin_fields(model_config)
             
             # Generate admin class
             code_lines.extend([
@@ -157,6 +173,14 @@ def generate_admin():
             
             code_lines.append("")
         
+        if any(model_config.get("anomalies") for model_config in config.values()):
+            code_lines.extend([
+                "# Review queue of detect_anomalies",
+                "from .anomalies import AnomalyAdmin",
+                "admin.site.register(Anomaly, AnomalyAdmin)",
+                "",
+            ])
+
         # Add custom admin site configuration
         code_lines.extend([
             "# Customize admin site header and title",
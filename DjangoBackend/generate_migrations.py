@@ -1,10 +1,23 @@
 #!/usr/bin/env python3
 """
 Enhanced migration script for dynamically generated models.
-Deletes old migrations, generates new ones, applies them, and validates DB state.
+Diffs the generated models against the existing migration history, writes
+only additive 000N_ migrations, applies them, and validates DB state.
+Entities with "partition_by" get a PartitionTable operation once, and
+"storage" hints (unlogged, fillfactor) a SetStorage operation when changed,
+source entities of "leaderboards" a SyncLeaderboards operation and those of
+"rollups" a SyncRollups operation.
+
+Options:
+  --reset               Delete all migrations and regenerate 0001_initial
+                        (only for throwaway databases)
+  --allow-destructive   Emit removals, renames and alterations as detected
+  --dry-run             Print the planned migration without writing it
 """
 
+import json
 import os
+import re
 import subprocess
 import sys
 import shutil
@@ -13,9 +26,13 @@ from pathlib import Path
 
 
 APP_NAME = "adminpanel"
+CONFIG_PATH = Path("config/entities.json")
 MIGRATIONS_PATH = Path(APP_NAME) / "migrations"
 EXCLUDE_FILES = {"__init__.py", "__pycache__"}
 
+# Tables with at least this many rows get non-blocking operations
+LARGE_TABLE_ROWS = int(os.getenv("MIGRATION_LARGE_TABLE_ROWS", 100000))
+
 
 def run_command(cmd, silent=False):
     """Run shell command and return (success, output)"""
@@ -47,11 +64,344 @@ def generate_migrations():
     return run_command(["python", "manage.py", "makemigrations", APP_NAME])
 
 
+def estimate_table_rows():
+    """Estimate row counts of the app tables from pg_class statistics"""
+    from django.db import connection
+
+    try:
+        with connection.cursor() as cursor:
+            cursor.execute(
+                "SELECT relname, reltuples::bigint FROM pg_class "
+                "WHERE relkind IN ('r', 'p') AND relname LIKE %s",
+                [f"{APP_NAME}\\_%"],
+            )
+            return {name: rows for name, rows in cursor.fetchall()}
+    except Exception as e:
+        print(f"⚠️ Could not estimate table sizes ({e}), treating existing tables as large")
+        return None
+
+
+def is_large_table(table, table_rows):
+    if table_rows is None:
+        return True
+    # reltuples is -1 for tables that were never analyzed
+    rows = table_rows.get(table, 0)
+    return rows < 0 or rows >= LARGE_TABLE_ROWS
+
+
+def detect_changes():
+    """Diff the current models against the state of the existing migrations"""
+    from django.apps import apps
+    from django.db.migrations.autodetector import MigrationAutodetector
+    from django.db.migrations.loader import MigrationLoader
+    from django.db.migrations.questioner import NonInteractiveMigrationQuestioner
+    from django.db.migrations.state import ProjectState
+
+    loader = MigrationLoader(None, ignore_no_migrations=True)
+    autodetector = MigrationAutodetector(
+        loader.project_state(),
+        ProjectState.from_apps(apps),
+        NonInteractiveMigrationQuestioner(specified_apps={APP_NAME}, dry_run=False),
+    )
+    changes = autodetector.changes(
+        graph=loader.graph,
+        trim_to_apps={APP_NAME},
+        convert_apps={APP_NAME},
+    )
+    return changes.get(APP_NAME, []), loader
+
+
+def pending_partitions(loader):
+    """PartitionTable operations for partitioned entities not converted by any migration yet"""
+    from adminpanel.operations import PartitionTable
+    from adminpanel.partitions import DEFAULT_PREMAKE, check_partitionable
+
+    done = {operation.model_name.lower()
+            for (app_label, _), migration in loader.disk_migrations.items() if app_label == APP_NAME
+            for operation in migration.operations if isinstance(operation, PartitionTable)}
+    operations = []
+    for model_name, model_config in json.loads(CONFIG_PATH.read_text()).items():
+        spec = model_config.get("partition_by")
+        if spec and model_name.lower() not in done:
+            check_partitionable(model_name, model_config)
+            operations.append(PartitionTable(
+                model_name, spec["field"], spec.get("interval", "month"), spec.get("premake", DEFAULT_PREMAKE),
+            ))
+    return operations
+
+
+def storage_options(model_config):
+    """Normalized storage hints of an entity (the PostgreSQL defaults when absent)"""
+    storage = model_config.get("storage", {})
+    return {"unlogged": bool(storage.get("unlogged", False)), "fillfactor": storage.get("fillfactor")}
+
+
+def pending_storage(loader):
+    """SetStorage operations for entities whose storage hints differ from the migrated ones"""
+    from adminpanel.operations import SetStorage
+
+    migrated = {}
+    for leaf in loader.graph.leaf_nodes(APP_NAME):
+        for key in loader.graph.forwards_plan(leaf):
+            if key[0] != APP_NAME:
+                continue
+            for operation in loader.disk_migrations[key].operations:
+                if isinstance(operation, SetStorage):
+                    migrated[operation.model_name.lower()] = {
+                        "unlogged": operation.unlogged, "fillfactor": operation.fillfactor,
+                    }
+    operations = []
+    for model_name, model_config in json.loads(CONFIG_PATH.read_text()).items():
+        wanted = storage_options(model_config)
+        if wanted != migrated.get(model_name.lower(), storage_options({})):
+            operations.append(SetStorage(model_name, **wanted))
+    return operations
+
+
+def pending_leaderboards(loader, partitioned):
+    """
+    SyncLeaderboards operations for entities whose boards differ from the
+    migrated ones, or that are being partitioned (the trigger moves along)
+    """
+    from adminpanel.leaderboards import source_boards
+    from adminpanel.operations import SyncLeaderboards
+
+    migrated = {}
+    for leaf in loader.graph.leaf_nodes(APP_NAME):
+        for key in loader.graph.forwards_plan(leaf):
+            if key[0] != APP_NAME:
+                continue
+            for operation in loader.disk_migrations[key].operations:
+                if isinstance(operation, SyncLeaderboards):
+                    migrated[operation.model_name.lower()] = operation.boards
+    operations = []
+    for model_name, model_config in json.loads(CONFIG_PATH.read_text()).items():
+        wanted = source_boards(model_name, model_config)
+        current = migrated.get(model_name.lower(), {})
+        if wanted != current or (wanted and model_name.lower() in partitioned):
+            operations.append(SyncLeaderboards(model_name, wanted))
+    return operations
+
+
+def pending_rollups(loader, partitioned):
+    """
+    SyncRollups operations for entities whose rollups differ from the
+    migrated ones, or that are being partitioned (the triggers move along);
+    rollups whose definition changed or went away are reset
+    """
+    from adminpanel.operations import SyncRollups
+    from adminpanel.rollups import source_rollups
+
+    migrated = {}
+    for leaf in loader.graph.leaf_nodes(APP_NAME):
+        for key in loader.graph.forwards_plan(leaf):
+            if key[0] != APP_NAME:
+                continue
+            for operation in loader.disk_migrations[key].operations:
+                if isinstance(operation, SyncRollups):
+                    migrated[operation.model_name.lower()] = operation.rollups
+    operations = []
+    for model_name, model_config in json.loads(CONFIG_PATH.read_text()).items():
+        # Delays and retention only matter to refresh_rollups
+        wanted = {name: {key: rollup[key] for key in ('time', 'dimensions', 'measures')}
+                  for name, rollup in source_rollups(model_name, model_config).items()}
+        current = migrated.get(model_name.lower(), {})
+        if wanted != current or (wanted and model_name.lower() in partitioned):
+            reset = [name for name in current if current[name] != wanted.get(name)]
+            operations.append(SyncRollups(model_name, wanted, reset))
+    return operations
+
+
+def standalone_migration(loader, operations):
+    """Migration for operations the autodetector does not know, on top of the current leaf"""
+    from django.db import migrations
+    from django.db.migrations.autodetector import MigrationAutodetector
+
+    leaf = loader.graph.leaf_nodes(APP_NAME)
+    number = (MigrationAutodetector.parse_number(leaf[0][1]) or 0) + 1 if leaf else 1
+    migration = migrations.Migration(f"{number:04d}_{operations[0].migration_name_fragment}", APP_NAME)
+    migration.dependencies = leaf
+    migration.operations = operations
+    return migration
+
+
+def uses_trigram_index(operation):
+    """Whether an operation creates an index with the pg_trgm operator class"""
+    from django.contrib.postgres.indexes import OpClass
+    from django.db import migrations
+
+    if isinstance(operation, migrations.AddIndex):
+        indexes = [operation.index]
+    elif isinstance(operation, migrations.CreateModel):
+        indexes = operation.options.get("indexes", [])
+    else:
+        return False
+    return any(isinstance(expression, OpClass) and expression.extra.get("name") == "gin_trgm_ops"
+               for index in indexes for expression in index.expressions)
+
+
+def make_additive(migration, table_rows, allow_destructive):
+    """
+    Rewrite detected operations so the migration only adds to the schema.
+    Removals keep their data, new NOT NULL columns on large tables are added
+    nullable and backfilled in batches, indexes on existing tables are
+    built and dropped concurrently, and changed computed columns are
+    recreated. Returns False if the migration holds
+    operations that cannot be made additive.
+    """
+    from django.apps import apps
+    from django.contrib.postgres.operations import RemoveIndexConcurrently, TrigramExtension
+    from django.db import migrations
+    from adminpanel.fields import ComputedField
+    from adminpanel.operations import (
+        AddFieldNonBlocking, BuildIndexConcurrently, RecreateComputedField, RetireField, RetireModel,
+    )
+
+    additive = (migrations.CreateModel, migrations.AddField, migrations.AddIndex,
+                migrations.AddConstraint, migrations.AlterModelOptions)
+    created = {operation.name_lower for operation in migration.operations
+               if isinstance(operation, migrations.CreateModel)}
+    # DROP INDEX CONCURRENTLY does not work on partitioned tables
+    partitioned = {name.lower() for name, model_config in json.loads(CONFIG_PATH.read_text()).items()
+                   if model_config.get("partition_by")}
+    operations = []
+    blocked = []
+
+    for operation in migration.operations:
+        if isinstance(operation, migrations.AddIndex) and operation.model_name_lower not in created:
+            operation = BuildIndexConcurrently(operation.model_name, operation.index)
+            migration.atomic = False
+        elif isinstance(operation, migrations.RemoveIndex):
+            if operation.model_name_lower not in partitioned:
+                operation = RemoveIndexConcurrently(operation.model_name, operation.name)
+                migration.atomic = False
+        elif isinstance(operation, migrations.AddField) and not operation.field.null:
+            table = apps.get_model(APP_NAME, operation.model_name)._meta.db_table
+            if is_large_table(table, table_rows):
+                print(f"  {table} is large, adding {operation.name} without blocking")
+                operation = AddFieldNonBlocking(
+                    operation.model_name, operation.name, operation.field,
+                    preserve_default=operation.preserve_default,
+                )
+                migration.atomic = False
+        elif isinstance(operation, migrations.AddField) and isinstance(operation.field, ComputedField):
+            table = apps.get_model(APP_NAME, operation.model_name)._meta.db_table
+            if operation.model_name_lower not in created and is_large_table(table, table_rows):
+                print(f"  ⚠️ {table} is large, adding computed {operation.name} rewrites it under an exclusive lock")
+        elif isinstance(operation, migrations.AlterField) and isinstance(operation.field, ComputedField):
+            operation = RecreateComputedField(operation.model_name, operation.name, operation.field)
+        elif allow_destructive or isinstance(operation, additive):
+            pass
+        elif isinstance(operation, migrations.RemoveField):
+            operation = RetireField(operation.model_name, operation.name)
+        elif isinstance(operation, migrations.DeleteModel):
+            operation = RetireModel(operation.name)
+        else:
+            blocked.append(operation)
+        operations.append(operation)
+
+    if blocked:
+        print("❌ Detected changes that are not additive:")
+        for operation in blocked:
+            print(f"  - {operation.describe()}")
+        print("  Re-run with --allow-destructive to emit them anyway")
+        return False
+
+    if any(uses_trigram_index(operation) for operation in operations):
+        operations.insert(0, TrigramExtension())
+
+    migration.operations = operations
+    return True
+
+
+def write_migration(migration, dry_run=False):
+    from django.db.migrations.writer import MigrationWriter
+
+    writer = MigrationWriter(migration)
+    content = writer.as_string()
+    if not migration.atomic:
+        content = content.replace(
+            "class Migration(migrations.Migration):\n",
+            "class Migration(migrations.Migration):\n\n    atomic = False\n",
+        )
+
+    if dry_run:
+        print(f"--- {writer.path} (dry run)")
+        print(content)
+        return
+    Path(writer.path).write_text(content)
+    print(f"  Wrote {Path(writer.path).name}")
+
+
+def generate_incremental_migrations(allow_destructive=False, dry_run=False):
+    print("📦 Detecting model changes against the migration history...")
+    migrations_to_write, loader = detect_changes()
+    # Storage follows partitioning, new partitions then get the fillfactor too
+    partitions = pending_partitions(loader)
+    partitioned = {operation.model_name.lower() for operation in partitions}
+    table_operations = (partitions + pending_storage(loader) + pending_leaderboards(loader, partitioned)
+                        + pending_rollups(loader, partitioned))
+    if not migrations_to_write and not table_operations:
+        print("  No changes detected")
+        return True
+
+    table_rows = estimate_table_rows()
+    for migration in migrations_to_write:
+        for operation in migration.operations:
+            print(f"  - {operation.describe()}")
+        if not make_additive(migration, table_rows, allow_destructive):
+            return False
+
+    if table_operations:
+        for operation in table_operations:
+            print(f"  - {operation.describe()}")
+        if migrations_to_write:
+            migrations_to_write[-1].operations.extend(table_operations)
+            migrations_to_write[-1].atomic = False
+        else:
+            migration = standalone_migration(loader, table_operations)
+            migration.atomic = False
+            migrations_to_write.append(migration)
+
+    for migration in migrations_to_write:
+        write_migration(migration, dry_run)
+    return True
+
+
 def apply_migrations():
     print("🔧 Applying migrations...")
     return run_command(["python", "manage.py", "migrate"])
 
 
+def repair_invalid_indexes():
+    """Rebuild indexes left invalid by an interrupted concurrent build"""
+    from django.db import connection
+
+    with connection.cursor() as cursor:
+        cursor.execute(
+            "SELECT c.relname FROM pg_index i "
+            "JOIN pg_class c ON c.oid = i.indexrelid "
+            "JOIN pg_class t ON t.oid = i.indrelid "
+            "WHERE NOT i.indisvalid AND t.relname LIKE %s",
+            [f"{APP_NAME}\\_%"],
+        )
+        invalid = [row[0] for row in cursor.fetchall()]
+        for name in invalid:
+            quoted = connection.ops.quote_name(name)
+            if re.search(r"_cc(new|old)\d*$", name):
+                # Leftover of an interrupted REINDEX CONCURRENTLY
+                print(f"🧹 Dropping leftover index {name}")
+                cursor.execute(f"DROP INDEX CONCURRENTLY IF EXISTS {quoted}")
+                continue
+            print(f"🔁 Rebuilding invalid index {name}")
+            try:
+                cursor.execute(f"REINDEX INDEX CONCURRENTLY {quoted}")
+            except Exception as e:
+                print(f"⚠️ Could not rebuild {name}: {e}")
+                cursor.execute(f"DROP INDEX CONCURRENTLY IF EXISTS {connection.ops.quote_name(name + '_ccnew')}")
+    return invalid
+
+
 def validate_tables(expected_models):
     print("🔍 Validating database tables...")
     django.setup()
@@ -59,7 +409,7 @@ def validate_tables(expected_models):
 
     with connection.cursor() as cursor:
         cursor.execute("""
-            SELECT tablename FROM pg_catalog.pg_tables 
+            SELECT tablename FROM pg_catalog.pg_tables
             WHERE schemaname = 'public'
         """)
         existing = {row[0] for row in cursor.fetchall()}
@@ -76,25 +426,37 @@ def validate_tables(expected_models):
 
 
 def extract_model_names():
-    from config.entities import get_model_names
-    return get_model_names()
+    return list(json.loads(CONFIG_PATH.read_text()).keys())
 
 
 def main():
     print(f"🚀 Starting migration process for app: {APP_NAME}")
+    dry_run = "--dry-run" in sys.argv
 
-    delete_old_migrations()
-
-    success, _ = generate_migrations()
+    if "--reset" in sys.argv:
+        delete_old_migrations()
+        success, _ = generate_migrations()
+    else:
+        success = generate_incremental_migrations(
+            allow_destructive="--allow-destructive" in sys.argv,
+            dry_run=dry_run,
+        )
     if not success:
         print("❌ Migration generation failed")
         return False
+    if dry_run:
+        return True
 
     success, _ = apply_migrations()
     if not success:
         print("❌ Migration application failed")
         return False
 
+    try:
+        repair_invalid_indexes()
+    except Exception as e:
+        print(f"⚠️ Skipping invalid index repair: {e}")
+
     try:
         # Only validate if Django is ready
         expected_models = extract_model_names()
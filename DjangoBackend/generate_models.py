@@ -8,6 +8,10 @@ import json
 import re
 from pathlib import Path
 
+from adminpanel.counters import counter_fields, counter_shard_model
+from adminpanel.fields import computed_fields
+from derive_indexes import derive_indexes, format_report, index_code, index_name, model_scopes, q_code
+
 # Configuration paths
 CONFIG_PATH = Path("config/entities.json")
 APP_PATH = Path("adminpanel")
@@ -37,7 +41,24 @@ def generate_model_class(model_name, model_config):
     fields = model_config.get("fields", {})
     meta = model_config.get("meta", {})
     methods = model_config.get("methods", {})
-    code = [f"class {model_name}(models.Model):"]
+    scopes = model_scopes(model_config)
+    counters = counter_fields(model_config)
+    computed = computed_fields(model_config)
+    code = []
+
+    if scopes:
+        code.append(f"class {model_name}QuerySet(models.QuerySet):")
+        code.append(f'    """Named scopes of {model_name}, each backed by a partial index"""')
+        for scope_name, scope in scopes.items():
+            order_by = ", ".join(f"'{f}'" for f in scope["order_by"])
+            code.extend([
+                "",
+                f"    def {scope_name}(self):",
+                f"        return self.filter({q_code(scope['filter'])}).order_by({order_by})",
+            ])
+        code.extend(["", ""])
+
+    code.append(f"class {model_name}(models.Model):")
 
     if not fields:
         code.append("    pass")
@@ -53,7 +74,15 @@ def generate_model_class(model_name, model_config):
 
     all_warnings = []
     for fname, fdef in fields.items():
-        if isinstance(fdef, str):
+        if fname in counters:
+            # Only ever changed through add_<field>(), see adminpanel/counters.py
+            column_type = "BigIntegerField" if counters[fname]["big"] else "IntegerField"
+            code.append(f"    {fname} = models.{column_type}(default=0)")
+        elif fname in computed:
+            # GENERATED ALWAYS AS (...) STORED, see adminpanel/fields.py
+            code.append(f"    {fname} = ComputedField(expression={computed[fname]['expression']!r}, "
+                        f"output_field=models.{computed[fname]['output']})")
+        elif isinstance(fdef, str):
             warnings = validate_field_definition(fname, fdef)
             all_warnings.extend(warnings)
             cleaned = clean_field_definition(fdef)
@@ -71,6 +100,10 @@ def generate_model_class(model_name, model_config):
         else:
             code.append(f"    {fname} = models.CharField(max_length=255)  # TODO")
 
+    if scopes:
+        code.append("")
+        code.append(f"    objects = {model_name}QuerySet.as_manager()")
+
     code.append("")
     code.append("    class Meta:")
     code.append(f"        verbose_name = '{model_name}'")
@@ -81,19 +114,36 @@ def generate_model_class(model_name, model_config):
             if k == "ordering" and isinstance(v, list):
                 ordering = ", ".join(f"'{item}'" for item in v)
                 code.append(f"        ordering = ({ordering},)")
-            elif k == "indexes" and isinstance(v, list):
-                indexes = []
-                for idx in v:
-                    if isinstance(idx, dict) and "fields" in idx:
-                        fields_list = ", ".join(f"'{f}'" for f in idx["fields"])
-                        indexes.append(f"models.Index(fields=[{fields_list}])")
-                if indexes:
-                    code.append(f"        indexes = [{', '.join(indexes)}]")
+            elif k == "indexes":
+                continue
             elif k in ["unique_together", "permissions"] and isinstance(v, list):
                 code.append(f"        {k} = {v}")
             elif isinstance(v, str):
                 code.append(f"        {k} = '{v}'")
 
+    indexes = []
+    for idx in meta.get("indexes", []):
+        if not isinstance(idx, dict):
+            continue
+        condition = f", condition={q_code(idx['condition'])}" if "condition" in idx else ""
+        if "fields" in idx:
+            fields_list = ", ".join(f"'{f}'" for f in idx["fields"])
+            name = idx.get("name") or (condition and index_name(model_name, idx["fields"], "prt"))
+            name = f", name='{name}'" if name else ""
+            indexes.append(f"models.Index(fields=[{fields_list}]{condition}{name})")
+        elif "expressions" in idx:
+            # Expression indexes, e.g. "Lower('username')", always need a name
+            name = idx.get("name") or index_name(
+                model_name, [re.sub(r"\W+", "", e) for e in idx["expressions"]], "exp")
+            indexes.append(f"models.Index({', '.join(idx['expressions'])}{condition}, name='{name}')")
+    derived, _ = derive_indexes(model_name, model_config)
+    indexes.extend(index_code(index) for index in derived)
+    if indexes:
+        code.append("        indexes = [")
+        for index in indexes:
+            code.append(f"            {index},")
+        code.append("        ]")
+
     code.append("")
     code.append("    def __str__(self):")
     code.append("        return self.__unicode__()")
@@ -117,6 +167,34 @@ def generate_model_class(model_name, model_config):
         code.append(f"        {mbody}")
         code.append("")
 
+    if computed:
+        computed_list = ", ".join(f"'{f}'" for f in computed)
+        code.extend([
+            "    def save(self, *args, **kwargs):",
+            "        adding = self._state.adding",
+            "        super().save(*args, **kwargs)",
+            "        if not adding:",
+            "            # Inserts return computed columns, updates recompute them in the database",
+            f"            self.refresh_from_db(fields=[{computed_list}])",
+            "",
+        ])
+
+    # Atomic counter updates
+    for fname, counter in counters.items():
+        code.extend([
+            "    @classmethod",
+            f"    def add_{fname}(cls, pk, amount=1):",
+            f'        """Add amount to {fname} ({counter["mode"]} counter)"""',
+        ])
+        if counter["mode"] == "sharded":
+            code.append(f"        counters.add_sharded({counter_shard_model(model_name, fname)}, pk, amount, "
+                        f"{counter['shards']})")
+        elif counter["mode"] == "buffered":
+            code.append(f"        counters.buffer.add(cls, pk, '{fname}', amount)")
+        else:
+            code.append(f"        return counters.add(cls, pk, '{fname}', amount)")
+        code.append("")
+
     # Utility methods
     code.extend([
         "    def get_absolute_url(self):",
@@ -129,6 +207,10 @@ def generate_model_class(model_name, model_config):
         ""
     ])
 
+    for fname, counter in counters.items():
+        if counter["mode"] == "sharded":
+            code.extend([""] + generate_shard_model(model_name, fname))
+
     if all_warnings:
         print(f"Warnings for {model_name}:")
         for w in all_warnings:
@@ -137,6 +219,170 @@ def generate_model_class(model_name, model_config):
     return code
 
 
+def generate_shard_model(model_name, field_name):
+    """Model for the shard rows of a sharded counter"""
+    shard_model = counter_shard_model(model_name, field_name)
+    name = index_name(shard_model, ["owner", "shard"], "unq")
+    return [
+        f"class {shard_model}(models.Model):",
+        f'    """Pending increments of {model_name}.{field_name}, folded in by fold_counters"""',
+        f"    owner = models.ForeignKey({model_name}, on_delete=CASCADE, related_name='{field_name}_shards')",
+        "    shard = models.SmallIntegerField()",
+        "    delta = models.BigIntegerField(default=0)",
+        "",
+        f"    counter_field = '{field_name}'",
+        "",
+        "    class Meta:",
+        f"        constraints = [models.UniqueConstraint(fields=['owner', 'shard'], name='{name}')]",
+        "",
+    ]
+
+
+def generate_leaderboard_model():
+    """Summary table of all leaderboards, maintained by triggers (see adminpanel/leaderboards.py)"""
+    return [
+        "class LeaderboardEntry(models.Model):",
+        '    """Score of one owner on one leaderboard"""',
+        "    board = models.CharField(max_length=50)",
+        "    owner_id = models.BigIntegerField()",
+        "    score = models.BigIntegerField(default=0)",
+        "    rows = models.BigIntegerField(default=0)",
+        "    updated_at = models.DateTimeField(auto_now=True)",
+        "",
+        "    class Meta:",
+        "        constraints = [",
+        f"            models.UniqueConstraint(fields=['board', 'owner_id'], "
+        f"name='{index_name('LeaderboardEntry', ['board', 'owner_id'], 'unq')}'),",
+        "        ]",
+        "        indexes = [",
+        "            # Top N and rank counts",
+        f"            models.Index(fields=['board', '-score', 'owner_id'], "
+        f"name='{index_name('LeaderboardEntry', ['board', '-score', 'owner_id'])}'),",
+        "        ]",
+        "",
+    ]
+
+
+def generate_rollup_models():
+    """Tables of the time-series rollups (see adminpanel/rollups.py)"""
+    return [
+        "class Rollup(models.Model):",
+        '    """Aggregate of one measure over one bucket of a rollup, for one combination of dimension values"""',
+        "    rollup = models.CharField(max_length=50)",
+        "    grain = models.CharField(max_length=8)",
+        "    bucket = models.DateTimeField()",
+        "    dimensions = models.JSONField(default=dict)",
+        "    measure = models.CharField(max_length=50, blank=True)",
+        "    rows = models.BigIntegerField(default=0)",
+        "    total = models.FloatField(null=True, blank=True)",
+        "    minimum = models.FloatField(null=True, blank=True)",
+        "    maximum = models.FloatField(null=True, blank=True)",
+        "",
+        "    class Meta:",
+        "        constraints = [",
+        "            # Merge target of refresh_rollups and the triggers; also serves the stats range scans",
+        f"            models.UniqueConstraint(fields=['rollup', 'grain', 'measure', 'bucket', 'dimensions'], "
+        f"name='{index_name('Rollup', ['rollup', 'grain', 'measure', 'bucket', 'dimensions'], 'unq')}'),",
+        "        ]",
+        "",
+        "class RollupWatermark(models.Model):",
+        '    """Time below which the buckets of a rollup are closed"""',
+        "    rollup = models.CharField(max_length=50, unique=True)",
+        "    watermark = models.DateTimeField(null=True, blank=True)",
+        "    updated_at = models.DateTimeField(auto_now=True)",
+        "",
+    ]
+
+
+def generate_rating_models():
+    """Tables of compute_ratings (see adminpanel/ratings.py)"""
+    return [
+        "class Rating(models.Model):",
+        '    """Rating of one owner, as of the last period it played"""',
+        "    name = models.CharField(max_length=50)",
+        "    owner_id = models.BigIntegerField()",
+        "    rating = models.FloatField()",
+        "    deviation = models.FloatField(null=True, blank=True)",
+        "    matches = models.IntegerField(default=0)",
+        "    period = models.BigIntegerField()",
+        "    updated_at = models.DateTimeField(auto_now=True)",
+        "",
+        "    class Meta:",
+        "        constraints = [",
+        f"            models.UniqueConstraint(fields=['name', 'owner_id'], "
+        f"name='{index_name('Rating', ['name', 'owner_id'], 'unq')}'),",
+        "        ]",
+        "        indexes = [",
+        "            # Matchmaking looks up owners in a rating range",
+        f"            models.Index(fields=['name', 'rating'], name='{index_name('Rating', ['name', 'rating'])}'),",
+        "        ]",
+        "",
+        "class RatingCheckpoint(models.Model):",
+        '    """Periods already rated, and the parameters they were rated with"""',
+        "    name = models.CharField(max_length=50, unique=True)",
+        "    params = models.CharField(max_length=32)",
+        "    period = models.BigIntegerField()",
+        "    updated_at = models.DateTimeField(auto_now=True)",
+        "",
+    ]
+
+
+def generate_anomaly_model():
+    """Review table of detect_anomalies (see adminpanel/anomalies.py)"""
+    return [
+        "class Anomaly(models.Model):",
+        '    """An outlier flagged by an anomaly detector, waiting for review"""',
+        "    STATUS_CHOICES = [('open', 'Open'), ('confirmed', 'Confirmed'), ('dismissed', 'Dismissed')]",
+        "",
+        "    detector = models.CharField(max_length=50)",
+        "    entity = models.CharField(max_length=50)",
+        "    object_id = models.BigIntegerField()",
+        "    score = models.FloatField()",
+        "    observed = models.FloatField()",
+        "    expected = models.FloatField()",
+        "    window_start = models.DateTimeField(null=True, blank=True)",
+        "    window_end = models.DateTimeField(null=True, blank=True)",
+        "    status = models.CharField(max_length=10, choices=STATUS_CHOICES, default='open')",
+        "    note = models.TextField(blank=True)",
+        "    detected_at = models.DateTimeField(auto_now_add=True)",
+        "",
+        "    class Meta:",
+        "        verbose_name_plural = 'anomalies'",
+        "        indexes = [",
+        f"            models.Index(fields=['detector', 'status'], name='{index_name('Anomaly', ['detector', 'status'])}'),",
+        "        ]",
+        "",
+        "    def __str__(self):",
+        "        return f\"{self.detector}: {self.entity} {self.object_id}\"",
+        "",
+    ]
+
+
+def generate_idempotency_model():
+    """Stored responses of finish actions (see adminpanel/finishing.py)"""
+    return [
+        "class IdempotencyKey(models.Model):",
+        '    """Response of a request, replayed to retries carrying the same Idempotency-Key"""',
+        "    endpoint = models.CharField(max_length=100)",
+        "    key = models.CharField(max_length=255)",
+        "    fingerprint = models.CharField(max_length=32)",
+        "    status = models.IntegerField()",
+        "    response = models.JSONField(encoder=DjangoJSONEncoder)",
+        "    created_at = models.DateTimeField()",
+        "",
+        "    class Meta:",
+        "        constraints = [",
+        f"            models.UniqueConstraint(fields=['endpoint', 'key'], "
+        f"name='{index_name('IdempotencyKey', ['endpoint', 'key'], 'unq')}'),",
+        "        ]",
+        "        indexes = [",
+        "            # purge_idempotency_keys",
+        f"            models.Index(fields=['created_at'], name='{index_name('IdempotencyKey', ['created_at'])}'),",
+        "        ]",
+        "",
+    ]
+
+
 def generate_models():
     if not CONFIG_PATH.exists():
         print("No entities.json found.")
@@ -147,10 +393,15 @@ def generate_models():
 
     header = [
         "from django.db import models",
-        "from django.db.models import CASCADE, SET_NULL, PROTECT, SET_DEFAULT, DO_NOTHING",
+        "from django.db.models import CASCADE, SET_NULL, PROTECT, SET_DEFAULT, DO_NOTHING, F, Q",
+        "from django.db.models.functions import Coalesce, Lower, TruncDate, Upper",
+        "from django.contrib.postgres.indexes import BrinIndex, GinIndex, OpClass",
         "from django.contrib.auth.models import User",
+        "from django.core.serializers.json import DjangoJSONEncoder",
         "from django.core.validators import MinValueValidator, MaxValueValidator",
         "from django.utils import timezone",
+        "from . import counters",
+        "from .fields import ComputedField",
         "",
         "# Auto-generated models",
         ""
@@ -184,6 +435,16 @@ def generate_models():
     for m in sorted_names:
         all_lines += generate_model_class(m, config[m])
         all_lines.append("")
+    if any(mconfig.get("leaderboards") for mconfig in config.values()):
+        all_lines += generate_leaderboard_model() + [""]
+    if any(mconfig.get("rollups") for mconfig in config.values()):
+        all_lines += generate_rollup_models() + [""]
+    if any(mconfig.get("ratings") for mconfig in config.values()):
+        all_lines += generate_rating_models() + [""]
+    if any(mconfig.get("anomalies") for mconfig in config.values()):
+        all_lines += generate_anomaly_model() + [""]
+    if any(mconfig.get("finish") for mconfig in config.values()):
+        all_lines += generate_idempotency_model() + [""]
 
     # Utility functions
     all_lines += [
@@ -209,6 +470,7 @@ def generate_models():
     output_path = APP_PATH / "models.py"
     output_path.write_text("\n".join(all_lines))
     print(f"Models generated at {output_path}")
+    print("\n".join(format_report(config)))
     return config
 
 
@@ -8,6 +8,9 @@ import json
 from pathlib import Path
 import re
 
+from adminpanel.counters import counter_fields
+from adminpanel.fields import computed_fields
+
 # Configuration paths
 CONFIG_PATH = Path("config/entities.json")
 APP_PATH = Path("adminpanel")
@@ -160,7 +163,10 @@ def generate_basic_serializer(model_name, model_config, relationships):
     # Handle field configuration
     exclude_fields = serializer_options.get("exclude", [])
     include_fields = serializer_options.get("include", None)
-    read_only_fields = serializer_options.get("read_only", [])
+    # Counters only change through their increment/decrement actions, computed fields in the database
+    read_only_fields = serializer_options.get("read_only", []) + [
+        f for f in [*counter_fields(model_config), *computed_fields(model_config)]
+        if f not in serializer_options.get("read_only", [])]
     write_only_fields = serializer_options.get("write_only", [])
     
     if include_fields:
@@ -282,7 +288,8 @@ def generate_create_update_serializer(model_name, model_config):
     
     for field_name, field_def in fields.items():
         field_def_str = str(field_def)
-        if 'auto_now' in field_def_str or 'auto_now_add' in field_def_str:
+        if ('auto_now' in field_def_str or 'auto_now_add' in field_def_str
+                or field_name in counter_fields(model_config) or field_name in computed_fields(model_config)):
             readonly_fields.append(field_name)
         else:
             writable_fields.append(field_name)
@@ -314,6 +321,8 @@ def generate_create_update_serializer(model_name, model_config):
         f"        model = {model_name}",
         f"        fields = '__all__'",
         f"        read_only_fields = {readonly_fields}",
+        "        # many=True: one uniqueness query per field for the whole payload",
+        "        list_serializer_class = BulkListSerializer",
         "",
         ""
     ])
@@ -338,6 +347,7 @@ def generate_serializers():
         code_lines = [
             "from rest_framework import serializers",
             "from django.contrib.auth.models import User",
+            "from .bulk import BulkListSerializer",
             "from .models import *",
             "",
             "# Auto-generated Serializers from entities.json config",
@@ -28,6 +28,9 @@ def generate_urls():
             "from rest_framework.routers import DefaultRouter",
             "from django.http import JsonResponse",
             "",
+            "from . import spool",
+            "from .batch import BatchView",
+            "",
             "# Import views safely",
             "try:",
             "    from . import views",
@@ -51,6 +54,30 @@ def generate_urls():
                 f"        pass  # {model_name}ViewSet not found"
             ])
         
+        if any(model_config.get("leaderboards") for model_config in config.values()):
+            code_lines.extend([
+                f"    try:",
+                f"        router.register(r'leaderboards', views.LeaderboardViewSet, basename='leaderboard')",
+                f"    except AttributeError:",
+                f"        pass  # no leaderboards declared"
+            ])
+        
+        if any(model_config.get("ratings") for model_config in config.values()):
+            code_lines.extend([
+                f"    try:",
+                f"        router.register(r'ratings', views.RatingViewSet, basename='rating')",
+                f"    except AttributeError:",
+                f"        pass  # no ratings declared"
+            ])
+        
+        if any(model_config.get("a2s") for model_config in config.values()):
+            code_lines.extend([
+                f"    try:",
+                f"        router.register(r'servers', views.ServerViewSet, basename='server')",
+                f"    except AttributeError:",
+                f"        pass  # no a2s declared"
+            ])
+        
         # Add health check endpoint
         code_lines.extend([
             "",
@@ -83,6 +110,11 @@ def generate_urls():
             "        'views_available': VIEWS_AVAILABLE,",
             f"        'configured_models': {list(config.keys())},",
             "        'model_counts': model_info,",
+        ])
+        if any(model_config.get("finish", {}).get("spool") for model_config in config.values()):
+            # Depth and drain rate of the local journal of finish requests
+            code_lines.append("        'spool': spool.stats(),")
+        code_lines.extend([
             "        'endpoints': {"
         ])
         
@@ -113,6 +145,7 @@ def generate_urls():
             "urlpatterns = [",
             "    path('health/', api_health, name='api-health'),",
             "    path('status/', api_status, name='api-status'),",
+            "    path('batch/', BatchView.as_view(), name='api-batch'),",
             "    path('', include(router.urls)),",
             "]"
         ])
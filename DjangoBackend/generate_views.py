@@ -5,11 +5,20 @@ Creates views.py with model-specific ViewSets for automatic API exposure
 """
 
 import json
+import os
 from pathlib import Path
 
+from derive_indexes import filter_lookups, model_scopes
+
 CONFIG_PATH = Path("config/entities.json")
 APP_PATH = Path("adminpanel")
 
+# Scope names that would shadow standard or generated ViewSet actions
+RESERVED_ACTIONS = {
+    'list', 'create', 'retrieve', 'update', 'partial_update', 'destroy',
+    'recent', 'stats', 'export', 'timeline', 'search', 'many', 'finish', 'upsert', 'ingest',
+}
+
 
 def generate_views():
     """Generate DRF ViewSets for each model from entities.json"""
@@ -17,6 +26,15 @@ def generate_views():
         print("entities.json not found.")
         return False
 
+    # The feature modules that parse their specs read Django settings when imported
+    os.environ.setdefault("DJANGO_SETTINGS_MODULE", "config.settings")
+    from adminpanel.counters import counter_fields
+    from adminpanel.finishing import finish_spec
+    from adminpanel.ingestion import ingest_spec
+    from adminpanel.multiget import natural_keys
+    from adminpanel.stats import stats_fields
+    from adminpanel.upserts import upsert_spec
+
     try:
         config = json.loads(CONFIG_PATH.read_text())
         print(f"Loaded configuration with {len(config)} models")
@@ -25,6 +43,13 @@ def generate_views():
             "from rest_framework import viewsets",
             "from rest_framework.response import Response",
             "from rest_framework.decorators import action",
+            "from rest_framework.exceptions import NotFound, ValidationError",
+            "from rest_framework import status",
+            "from django.db import IntegrityError",
+            "from django.utils import timezone",
+            "from django.utils.dateparse import parse_datetime",
+            "from . import finishing, ingestion, multiget, rollups, spool, stats, upserts",
+            "from .filters import IndexedFilterBackend",
             "from .models import *",
             "from .serializers import *",
             "",
@@ -44,6 +69,16 @@ def generate_views():
                 f"    \"\"\"ViewSet for {model_name} model\"\"\"",
                 f"    queryset = {model_name}.objects.all()",
                 f"    serializer_class = {base_serializer}",
+                f"    filter_backends = [IndexedFilterBackend]",
+            ])
+
+            # Filters on indexed fields only, see adminpanel/filters.py
+            lines.append(f"    filter_lookups = {{")
+            for field_name, field_lookups in filter_lookups(model_name, model_config).items():
+                lines.append(f"        '{field_name}': {field_lookups},")
+            lines.append(f"    }}")
+
+            lines.extend([
                 "",
                 f"    def get_serializer_class(self):",
                 f"        if self.action in ['create', 'update', 'partial_update']:",
@@ -51,20 +86,61 @@ def generate_views():
                 f"        elif self.action == 'list':",
                 f"            return {list_serializer}",
                 f"        return {base_serializer}",
+                "",
+                f"    def get_serializer(self, *args, **kwargs):",
+                f"        \"\"\"A list posted to create is a bulk create, see adminpanel/bulk.py\"\"\"",
+                f"        if self.action == 'create' and isinstance(kwargs.get('data'), list):",
+                f"            kwargs['many'] = True",
+                f"        return super().get_serializer(*args, **kwargs)",
                 ""
             ])
 
+            # Partitioned tables: bounded ranges only scan the partitions they touch
+            partition_field = model_config.get("partition_by", {}).get("field")
+            recent_order = f"'-{partition_field}', '-id'" if partition_field else "'-id'"
+            if partition_field:
+                lines.extend([
+                    f"    def get_queryset(self):",
+                    f"        \"\"\"Filter on ?since= and ?until= ({partition_field}), pruning partitions\"\"\"",
+                    f"        queryset = super().get_queryset()",
+                    f"        for param, lookup in (('since', 'gte'), ('until', 'lt')):",
+                    f"            value = self.request.query_params.get(param)",
+                    f"            if not value:",
+                    f"                continue",
+                    f"            moment = parse_datetime(value)",
+                    f"            if moment is None:",
+                    f"                raise ValidationError({{param: 'Expected an ISO 8601 datetime'}})",
+                    f"            if timezone.is_naive(moment):",
+                    f"                moment = timezone.make_aware(moment)",
+                    f"            queryset = queryset.filter(**{{f'{partition_field}__{{lookup}}': moment}})",
+                    f"        return queryset",
+                    "",
+                ])
+
             # Add custom actions
+            aggregate, group_by, bucket = stats_fields(model_config)
             lines.extend([
                 f"    @action(detail=False)",
                 f"    def recent(self, request):",
-                f"        recent = self.queryset.order_by('-id')[:10]",
+                f"        recent = self.get_queryset().order_by({recent_order})[:10]",
                 f"        serializer = self.get_serializer(recent, many=True)",
                 f"        return Response(serializer.data)",
                 "",
                 f"    @action(detail=False)",
                 f"    def stats(self, request):",
-                f"        return Response({{'count': self.queryset.count()}})",
+                f"        \"\"\"count plus ?aggregate=, ?group_by= and ?bucket= in one query, see adminpanel/stats.py\"\"\"",
+            ])
+            if model_config.get("rollups"):
+                # Time buckets and ranges are answered from the rollup tables when the parameters allow it,
+                # ?source=raw opts out and ?source=rollup in
+                lines.extend([
+                    f"        rolled_up = rollups.answer({model_name}, request.query_params)",
+                    f"        if rolled_up is not None:",
+                    f"            return Response(rolled_up, headers={{'X-Stats-Source': 'rollup'}})",
+                ])
+            lines.extend([
+                f"        queryset = self.filter_queryset(self.get_queryset())",
+                f"        return Response(stats.cached(queryset, request.query_params, {aggregate}, {group_by}, {bucket}))",
                 "",
                 f"    @action(detail=False)",
                 f"    def export(self, request):",
@@ -83,6 +159,153 @@ def generate_views():
                 "",
             ])
 
+            # Natural-key lookups: retrieve() through the field's unique index
+            keys = natural_keys(model_name, model_config)
+            lines.extend([
+                f"    @action(detail=False)",
+                f"    def many(self, request):",
+                f"        \"\"\"Rows by ?ids= or ?<unique field>= in request order, one query, see adminpanel/multiget.py\"\"\"",
+                f"        return multiget.respond(self, request, {list(keys.values())})",
+                "",
+            ])
+            if keys:
+                lines.extend([
+                    f"    def retrieve_by(self, field_name, value):",
+                    f"        \"\"\"retrieve() with a unique field instead of the pk\"\"\"",
+                    f"        self.lookup_field = field_name",
+                    f"        self.kwargs[field_name] = value",
+                    f"        return self.retrieve(self.request)",
+                    "",
+                ])
+            for route, field_name in keys.items():
+                lines.extend([
+                    f"    @action(detail=False, url_path=r'{route}/(?P<{field_name}>[^/]+)')",
+                    f"    def by_{field_name}(self, request, {field_name}=None, format=None):",
+                    f"        \"\"\"{model_name} by its unique {field_name}\"\"\"",
+                    f"        return self.retrieve_by('{field_name}', {field_name})",
+                    "",
+                ])
+
+            # Append-only events through an in-process buffer and COPY
+            ingest = ingest_spec(model_name, model_config)
+            if ingest:
+                lines.extend([
+                    f"    @action(detail=False, methods=['get', 'post'])",
+                    f"    def ingest(self, request):",
+                    f"        \"\"\"POST queues events for COPY, GET reports the buffer, see adminpanel/ingestion.py\"\"\"",
+                    f"        return ingestion.respond(self, request, {ingest!r})",
+                    "",
+                ])
+
+            # Batched INSERT ... ON CONFLICT on a unique field
+            upsert = upsert_spec(model_name, model_config)
+            if upsert:
+                lines.extend([
+                    f"    @action(detail=False, methods=['post'])",
+                    f"    def upsert(self, request):",
+                    f"        \"\"\"Insert or update rows by {upsert['on']} in one statement, see adminpanel/upserts.py\"\"\"",
+                    f"        return upserts.respond(self, request, {upsert!r})",
+                    "",
+                ])
+
+            # End-of-row writes in one transaction, replayable by Idempotency-Key
+            finish = finish_spec(model_name, model_config, config)
+            if finish:
+                lookup = finish["lookup"]
+                # Spooled finishes keep authenticating known sessions and tokens while the database is down
+                authentication = ", authentication_classes=spool.AUTHENTICATION_CLASSES" if finish["spool"] else ""
+                lines.extend([
+                    f"    @action(detail=False, methods=['post'], url_path=r'(?P<{lookup}>[^/]+)/finish'{authentication})",
+                    f"    def finish(self, request, {lookup}=None, format=None):",
+                    f"        \"\"\"Set {', '.join([finish['time']] + finish['fields'])} once, in one transaction, "
+                    f"see adminpanel/finishing.py\"\"\"",
+                    f"        return finishing.respond(self, request, {lookup}, {finish!r})",
+                    "",
+                ])
+
+            # Counter actions: atomic adds instead of read-modify-write through update()
+            counters = counter_fields(model_config)
+            if counters:
+                lines.extend([
+                    f"    def counter_amount(self, request):",
+                    f"        try:",
+                    f"            amount = int(request.data.get('by', 1))",
+                    f"        except (TypeError, ValueError):",
+                    f"            raise ValidationError({{'by': 'Expected an integer'}})",
+                    f"        if amount < 1:",
+                    f"            raise ValidationError({{'by': 'Must be at least 1'}})",
+                    f"        return amount",
+                    "",
+                ])
+            for field_name, counter in counters.items():
+                for verb, sign in (("increment", ""), ("decrement", "-")):
+                    lines.extend([
+                        f"    @action(detail=True, methods=['post'], url_path='{field_name}/{verb}')",
+                        f"    def {verb}_{field_name}(self, request, pk=None):",
+                        f"        \"\"\"{verb.title()} {field_name} by {{\"by\": n}} (default 1)\"\"\"",
+                        f"        amount = {sign}self.counter_amount(request)",
+                        f"        pk = {model_name}._meta.pk.to_python(pk)",
+                    ])
+                    if counter["mode"] == "direct":
+                        lines.extend([
+                            f"        value = {model_name}.add_{field_name}(pk, amount)",
+                            f"        if value is None:",
+                            f"            raise NotFound()",
+                            f"        return Response({{'{field_name}': value}})",
+                            "",
+                        ])
+                    elif counter["mode"] == "sharded":
+                        lines.extend([
+                            f"        try:",
+                            f"            {model_name}.add_{field_name}(pk, amount)",
+                            f"        except IntegrityError:",
+                            f"            raise NotFound()",
+                            f"        return Response({{'{field_name}': amount}}, status=status.HTTP_202_ACCEPTED)",
+                            "",
+                        ])
+                    else:
+                        lines.extend([
+                            f"        {model_name}.add_{field_name}(pk, amount)",
+                            f"        return Response({{'{field_name}': amount}}, status=status.HTTP_202_ACCEPTED)",
+                            "",
+                        ])
+
+            # Scoped list actions, served from the scope's partial index
+            for scope_name, scope in model_scopes(model_config).items():
+                if scope_name in RESERVED_ACTIONS:
+                    print(f"Warning: scope '{scope_name}' of {model_name} clashes with an action, skipped")
+                    continue
+                lines.extend([
+                    f"    @action(detail=False)",
+                    f"    def {scope_name}(self, request):",
+                    f"        \"\"\"{model_name} rows where {scope['filter']}\"\"\"",
+                    f"        page = self.paginate_queryset(self.queryset.{scope_name}())",
+                    f"        serializer = self.get_serializer(page, many=True)",
+                    f"        return self.get_paginated_response(serializer.data)",
+                    "",
+                ])
+
+        if any(model_config.get("leaderboards") for model_config in config.values()):
+            lines.extend([
+                "# /api/leaderboards/, registered in urls.py",
+                "from .leaderboards import LeaderboardViewSet",
+                "",
+            ])
+
+        if any(model_config.get("ratings") for model_config in config.values()):
+            lines.extend([
+                "# /api/ratings/, registered in urls.py",
+                "from .ratings import RatingViewSet",
+                "",
+            ])
+
+        if any(model_config.get("a2s") for model_config in config.values()):
+            lines.extend([
+                "# /api/servers/, registered in urls.py",
+                "from .a2s import ServerViewSet",
+                "",
+            ])
+
         # Write the views.py file
         output_path = APP_PATH / "views.py"
         output_path.write_text("\n".join(lines))